@@ -1,8 +1,8 @@
-import nmrpy.data_objects
+import importlib
 from .version import __version__
-from nmrpy.tests import NMRPyTest as test
+from . import storage
 
-def from_path(fid_path='.', file_format=None, arrayset=None):
+def from_path(fid_path='.', file_format=None, arrayset=None, lazy=False, max_resident=storage.MAX_ROWS, pdata=None):
     """
     Instantiate a new :class:`~nmrpy.data_objects.FidArray` object from a .fid directory.
 
@@ -12,8 +12,27 @@ def from_path(fid_path='.', file_format=None, arrayset=None):
        
     :keyword arrayset: (int) array set for interleaved spectra, 
                              user is prompted if not specified 
+
+    :keyword lazy: see :meth:`~nmrpy.data_objects.FidArray.from_path`
+
+    :keyword max_resident: see :meth:`~nmrpy.data_objects.FidArray.from_path`
+
+    :keyword pdata: see :meth:`~nmrpy.data_objects.FidArray.from_path`
     """
-    return nmrpy.data_objects.FidArray.from_path(fid_path,
-                                                 file_format, 
-                                                 arrayset)
+    data_objects = importlib.import_module('nmrpy.data_objects')
+    return data_objects.FidArray.from_path(fid_path,
+                                           file_format,
+                                           arrayset,
+                                           lazy=lazy,
+                                           max_resident=max_resident,
+                                           pdata=pdata)
 
+def __getattr__(name):
+    # nmrpy.data_objects and the tests import the plotting libraries, so they
+    # are only imported on first use; worker processes only need nmrpy.core
+    if name == 'data_objects':
+        return importlib.import_module('nmrpy.data_objects')
+    if name == 'test':
+        from nmrpy.tests import NMRPyTest
+        return NMRPyTest
+    raise AttributeError("module 'nmrpy' has no attribute '{}'".format(name))
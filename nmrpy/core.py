@@ -0,0 +1,1257 @@
+import numpy
+import scipy
+import scipy.fft
+import scipy.optimize
+import scipy.sparse
+import lmfit
+import numbers
+
+class Base():
+    _complex_dtypes = [
+                    numpy.dtype('csingle'),
+                    numpy.dtype('cdouble'),
+                    numpy.dtype('clongdouble'),
+                    ]
+
+    _file_formats = ['varian', 'bruker', None]
+
+    def __init__(self, *args, **kwargs):
+        self.id = kwargs.get('id', None)
+        self._procpar = kwargs.get('procpar', None)
+        self._params = None
+        self.fid_path = kwargs.get('fid_path', '.')
+        self._file_format = None
+
+    @property
+    def id(self):
+        return self.__id
+
+    @id.setter
+    def id(self, id):
+        if isinstance(id, str) or id is None:
+            self.__id = id
+        else:
+            raise AttributeError('ID must be a string or None.')
+        
+    @property
+    def fid_path(self):
+        return self.__fid_path
+
+    @fid_path.setter
+    def fid_path(self, fid_path):
+        if isinstance(fid_path, str):
+            self.__fid_path = fid_path
+        else:
+            raise AttributeError('fid_path must be a string.')
+
+    @property
+    def _file_format(self):
+        return self.__file_format
+
+    @_file_format.setter
+    def _file_format(self, file_format):
+        if file_format in self._file_formats:
+            self.__file_format = file_format
+        else:
+            raise AttributeError('_file_format must be "varian", "bruker", or None.')
+
+    @classmethod
+    def _is_iter(cls, i):
+        try:
+            iter(i)
+            return True
+        except TypeError:
+            return False
+
+    @classmethod
+    def _is_iter_of_iters(cls, i):
+        if type(i) == list and len(i) == 0:
+            return False
+        elif cls._is_numeric_array(i):
+            return i.ndim > 1 or (i.ndim == 1 and len(i) == 0)
+        elif cls._is_iter(i) and all(cls._is_iter(j) for j in i):
+            return True
+        return False
+
+    @classmethod
+    def _is_flat_iter(cls, i):
+        if type(i) == list and len(i) == 0:
+            return True
+        elif cls._is_numeric_array(i):
+            return i.ndim == 1 or (i.ndim > 1 and len(i) == 0)
+        elif cls._is_iter(i) and not any(cls._is_iter(j) for j in i):
+            return True
+        return False
+
+    @staticmethod
+    def _is_numeric_array(i):
+        """
+        Check whether i is an ndarray of numbers, which can be validated from
+        its dtype and shape rather than element by element.
+        """
+        return isinstance(i, numpy.ndarray) and i.dtype.kind in 'iufc'
+
+    @classmethod
+    def _is_number_iter(cls, i):
+        """
+        Check whether all elements of the flat iterable i are numbers.
+        """
+        if cls._is_numeric_array(i):
+            return True
+        return all(isinstance(j, numbers.Number) for j in i)
+
+    @property
+    def _procpar(self):
+        return self.__procpar
+
+    @_procpar.setter
+    def _procpar(self, procpar):
+        if procpar is None:
+            self.__procpar = procpar 
+        elif isinstance(procpar, dict):
+            self.__procpar = procpar 
+            self._params = self._extract_procpar(procpar)
+        else:
+            raise AttributeError('procpar must be a dictionary or None.')
+
+    @property
+    def _params(self):
+        return self.__params
+
+    @_params.setter
+    def _params(self, params):
+        if isinstance(params, dict) or params is None:
+            self.__params = params
+        else:
+            raise AttributeError('params must be a dictionary or None.')
+
+    #processing
+    def _extract_procpar(self, procpar):
+        if self._file_format == 'bruker':
+            return self._extract_procpar_bruker(procpar)
+        elif self._file_format == 'varian':
+            return self._extract_procpar_varian(procpar)
+        #else:
+        #    raise AttributeError('Could not parse procpar.') 
+
+    @staticmethod
+    def _extract_procpar_varian(procpar):
+        """
+        Extract some commonely-used NMR parameters (using Varian denotations)
+        and return a parameter dictionary 'params'.
+        """
+        at = float(procpar['procpar']['at']['values'][0])
+        d1 = float(procpar['procpar']['d1']['values'][0])
+        sfrq = float(procpar['procpar']['sfrq']['values'][0])
+        reffrq = float(procpar['procpar']['reffrq']['values'][0])
+        rfp = float(procpar['procpar']['rfp']['values'][0])
+        rfl = float(procpar['procpar']['rfl']['values'][0])
+        tof = float(procpar['procpar']['tof']['values'][0])
+        rt = at+d1
+        nt = numpy.array(
+            [procpar['procpar']['nt']['values']], dtype=int).flatten()
+        acqtime = numpy.zeros(nt.shape)
+        acqtime[0] = (rt * nt[0] / 2)
+        for i in range(1, len(nt)):
+            acqtime[i] = acqtime[i - 1] + (nt[i - 1] + nt[i]) / 2 * rt
+        acqtime /= 60.   # convert to min
+        sw_hz = float(procpar['procpar']['sw']['values'][0])
+        sw = round(sw_hz/reffrq, 2)
+        sw_left = (0.5+1e6*(sfrq-reffrq)/sw_hz)*sw_hz/sfrq
+        params = dict(
+            at=at,
+            d1=d1,
+            rt=rt,
+            nt=nt,
+            acqtime=acqtime,
+            sw=sw,
+            sw_hz=sw_hz,
+            sfrq=sfrq,
+            reffrq=reffrq,
+            rfp=rfp,
+            rfl=rfl,
+            tof=tof,
+            sw_left=sw_left,
+            )
+        return params
+
+    @staticmethod
+    def _extract_procpar_bruker(procpar): 
+        """
+        Extract some commonly-used NMR parameters (using Bruker denotations)
+        and return a parameter dictionary 'params'.
+        """
+        d1 = procpar['acqus']['D'][1]
+        reffrq = procpar['acqus']['SFO1']
+        nt = procpar['acqus']['NS']
+        sw_hz = procpar['acqus']['SW_h']
+        sw = procpar['acqus']['SW']
+        # lefthand offset of the processed data in ppm
+        if 'procs' in procpar:
+            sfrq = procpar['procs']['SF']
+            sw_left = procpar['procs']['OFFSET']
+        else:
+            sfrq = procpar['acqus']['BF1']
+            sw_left = (0.5+1e6*(sfrq-reffrq)/sw_hz)*sw_hz/sfrq
+        at = procpar['acqus']['TD']/(2*sw_hz)
+        rt = at+d1
+        td = procpar['tdelta']
+        cumulative = procpar['tcum']
+        single = procpar['tsingle']
+        tstart = cumulative - 0.5*single    # tstart for acquisition
+        al = procpar['arraylength']
+        a = procpar['arrayset']
+        if 'acqtime' in procpar:
+            # increments of a pseudo-2D experiment, timed individually
+            acqtime = numpy.array(procpar['acqtime'])
+        else:
+            acqtime = numpy.zeros((al))
+            acqtime[0] = tstart[a-1]
+            for i in range(1, al):
+                acqtime[i] = acqtime[i-1] + td
+        params = dict(
+            at=at,
+            d1=d1,
+            rt=rt,
+            nt=nt,
+            acqtime=acqtime,
+            sw=sw,
+            sw_hz=sw_hz,
+            sfrq=sfrq,
+            reffrq=reffrq,
+            sw_left=sw_left,
+            )
+        return params
+
+
+class FidCore(Base):
+    '''
+    The numerical processing methods of :class:`~nmrpy.data_objects.Fid`:
+    Fourier transformation, phasing and deconvolution. This module does not
+    depend on the plotting and widget libraries, so that worker processes
+    (see :mod:`nmrpy.parallel`) can import it cheaply.
+    '''
+
+    # fitting methods that accept the analytic Jacobian of _f_jac
+    _jacobian_methods = ['leastsq', 'least_squares']
+
+    # scipy.optimize.minimize methods used for phase-correction, by the lmfit
+    # method names accepted by phase_correct; leastsq, the default, cannot
+    # minimise a scalar and uses L-BFGS-B
+    _phasing_methods = {
+            'leastsq': 'L-BFGS-B',
+            'bfgs': 'BFGS',
+            'nelder': 'Nelder-Mead',
+            'l-bfgs-b': 'L-BFGS-B',
+            'lbfgsb': 'L-BFGS-B',
+            'cg': 'CG',
+            'powell': 'Powell',
+            'newton': 'Newton-CG',
+            }
+
+    # maximum number of points of the decimated spectrum used for the coarse
+    # phasing stage
+    _phasing_coarse_size = 4096
+
+    @classmethod
+    def _is_valid_dataset(cls, data):
+        if isinstance(data, str):
+            raise TypeError('Data must be iterable not a string.')
+        if not cls._is_iter(data):
+            raise TypeError('Data must be an iterable.')
+        if not cls._is_flat_iter(data):
+            raise TypeError('Data must not be nested.')
+        if not cls._is_number_iter(data):
+            raise TypeError('Data must consist of numbers only.')
+        return True 
+        
+
+    @staticmethod
+    def _zf(data):
+        """
+        Zero-fill data to double length along its last axis. data may be a
+        single FID or a 2D block of FIDs.
+        """
+        size = data.shape[-1]
+        zf_data = numpy.zeros(data.shape[:-1]+(2*size,), dtype=data.dtype)
+        zf_data[..., :size] = data
+        return zf_data
+
+    @staticmethod
+    def _emhz(data, lb, sw_hz, out=None):
+        """
+        Apply exponential line-broadening along the last axis of data. data
+        may be a single FID or a 2D block of FIDs, in which case the window is
+        computed once and broadcast over all rows.
+
+        :arg lb: degree of line-broadening in Hz
+
+        :arg sw_hz: spectral width in Hz, a scalar or a column of one value per row
+
+        :keyword out: array in which to store the result, pass data to apodise in place
+        """
+        window = numpy.exp(-numpy.pi*numpy.arange(data.shape[-1]) * (lb/sw_hz))
+        return numpy.multiply(window, data, out=out)
+
+    @classmethod
+    def _ft(cls, list_params):
+        """
+        Class method for Fourier-transforming data using multiprocessing.
+        list_params is a tuple of (<data>, <file_format>).
+        """
+        if len(list_params) != 2:
+            raise ValueError('Wrong number of parameters. list_params must contain [<data>, <file_format>]')
+        data, file_format = list_params
+        if cls._is_valid_dataset(data) and file_format in cls._file_formats:
+            return cls._ft_block(data, file_format)
+
+    @staticmethod
+    def _ft_block(data, file_format, workers=None):
+        """
+        Fourier-transform data along its last axis and reorder the halves of
+        the spectrum according to file_format. data may be a single FID or a
+        2D block of FIDs, which is transformed in one batched FFT.
+
+        :arg data: 1D or 2D data array
+
+        :arg file_format: 'varian', 'bruker' or None
+
+        :keyword workers: number of threads used for the FFT, -1 uses all CPUs
+        """
+        data = numpy.asarray(data)
+        fft_data = scipy.fft.fft(data, axis=-1, workers=workers)
+        fft_data = fft_data.astype(data.dtype, copy=False)
+        s = data.shape[-1]
+        half = int(s / 2.0)
+        ft_data = numpy.empty_like(fft_data)
+        if file_format == 'bruker':
+            ft_data[..., :half+1] = fft_data[..., half::-1]
+            ft_data[..., half+1:] = fft_data[..., :half:-1]
+        else:
+            ft_data[..., :s-half] = fft_data[..., half:]
+            ft_data[..., s-half:] = fft_data[..., :half]
+        return ft_data
+
+
+    @staticmethod
+    def _conv_to_ppm(data, index, sw_left, sw):
+            """
+            Convert index array to ppm. 
+            """
+            if isinstance(index, list):
+                    index = numpy.array(index)
+            frc_sw = index/float(len(data))
+            ppm = sw_left-sw*frc_sw
+            if FidCore._is_iter(ppm):
+                return numpy.array([round(i, 2) for i in ppm])
+            else:
+                return round(ppm, 2)
+
+    @staticmethod
+    def _conv_to_index(data, ppm, sw_left, sw):
+            """
+            Convert ppm array to index. 
+            """
+            conv_to_int = False
+            if not FidCore._is_iter(ppm):
+                ppm = [ppm]
+                conv_to_int = True
+            if isinstance(ppm, list):
+                    ppm = numpy.array(ppm)
+            if any(ppm > sw_left) or any(ppm < sw_left-sw):
+                raise ValueError('ppm must be within spectral width.')
+            indices = len(data)*(sw_left-ppm)/sw
+            if conv_to_int:
+                return int(numpy.ceil(indices))
+            return numpy.array(numpy.ceil(indices), dtype=int)
+    
+    @classmethod
+    def _phase_correct(cls, list_params):
+            """
+            Class method for phase-correction using multiprocessing.
+            list_params is a tuple of (<data>, <fitting method>) or
+            (<data>, <fitting method>, <start>), where <start> is None or
+            the (p0, p1) from which to start the fit instead of scanning p0.
+            Returns a tuple of (<phased data>, <p0>, <p1>), where p0 and p1
+            (in degrees) reproduce the phased data from data with
+            :meth:`~nmrpy.data_objects.Fid._ps`.
+            """
+            data, method = list_params[:2]
+            start = list_params[2] if len(list_params) > 2 else None
+            if start is None:
+                p0, p1 = cls._phase_fit(data, method=method)
+            else:
+                p0, p1 = cls._phase_fit(data, method=method, p0=start[0], p1=start[1])
+            phased_data = cls._ps(data, p0=p0, p1=p1)
+            flip = False
+            if abs(phased_data.min()) > abs(phased_data.max()):
+                    phased_data *= -1
+                    flip = not flip
+            if phased_data.sum() < 0.0:
+                    phased_data *= -1
+                    flip = not flip
+            if flip:
+                    p0 += 180.0
+            p0 = (p0+180.0)%360.0-180.0
+            return phased_data, p0, p1
+
+    @classmethod
+    def _phase_correct_shared(cls, list_params):
+            """
+            Class method for phase-correction of one row of a shared data
+            block using multiprocessing. The phased row is written back into
+            the block in place of the original, and (<p0>, <p1>) are returned.
+            list_params is a tuple of (<shared data>, <row index>, <fitting method>, <start>),
+            where <shared data> is a :class:`~nmrpy.parallel.SharedArray`
+            and <start> is as for :meth:`~nmrpy.data_objects.Fid._phase_correct`.
+            """
+            shared, index, method, start = list_params
+            data = shared.array
+            data[index], p0, p1 = cls._phase_correct((data[index], method, start))
+            return p0, p1
+
+    @classmethod
+    def _phase_fit(cls, data, method='leastsq', p0=None, p1=0.0):
+            """
+            Find the zero- and first-order phases (in degrees) that minimise
+            the total absolute real area of data (see
+            :meth:`~nmrpy.data_objects.Fid._phased_data_sum`).
+
+            Unless a starting p0 is given, p0 is first scanned on a coarse
+            grid on a spectrum decimated to at most _phasing_coarse_size
+            points by summing blocks of neighbouring points, and (p0, p1) are
+            optimised on that spectrum. The result is then refined on the full
+            spectrum.
+
+            :keyword method: see :meth:`~nmrpy.data_objects.Fid.phase_correct`
+
+            :keyword p0: starting zero-order phase, skips the coarse stage
+
+            :keyword p1: starting first-order phase
+            """
+            if method not in cls._phasing_methods:
+                raise ValueError('method must be one of: {}'.format(', '.join(cls._phasing_methods)))
+            size = data.shape[-1]
+            ramp = numpy.arange(size)/size
+            if p0 is None:
+                step = int(numpy.ceil(size/cls._phasing_coarse_size))
+                n = size//step
+                coarse_data = data[:n*step].reshape(n, step).sum(1)
+                coarse_ramp = ramp[:n*step].reshape(n, step).mean(1)
+                # the objective is periodic in p0 over 180 degrees
+                grid = numpy.arange(-90.0, 90.0, 10.0)
+                sums = [cls._phased_data_sum([i, p1], coarse_data, coarse_ramp)[0] for i in grid]
+                p0, p1 = cls._phase_minimise([grid[numpy.argmin(sums)], p1], coarse_data, coarse_ramp, method)
+            return cls._phase_minimise([p0, p1], data, ramp, method)
+
+    @classmethod
+    def _phase_minimise(cls, p, data, ramp, method):
+            """
+            Minimise :meth:`~nmrpy.data_objects.Fid._phased_data_sum` from
+            p = [p0, p1], returning (p0, p1). The objective is scaled by the
+            total absolute intensity so that the first steps of the
+            gradient-based methods are of a sensible size.
+            """
+            scale = numpy.abs(data).sum()
+            if scale == 0.0:
+                return float(p[0]), float(p[1])
+            jac = cls._phasing_methods[method] not in ['Nelder-Mead', 'Powell']
+            def objective(p):
+                area, grad = cls._phased_data_sum(p, data, ramp)
+                if jac:
+                    return area/scale, grad/scale
+                return area/scale
+            mz = scipy.optimize.minimize(objective, p, method=cls._phasing_methods[method], jac=jac)
+            return float(mz.x[0]), float(mz.x[1])
+
+    @classmethod
+    def _phased_data_sum(cls, p, data, ramp):
+            """
+            Total absolute real area of data phased by p = [p0, p1] (in
+            degrees), and its gradient with respect to p0 and p1. ramp is the
+            normalised position (index/size) of each point, precomputed so
+            that only the phase factors are evaluated on each call.
+            """
+            angle = (p[0]+p[1]*ramp)*numpy.pi/180.0
+            phased_data = numpy.exp(1.0j*angle)*data
+            # d(real)/d(angle) = -imag
+            grad = -numpy.sign(phased_data.real)*phased_data.imag*numpy.pi/180.0
+            return numpy.abs(phased_data.real).sum(), numpy.array([grad.sum(), grad.dot(ramp)])
+
+    @classmethod
+    def _ps(cls, data, p0=0.0, p1=0.0, out=None):
+            """
+            Linear phase correction along the last axis of data, which may be
+            a single FID or a 2D block of FIDs.
+            
+            :keyword p0: Zero order phase in degrees.
+    
+            :keyword p1: First order phase in degrees.
+
+            :keyword out: array in which to store the result, pass data to phase in place
+
+            """
+            if not all(isinstance(i, (float, int)) for i in [p0, p1]):
+                raise TypeError('p0 and p1 must be floats or ints.')
+            if not data.dtype in cls._complex_dtypes:
+                raise TypeError('data must be complex.')
+            # convert to radians
+            p0 = p0*numpy.pi/180.0
+            p1 = p1*numpy.pi/180.0
+            size = data.shape[-1]
+            ph = numpy.exp(1.0j*(p0+(p1*numpy.arange(size)/size)))
+            return numpy.multiply(ph, data, out=out)
+
+    @classmethod
+    def _f_gauss(cls, offset, amplitude, gauss_sigma, x):
+        return amplitude*numpy.exp(-((offset-x)**2.0)/(2.0*gauss_sigma**2.0))
+    
+    @classmethod
+    def _f_lorentz(cls, offset, amplitude, lorentz_hwhm, x):
+        #return amplitude*lorentz_hwhm**2.0/(lorentz_hwhm**2.0+4.0*(offset-x)**2.0)
+        return amplitude*lorentz_hwhm**2.0/(lorentz_hwhm**2.0+(x-offset)**2.0)
+
+    @classmethod
+    def _f_gauss_int(cls, amplitude, gauss_sigma):
+        return amplitude*numpy.sqrt(2.0*numpy.pi*gauss_sigma**2.0)
+
+    @classmethod
+    def _f_lorentz_int(cls, amplitude, lorentz_hwhm):
+        #empirical integral commented out
+        #x = numpy.arange(1000*lorentz_hwhm)
+        #return numpy.sum(amplitude*lorentz_hwhm**2.0/(lorentz_hwhm**2.0+(x-len(x)/2)**2.0))
+        #this integral forumula from http://magicplot.com/wiki/fit_equations
+        return amplitude*lorentz_hwhm*numpy.pi
+
+    @classmethod
+    def _f_pks_int(cls, parameterset_list):
+        """
+        Integrals of the peaks of an (n_peaks, 5) array of parameter sets,
+        the Gaussian and Lorentzian integrals weighted by frac_gauss.
+        """
+        offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss = numpy.asarray(parameterset_list, dtype='f8').reshape(-1, 5).transpose()
+        return frac_gauss*cls._f_gauss_int(amplitude, gauss_sigma) + (1-frac_gauss)*cls._f_lorentz_int(amplitude, lorentz_hwhm)
+
+    @classmethod
+    def _f_pk(cls, x, offset=0.0, gauss_sigma=1.0, lorentz_hwhm=1.0, amplitude=1.0, frac_gauss=0.0):
+        """
+
+        Return the a combined Gaussian/Lorentzian peakshape for deconvolution
+        of :attr:`~nmrpy.data_objects.Fid.data`.
+        
+        :arg x: array of equal length to :attr:`~nmrpy.data_objects.Fid.data`
+        
+
+        :keyword offset: spectral offset in x
+
+        :keyword gauss_sigma: 2*sigma**2 specifying the width of the Gaussian peakshape
+
+        :keyword lorentz_hwhm: Lorentzian half width at half maximum height
+
+        :keyword amplitude: amplitude of peak
+
+        :keyword frac_gauss: fraction of function to be Gaussian (0 -> 1). Note:
+            specifying a Gaussian fraction of 0 will produce a pure Lorentzian and vice
+            versa.  """
+        
+        #validation
+        parameters = [offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss]
+        if not all(isinstance(i, numbers.Number) for i in parameters):
+            raise TypeError('Keyword parameters must be numbers.') 
+        if not cls._is_iter(x):
+            raise TypeError('x must be an iterable') 
+        if not isinstance(x, numpy.ndarray):
+            x = numpy.array(x) 
+        return cls._f_pk_nocheck(x, offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss)
+
+    @classmethod
+    def _f_pk_nocheck(cls, x, offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss):
+        """
+        Unvalidated version of :meth:`~nmrpy.data_objects.cls._f_pk` for use
+        inside fitting loops. x must be an ndarray.
+        """
+        if frac_gauss > 1.0:
+            frac_gauss = 1.0
+        if frac_gauss < 0.0:
+            frac_gauss = 0.0
+        
+        gauss_peak = cls._f_gauss(offset, amplitude, gauss_sigma, x)
+        lorentz_peak = cls._f_lorentz(offset, amplitude, lorentz_hwhm, x)
+        peak = frac_gauss*gauss_peak + (1-frac_gauss)*lorentz_peak
+        
+        return peak
+
+    @classmethod
+    def _f_pks_array(cls, parameterset_list, x, out=None, work=None):
+        """
+        Evaluate all peaks in parameterset_list at x as a single broadcast
+        operation, returning a (n_peaks, len(x)) array with one peakshape per
+        row (see :meth:`~nmrpy.data_objects.Fid._f_pk`). Unvalidated, for use
+        inside fitting loops; x must be an ndarray.
+
+        :arg parameterset_list: an (n_peaks, 5) array or list of parameter sets [offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss]; further columns are ignored
+
+        :keyword out: preallocated (n_peaks, len(x)) float array for the result
+
+        :keyword work: preallocated (n_peaks, len(x)) float array used as scratch space
+        """
+        shape = (len(parameterset_list), len(x))
+        if out is None:
+            out = numpy.empty(shape)
+        if shape[0] == 0:
+            return out
+        if work is None:
+            work = numpy.empty(shape)
+        parameters = numpy.asarray(parameterset_list, dtype='f8')[:, :5]
+        offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss = parameters.transpose()[:, :, numpy.newaxis]
+        frac_gauss = numpy.clip(frac_gauss, 0.0, 1.0)
+
+        numpy.subtract(x, offset, out=work)
+        numpy.square(work, out=work)
+        # Gaussian fraction
+        numpy.divide(work, -2.0*gauss_sigma**2.0, out=out)
+        numpy.exp(out, out=out)
+        out *= frac_gauss
+        # Lorentzian fraction
+        work += lorentz_hwhm**2.0
+        numpy.divide((1-frac_gauss)*lorentz_hwhm**2.0, work, out=work)
+        out += work
+        out *= amplitude
+        return out
+
+    @classmethod
+    def _f_pks_grad(cls, parameterset_list, x):
+        """
+        Return the partial derivatives of the peakshapes of
+        :meth:`~nmrpy.data_objects.Fid._f_pks_array` with respect to offset,
+        gauss_sigma, lorentz_hwhm, amplitude and frac_gauss of each peak, as
+        the rows of a (5*n_peaks, len(x)) array ordered by peak and then by
+        parameter. x must be an ndarray.
+        """
+        parameters = numpy.asarray(parameterset_list, dtype='f8').reshape(-1, 5)
+        offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss = parameters.transpose()[:, :, numpy.newaxis]
+        frac_gauss = numpy.clip(frac_gauss, 0.0, 1.0)
+
+        dx = x-offset
+        gauss = numpy.exp(-dx**2.0/(2.0*gauss_sigma**2.0))
+        denominator = lorentz_hwhm**2.0+dx**2.0
+        lorentz = lorentz_hwhm**2.0/denominator
+
+        grad = numpy.empty((len(parameters), 5, len(x)))
+        grad[:, 0] = amplitude*dx*(frac_gauss*gauss/gauss_sigma**2.0 + (1-frac_gauss)*2.0*lorentz/denominator)
+        grad[:, 1] = amplitude*frac_gauss*gauss*dx**2.0/gauss_sigma**3.0
+        grad[:, 2] = amplitude*(1-frac_gauss)*2.0*lorentz_hwhm*dx**2.0/denominator**2.0
+        grad[:, 3] = frac_gauss*gauss + (1-frac_gauss)*lorentz
+        grad[:, 4] = amplitude*(gauss-lorentz)
+        return grad.reshape(-1, len(x))
+
+    @classmethod
+    def _f_windows(cls, parameterset_list, x, window):
+        """
+        Return the start and stop indices in x (which must be ascending) of
+        the points within window linewidths of the offset of each peak in
+        parameterset_list, where the linewidth is the larger of the Gaussian
+        sigma and Lorentzian hwhm of the fractions present.
+        """
+        parameters = numpy.asarray(parameterset_list, dtype='f8').reshape(-1, 5)
+        frac_gauss = numpy.clip(parameters[:, 4], 0.0, 1.0)
+        width = numpy.maximum(numpy.where(frac_gauss > 0.0, abs(parameters[:, 1]), 0.0),
+                              numpy.where(frac_gauss < 1.0, abs(parameters[:, 2]), 0.0))
+        half = window*width+1.0
+        half[numpy.isnan(half)] = numpy.inf
+        start = numpy.searchsorted(x, parameters[:, 0]-half)
+        stop = numpy.searchsorted(x, parameters[:, 0]+half, side='right')
+        return start, stop
+
+    @classmethod
+    def _f_pks_windowed(cls, parameterset_list, x, window, out=None):
+        """
+        Sum of the peakshapes of :meth:`~nmrpy.data_objects.Fid._f_pks_array`
+        at x, with each peak only evaluated within window linewidths of its
+        offset (see :meth:`~nmrpy.data_objects.Fid._f_windows`) and taken as
+        zero elsewhere. For many narrow peaks in a wide range this costs
+        O(len(x) + n_peaks*window) rather than O(len(x)*n_peaks). x must be
+        an ascending ndarray.
+
+        :keyword out: preallocated float array of len(x) for the result
+        """
+        parameters = numpy.asarray(parameterset_list, dtype='f8').reshape(-1, 5)
+        if out is None:
+            out = numpy.empty(len(x))
+        out[:] = 0.0
+        for peak, start, stop in zip(parameters, *cls._f_windows(parameters, x, window)):
+            if stop > start:
+                out[start:stop] += cls._f_pks_array(peak[numpy.newaxis], x[start:stop])[0]
+        return out
+
+    @classmethod
+    def _f_pks_grad_windowed(cls, parameterset_list, x, window):
+        """
+        Windowed version of :meth:`~nmrpy.data_objects.Fid._f_pks_grad` (see
+        :meth:`~nmrpy.data_objects.Fid._f_pks_windowed`), returned as a
+        (5*n_peaks, len(x)) scipy.sparse.csr_matrix that only holds the
+        points within the window of each peak.
+        """
+        parameters = numpy.asarray(parameterset_list, dtype='f8').reshape(-1, 5)
+        start, stop = cls._f_windows(parameters, x, window)
+        size = numpy.maximum(stop-start, 0)
+        grads = [cls._f_pks_grad(peak, x[i:i+n]) for peak, i, n in zip(parameters, start, size)]
+        indices = [numpy.arange(i, i+n) for i, n in zip(start, size) for _ in range(5)]
+        indptr = numpy.concatenate([[0], numpy.cumsum(numpy.repeat(size, 5))])
+        if not len(grads):
+            return scipy.sparse.csr_matrix((0, len(x)))
+        return scipy.sparse.csr_matrix((numpy.concatenate([g.ravel() for g in grads]),
+                                        numpy.concatenate(indices), indptr),
+                                       shape=(5*len(parameters), len(x)))
+
+    @classmethod
+    def _f_makep(cls, data, peaks, frac_gauss=None):
+        """
+        Make a set of initial peak parameters for deconvolution.
+        
+
+        :arg data: data to be fitted
+
+        :arg peaks: selected peak positions (see peakpicker())
+       
+        :returns: an array of peaks, each consisting of the following parameters:
+
+                    spectral offset (x)
+
+                    gauss: 2*sigma**2
+
+                    lorentz: scale (HWHM)
+
+                    amplitude: amplitude of peak
+
+                    frac_gauss: fraction of function to be Gaussian (0 -> 1)
+        """
+        if not cls._is_flat_iter(data):
+            raise TypeError('data must be a flat iterable') 
+        if not cls._is_flat_iter(peaks):
+            raise TypeError('peaks must be a flat iterable') 
+        if not isinstance(data, numpy.ndarray):
+            data = numpy.array(data) 
+        
+        p = []
+        for i in peaks:
+            pamp = 0.9*abs(data[int(i)])
+            single_peak = [i, 10, 0.1, pamp, frac_gauss]
+            p.append(single_peak)
+        return numpy.array(p)
+
+    @classmethod
+    def _f_initp(cls, data, init, frac_gauss=None):
+        """
+        Make a set of initial peak parameters for deconvolution from existing
+        parameter sets init (see :meth:`~nmrpy.data_objects.Fid._f_makep`),
+        clipped to the bounds used by :meth:`~nmrpy.data_objects.Fid._f_fitp`.
+        Widths that are not finite and positive, or exceed the length of data
+        (as happens to the Gaussian width of a purely Lorentzian fit), are
+        reset to the initial guesses of
+        :meth:`~nmrpy.data_objects.Fid._f_makep`. The Gaussian fraction is
+        set to frac_gauss; if that is None, the fraction restarts from 0.5 and
+        the widths from their initial guesses, as a fraction stuck at 0 or 1
+        leaves the other width undetermined.
+        """
+        p = numpy.array(init, dtype='f8')[:, :5]
+        p[:, 0] = numpy.clip(numpy.nan_to_num(p[:, 0]), 0.0, len(data)-1)
+        for column, width in [(1, 10.0), (2, 0.1)]:
+            invalid = ~numpy.isfinite(p[:, column]) | (p[:, column] <= 0.0) | (p[:, column] > len(data)) | (frac_gauss is None)
+            p[invalid, column] = width
+        amplitude = 0.9*abs(data[p[:, 0].astype(int)])
+        p[:, 3] = numpy.where(numpy.isfinite(p[:, 3]), p[:, 3], amplitude)
+        p[:, 3] = numpy.clip(p[:, 3], 0.0, max(2.0*data.max(), 0.0))
+        if frac_gauss is None:
+            p[:, 4] = 0.5
+        else:
+            p[:, 4] = frac_gauss
+        return p
+
+    @classmethod
+    def _f_conv(cls, parameterset_list, data):
+        """
+        Returns the maximum of a convolution of an initial set of lineshapes and the data to be fitted.
+        
+        parameterset_list -- a list of parameter lists: n*[[spectral offset (x), 
+                                        gauss: 2*sigma**2, 
+                                        lorentz: scale (HWHM), 
+                                        amplitude: amplitude of peak, 
+                                        frac_gauss: fraction of function to be Gaussian (0 -> 1)]]
+                            where n is the number of peaks
+        data -- 1D spectral array
+
+        The convolution of the data with the reversed lineshapes (i.e. their
+        cross-correlation) is computed with FFTs. As these carry rounding
+        errors, the lags whose correlation is within rounding error of the
+        maximum are recomputed exactly, so that the result is the same as with
+        a direct convolution. The auto-convolution of the lineshapes always
+        peaks at zero lag, so the offset is the lag of the maximum
+        cross-correlation.
+        """
+
+        if not cls._is_flat_iter(data):
+            raise TypeError('data must be a flat iterable') 
+        if not cls._is_iter(parameterset_list):
+            raise TypeError('parameterset_list must be an iterable') 
+        if not isinstance(data, numpy.ndarray):
+            data = numpy.array(data) 
+        
+        data = numpy.where(data == 0.0, 1e-6, data)
+        n = len(data)
+        x = numpy.arange(n, dtype='f8')
+        peaks_init = cls._f_pks(parameterset_list, x)
+        if not peaks_init.any():
+            return 0
+        size = scipy.fft.next_fast_len(2*n-1, real=True)
+        correlation = scipy.fft.irfft(scipy.fft.rfft(data, size)*numpy.conj(scipy.fft.rfft(peaks_init, size)), size)
+        # reorder the circular correlation to lags -(n-1)...(n-1)
+        correlation = numpy.concatenate([correlation[size-n+1:], correlation[:n]])
+        tolerance = 1e-9*numpy.linalg.norm(data)*numpy.linalg.norm(peaks_init)
+        lags = numpy.flatnonzero(correlation >= correlation.max()-tolerance)-(n-1)
+        exact = [numpy.dot(data[max(lag, 0):n+min(lag, 0)], peaks_init[max(-lag, 0):n-max(lag, 0)])
+                for lag in lags]
+        return int(lags[numpy.argmax(exact)])
+
+    @classmethod 
+    def _f_pks_list(cls, parameterset_list, x):
+        """
+        Return a list of peak evaluations for deconvolution. See _f_pk().
+        
+        Keyword arguments:
+        parameterset_list -- a list of parameter lists: [spectral offset (x), 
+                                        gauss: 2*sigma**2, 
+                                        lorentz: scale (HWHM), 
+                                        amplitude: amplitude of peak, 
+                                        frac_gauss: fraction of function to be Gaussian (0 -> 1)]
+        x -- array of equal length to FID
+        """
+        x = cls._check_parameterset_list(parameterset_list, x)
+        return cls._f_pks_list_nocheck(parameterset_list, x)
+
+    @classmethod
+    def _f_pks_list_nocheck(cls, parameterset_list, x):
+        """
+        Unvalidated version of :meth:`~nmrpy.data_objects.cls._f_pks_list`.
+        """
+        return cls._f_pks_array(parameterset_list, x)
+
+    @classmethod
+    def _check_parameterset_list(cls, parameterset_list, x):
+        """
+        Validate a list of peak parameter sets and x, returning x as an ndarray.
+        """
+        if not cls._is_iter_of_iters(parameterset_list):
+            raise TypeError('Parameter set must be an iterable of iterables') 
+        if not cls._is_numeric_array(parameterset_list):
+            for p in parameterset_list:
+                if not cls._is_iter(p):
+                    raise TypeError('Parameter set must be an iterable') 
+                if not cls._is_number_iter(p):
+                    raise TypeError('Keyword parameters must be numbers.') 
+        if not cls._is_iter(x):
+            raise TypeError('x must be an iterable') 
+        if not isinstance(x, numpy.ndarray):
+            x = numpy.array(x) 
+        return x
+        
+
+    @classmethod 
+    def _f_pks(cls, parameterset_list, x):
+        """
+        Return the sum of a series of peak evaluations for deconvolution. See _f_pk().
+        
+        Keyword arguments:
+        parameterset_list -- a list of parameter lists: [spectral offset (x), 
+                                        gauss: 2*sigma**2, 
+                                        lorentz: scale (HWHM), 
+                                        amplitude: amplitude of peak, 
+                                        frac_gauss: fraction of function to be Gaussian (0 -> 1)]
+        x -- array of equal length to FID
+        """
+        x = cls._check_parameterset_list(parameterset_list, x)
+        return cls._f_pks_nocheck(parameterset_list, x)
+
+    @classmethod
+    def _f_pks_nocheck(cls, parameterset_list, x):
+        """
+        Unvalidated version of :meth:`~nmrpy.data_objects.cls._f_pks` for use
+        inside fitting loops. x must be an ndarray.
+        """
+        return cls._f_pks_array(parameterset_list, x).sum(0)
+
+    @classmethod
+    def _f_res(cls, p, data, buffers=None, window=None):
+        """
+        Objective function for deconvolution. Returns residuals of the devonvolution fit.
+        
+        x -- array of equal length to FID
+        
+        Keyword arguments:
+        p -- lmfit parameters object:
+                            offset_n -- spectral offset in x
+                            sigma_n -- gaussian 2*sigma**2
+                            hwhm_n -- lorentzian half width at half maximum height
+                            amplitude_n -- amplitude of peak
+                            frac_gauss_n -- fraction of function to be Gaussian (0 -> 1)
+            where n is the peak number (zero-indexed)
+        data -- spectrum array
+        buffers -- optional (x, out, work) arrays from _f_buffers(), reused on every call
+        window -- only evaluate each peak within this many linewidths of its offset (see _f_pks_windowed())
+        
+        This is called on every iteration of the fit, so data is not
+        validated here but once in :meth:`~nmrpy.data_objects.cls._f_fitp`.
+        """
+        params = cls._parameters_to_list(p)
+        if buffers is None:
+            buffers = cls._f_buffers(len(params), len(data))
+        x, out, work = buffers
+        if window is not None:
+            return data-cls._f_pks_windowed(params, x, window, out=out[0])
+        res = data-cls._f_pks_array(params, x, out=out, work=work).sum(0)
+        return res
+
+    @classmethod
+    def _f_buffers(cls, n_peaks, n_points):
+        """
+        Allocate the x axis and the (n_peaks, n_points) result and scratch
+        arrays of :meth:`~nmrpy.data_objects.Fid._f_pks_array` once per fit.
+        """
+        x = numpy.arange(n_points, dtype='f8')
+        return x, numpy.empty((n_peaks, n_points)), numpy.empty((n_peaks, n_points))
+
+    @classmethod
+    def _f_jac(cls, p, data, buffers=None, window=None):
+        """
+        Jacobian of :meth:`~nmrpy.data_objects.Fid._f_res`, with one row per
+        data point and one column per varying parameter in p (in the order of
+        p). Passed to lmfit by :meth:`~nmrpy.data_objects.Fid._f_fitp` so
+        that the derivatives need not be estimated by finite differences.
+        With window, the derivatives are only evaluated within the window of
+        each peak (see :meth:`~nmrpy.data_objects.Fid._f_pks_grad_windowed`).
+        """
+        params = cls._parameters_to_list(p)
+        if buffers is None:
+            x = numpy.arange(len(data), dtype='f8')
+        else:
+            x = buffers[0]
+        vary = [p['%s_%s'%(par, i)].vary for i in range(len(params))
+                for par in ['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss']]
+        if window is not None:
+            grad = cls._f_pks_grad_windowed(params, x, window)
+            return -grad[numpy.flatnonzero(vary)].transpose().toarray()
+        grad = cls._f_pks_grad(params, x)
+        return -grad[vary].transpose()
+
+    @classmethod
+    def _f_fitp(cls, data, peaks, frac_gauss=None, method='leastsq', jacobian=True, init=None, window=None):
+        """Fit a section of spectral data with a combination of Gaussian/Lorentzian peaks for deconvolution.
+        
+        Keyword arguments:
+        peaks -- selected peak positions (see peakpicker())
+        frac_gauss -- fraction of fitted function to be Gaussian (1 - Guassian, 0 - Lorentzian)
+        jacobian -- use the analytic Jacobian (see _f_jac()) with the leastsq and least_squares methods; False falls back to finite differences
+        init -- optional parameter sets, one per peak and in the order of peaks, to start the fit from instead of the initial guesses of _f_makep() and _f_conv(), e.g. the fit of a similar spectrum
+        window -- only evaluate each peak within this many linewidths of its offset (see _f_pks_windowed()), None evaluates all peaks over all of data
+   
+        returns:
+            fits -- list of fitted peak parameter sets
+            
+        Note: peaks are fitted by default using the Levenberg-Marquardt algorithm[1]. Other fitting algorithms are available (http://cars9.uchicago.edu/software/python/lmfit/fitting.html#choosing-different-fitting-methods).
+        
+        [1] Marquardt, Donald W. 'An algorithm for least-squares estimation of nonlinear parameters.' Journal of the Society for Industrial & Applied Mathematics 11.2 (1963): 431-441.
+        """
+        data = numpy.real(data)
+        if not cls._is_flat_iter(data):
+            raise TypeError('data must be a flat iterable') 
+        if not cls._is_flat_iter(peaks):
+            raise TypeError('peaks must be a flat iterable') 
+        if any(peak > (len(data)-1)  for peak in peaks):
+            raise ValueError('peaks must be within the length of data.')
+        if window is not None and not window > 0:
+            raise ValueError('window must be a positive number of linewidths.')
+        if not isinstance(data, numpy.ndarray):
+            data = numpy.array(data) 
+        if init is not None and len(init) == len(peaks):
+            p = cls._f_initp(data, init, frac_gauss=frac_gauss)
+        else:
+            p = cls._f_makep(data, peaks, frac_gauss=0.5)
+            init_ref = cls._f_conv(p, data)
+            if any(peaks+init_ref < 0) or any(peaks+init_ref > len(data)-1):
+                init_ref = 0 
+            if frac_gauss==None:
+                p = cls._f_makep(data, peaks+init_ref, frac_gauss=0.5)
+            else:
+                p = cls._f_makep(data, peaks+init_ref, frac_gauss=frac_gauss)
+        
+        params = lmfit.Parameters()
+        for parset in range(len(p)):
+            current_parset = dict(zip(['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss'], p[parset]))
+            for k,v in current_parset.items():
+                par_name = '%s_%i'%(k, parset)
+                params.add(name=par_name, 
+                        value=v, 
+                        vary=True, 
+                        min=0.0)
+                if 'offset' in par_name:
+                    params[par_name].max = len(data)-1
+                if 'frac_gauss' in par_name:
+                    params[par_name].max = 1.0
+                    if frac_gauss is not None:
+                        params[par_name].vary = False
+                #if 'sigma' in par_name or 'hwhm' in par_name:
+                #    params[par_name].max = 0.01*current_parset['amplitude'] 
+                if 'amplitude' in par_name:
+                    params[par_name].max = 2.0*data.max()
+                    
+        fit_kws = {}
+        if jacobian and method in cls._jacobian_methods:
+            fit_kws['Dfun'] = cls._f_jac
+        try:
+            buffers = cls._f_buffers(len(p), len(data))
+            mz = lmfit.minimize(cls._f_res, params, args=(data, buffers, window), method=method, **fit_kws)
+            fits = cls._parameters_to_list(mz.params)
+        except:
+            fits = None
+        return fits
+
+    @classmethod
+    def _parameters_to_list(cls, p):
+        n_pks = int(len(p)/5)
+        params = []
+        for i in range(n_pks):
+            current_params = [p['%s_%s'%(par, i)].value for par in ['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss']]
+            params.append(current_params)
+        return params
+
+
+    @classmethod
+    def _deconv_series(cls, list_parameters):
+        """
+        Class method for deconvolution of a series of spectra using
+        multiprocessing. With warm_start, the fit of each spectrum is started
+        from the fitted peaks of the previous one (see
+        :meth:`~nmrpy.data_objects.Fid._f_fitp`), which takes fewer
+        iterations and keeps the peak assignments consistent along a
+        time-course.
+        list_parameters is a tuple of (<list of data>, <list of peaks>,
+        <list of ranges>, <frac_gauss>, <method>, <jacobian>, <warm_start>,
+        <window>),
+        with one entry per spectrum in each list. Returns a list of fitted
+        peak parameter arrays, one row per peak.
+        """
+        data, peaks, ranges, frac_gauss, method, jacobian, warm_start, window = list_parameters
+        fits = []
+        init = None
+        for datum, peaklist, index_ranges in zip(data, peaks, ranges):
+            fit = cls._deconv_datum([datum, peaklist, index_ranges, frac_gauss, method, jacobian, init, window])
+            fit = numpy.array([j for i in fit for j in i])
+            if warm_start and len(fit):
+                init = fit
+            fits.append(fit)
+        return fits
+
+    @classmethod
+    def _deconv_shared(cls, list_parameters):
+        """
+        Class method for deconvolution of a series of rows of a shared data
+        block using multiprocessing (see
+        :meth:`~nmrpy.data_objects.Fid._deconv_series`). The fitted peak
+        parameters of each row are written into the shared output block from
+        its start row onwards, one row per peak.
+        list_parameters is a tuple of (<shared data>, <row indices>, <list of peaks>,
+        <list of ranges>, <frac_gauss>, <method>, <jacobian>, <warm_start>,
+        <window>, <shared output>, <start rows>), where the shared blocks are
+        :class:`~nmrpy.parallel.SharedArray` objects.
+        """
+        shared_data, indices, peaks, ranges, frac_gauss, method, jacobian, warm_start, window, shared_peaks, starts = list_parameters
+        data = [shared_data.array[index] for index in indices]
+        fits = cls._deconv_series([data, peaks, ranges, frac_gauss, method, jacobian, warm_start, window])
+        for fit, start in zip(fits, starts):
+            if len(fit):
+                shared_peaks.array[start:start+len(fit)] = fit
+
+    @classmethod
+    def _deconv_datum(cls, list_parameters):
+        if len(list_parameters) not in [5, 6, 7, 8]:
+            raise ValueError('list_parameters must consist of five to eight objects.')
+        if (type(list_parameters[1]) == list and len(list_parameters[1]) == 0) or \
+           (type(list_parameters[2]) == list and len(list_parameters[2]) == 0):
+            return []
+
+        datum, peaks, ranges, frac_gauss, method = list_parameters[:5]
+        jacobian = list_parameters[5] if len(list_parameters) > 5 else True
+        init = list_parameters[6] if len(list_parameters) > 6 else None
+        window = list_parameters[7] if len(list_parameters) > 7 else None
+        if init is not None and len(init) != sum(len(i) for i in peaks):
+            init = None
+
+        if not cls._is_iter_of_iters(ranges):
+            raise TypeError('ranges must be an iterable of iterables') 
+        if not all(len(rng) == 2 for rng in ranges):
+            raise ValueError('ranges must contain two values.')
+        if not all(rng[0] != rng[1] for rng in ranges):
+            raise ValueError('data_index must contain different values.')
+        if not isinstance(datum, numpy.ndarray):
+            datum = numpy.array(datum) 
+        if datum.dtype in cls._complex_dtypes:
+            raise TypeError('data must be not be complex.')
+
+        fit = []
+        n = 0
+        for j in zip(peaks, ranges):
+            d_slice = datum[j[1][0]:j[1][1]]
+            p_slice = j[0]-j[1][0]
+            init_slice = None
+            if init is not None and len(j[0]):
+                init_slice = numpy.array(init[n:n+len(j[0])], dtype='f8')
+                init_slice[:, 0] -= j[1][0]
+            n += len(j[0])
+            f = cls._f_fitp(d_slice, p_slice, frac_gauss=frac_gauss, method=method, jacobian=jacobian, init=init_slice, window=window)
+            f = numpy.array(f).transpose()
+            f[0] += j[1][0]
+            f = f.transpose()
+            fit.append(f)
+        return fit
+
+    @classmethod
+    def _f_joint_index(cls, n_fids, n_peaks, frac_gauss=None, shared_offsets=False):
+        """
+        Map the peak parameters of a joint fit of n_fids spectra (see
+        :meth:`~nmrpy.data_objects.Fid._f_fit_joint`) onto a parameter vector.
+        Returns an (n_fids, n_peaks, 5) integer array holding the position of
+        each [offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss] in the
+        vector, or -1 for parameters that are held fixed, and the number of
+        parameters. The shared parameters come first, followed by those of
+        each spectrum in turn.
+        """
+        shared = [(1, frac_gauss != 0.0), (2, frac_gauss != 1.0), (4, frac_gauss is None)]
+        if shared_offsets:
+            shared.insert(0, (0, True))
+            per_fid = [3]
+        else:
+            per_fid = [0, 3]
+        index = -numpy.ones((n_fids, n_peaks, 5), dtype=int)
+        n = 0
+        for column, vary in shared:
+            if vary:
+                index[:, :, column] = numpy.arange(n, n+n_peaks)
+                n += n_peaks
+        own = numpy.arange(n_fids*n_peaks*len(per_fid)).reshape(n_fids, n_peaks, len(per_fid))
+        index[:, :, per_fid] = n+own
+        return index, n+own.size
+
+    @classmethod
+    def _f_fit_joint(cls, data, peaks, frac_gauss=None, shared_offsets=False, window=None):
+        """
+        Fit a section of the spectral data of a series of spectra with one
+        combination of Gaussian/Lorentzian peaks for deconvolution, as a
+        single least-squares problem. The widths and Gaussian fractions of
+        the peaks (and, with shared_offsets, their positions) are shared by
+        all spectra; only the amplitudes (and positions) are fitted to each
+        spectrum. The Jacobian is block-sparse, as each spectrum only depends
+        on the shared parameters and its own, so that the cost of the fit
+        grows linearly with the number of spectra.
+
+        :arg data: 2D array with one spectrum per row
+
+        :arg peaks: selected peak positions (see peakpicker())
+
+        :keyword frac_gauss: fraction of fitted function to be Gaussian (1 - Guassian, 0 - Lorentzian), None to fit
+
+        :keyword shared_offsets: share the peak positions between all spectra
+
+        :keyword window: only evaluate each peak within this many linewidths of its offset (see :meth:`~nmrpy.data_objects.Fid._f_pks_windowed`), which makes the Jacobian sparser still
+
+        :returns: an (n_spectra, n_peaks, 5) array of fitted peak parameter sets
+        """
+        data = numpy.asarray(data, dtype='f8')
+        peaks = numpy.asarray(peaks)
+        if data.ndim != 2:
+            raise TypeError('data must be a 2D array.')
+        if not cls._is_flat_iter(peaks):
+            raise TypeError('peaks must be a flat iterable')
+        if any(peaks < 0) or any(peaks > data.shape[1]-1):
+            raise ValueError('peaks must be within the length of data.')
+        n_fids, n_points = data.shape
+        n_peaks = len(peaks)
+        x = numpy.arange(n_points, dtype='f8')
+
+        # start from a fit of the mean spectrum, with the amplitudes of each
+        # spectrum fitted linearly to its peakshapes
+        mean = data.mean(0)
+        mean_fit = cls._f_fitp(mean, peaks, frac_gauss=frac_gauss, window=window)
+        if mean_fit is None:
+            mean_fit = cls._f_makep(mean, peaks, frac_gauss=0.5)
+        if frac_gauss is None:
+            # keep the fitted fractions, but away from 0 and 1 where one of
+            # the widths has no effect
+            fractions = numpy.clip(numpy.array(mean_fit)[:, 4], 0.05, 0.95)
+            mean_fit = cls._f_initp(mean, mean_fit, frac_gauss=0.5)
+            mean_fit[:, 4] = fractions
+        else:
+            mean_fit = cls._f_initp(mean, mean_fit, frac_gauss=frac_gauss)
+        unit = mean_fit.copy()
+        unit[:, 3] = 1.0
+        amplitudes = numpy.linalg.lstsq(cls._f_pks_array(unit, x).transpose(), data.transpose(), rcond=None)[0]
+        amplitude_max = max(2.0*data.max(), 1e-12)
+        p = numpy.repeat(mean_fit[numpy.newaxis], n_fids, axis=0)
+        p[:, :, 3] = numpy.clip(amplitudes.transpose(), 1e-3*amplitude_max, amplitude_max)
+
+        index, n_parameters = cls._f_joint_index(n_fids, n_peaks, frac_gauss=frac_gauss, shared_offsets=shared_offsets)
+        vary = index >= 0
+        x0 = numpy.empty(n_parameters)
+        x0[index[vary]] = p[vary]
+        lower = numpy.zeros(n_parameters)
+        upper = numpy.full(n_parameters, numpy.inf)
+        bounds = {0: n_points-1, 3: amplitude_max, 4: 1.0}
+        for column, bound in bounds.items():
+            upper[index[:, :, column][index[:, :, column] >= 0]] = bound
+        x0 = numpy.clip(x0, lower, upper)
+
+        rows = (numpy.arange(n_fids)[:, numpy.newaxis, numpy.newaxis]*n_points
+                +numpy.arange(n_points)[numpy.newaxis, numpy.newaxis]).repeat(vary[0].sum(), axis=1)
+        columns = numpy.repeat(index[vary].reshape(n_fids, -1, 1), n_points, axis=2)
+
+        def parameters(z):
+            q = p.copy()
+            q[vary] = z[index[vary]]
+            return q.reshape(-1, 5)
+
+        def residuals(z):
+            if window is not None:
+                model = numpy.array([cls._f_pks_windowed(q, x, window) for q in parameters(z).reshape(n_fids, n_peaks, 5)])
+            else:
+                model = cls._f_pks_array(parameters(z), x).reshape(n_fids, n_peaks, n_points).sum(1)
+            return (data-model).ravel()
+
+        def jacobian(z):
+            if window is not None:
+                grad = cls._f_pks_grad_windowed(parameters(z), x, window)[numpy.flatnonzero(vary.ravel())].tocoo()
+                return scipy.sparse.csr_matrix((-grad.data, (grad.row//vary[0].sum()*n_points+grad.col, index[vary][grad.row])),
+                                               shape=(n_fids*n_points, n_parameters))
+            grad = cls._f_pks_grad(parameters(z), x).reshape(n_fids, 5*n_peaks, n_points)
+            grad = grad[:, vary[0].ravel()]
+            return scipy.sparse.csr_matrix((-grad.ravel(), (rows.ravel(), columns.ravel())),
+                                           shape=(n_fids*n_points, n_parameters))
+
+        result = scipy.optimize.least_squares(residuals, x0, jac=jacobian, bounds=(lower, upper),
+                                              method='trf', tr_solver='lsmr')
+        return parameters(result.x).reshape(n_fids, n_peaks, 5)
+
+    @classmethod
+    def _deconv_joint(cls, list_parameters):
+        """
+        Class method for the joint deconvolution of one range of a series of
+        spectra using multiprocessing (see
+        :meth:`~nmrpy.data_objects.Fid._f_fit_joint`). list_parameters is a
+        tuple of (<2D data of the range>, <peaks>, <start>, <frac_gauss>,
+        <shared_offsets>, <window>), where peaks are indices of the full spectra and
+        start is the index at which the range begins. Returns an
+        (n_spectra, n_peaks, 5) array of fitted peak parameter sets.
+        """
+        data, peaks, start, frac_gauss, shared_offsets, window = list_parameters
+        fit = cls._f_fit_joint(data, numpy.asarray(peaks)-start, frac_gauss=frac_gauss,
+                               shared_offsets=shared_offsets, window=window)
+        fit[:, :, 0] += start
+        return fit
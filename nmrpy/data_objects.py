@@ -1,208 +1,17 @@
 import numpy
 import scipy
 from matplotlib import pyplot
-import lmfit
 import nmrglue
-import numbers
 from scipy.optimize import leastsq
-from multiprocessing import Pool, cpu_count
+from nmrpy.core import *
+from nmrpy.parallel import WorkerPool, get_worker_pool
+from nmrpy import storage
 from nmrpy.plotting import *
 import os
+import hashlib
 import pickle
 
-class Base():
-    _complex_dtypes = [
-                    numpy.dtype('csingle'),
-                    numpy.dtype('cdouble'),
-                    numpy.dtype('clongdouble'),
-                    ]
-
-    _file_formats = ['varian', 'bruker', None]
-
-    def __init__(self, *args, **kwargs):
-        self.id = kwargs.get('id', None)
-        self._procpar = kwargs.get('procpar', None)
-        self._params = None
-        self.fid_path = kwargs.get('fid_path', '.')
-        self._file_format = None
-
-    @property
-    def id(self):
-        return self.__id
-
-    @id.setter
-    def id(self, id):
-        if isinstance(id, str) or id is None:
-            self.__id = id
-        else:
-            raise AttributeError('ID must be a string or None.')
-        
-    @property
-    def fid_path(self):
-        return self.__fid_path
-
-    @fid_path.setter
-    def fid_path(self, fid_path):
-        if isinstance(fid_path, str):
-            self.__fid_path = fid_path
-        else:
-            raise AttributeError('fid_path must be a string.')
-
-    @property
-    def _file_format(self):
-        return self.__file_format
-
-    @_file_format.setter
-    def _file_format(self, file_format):
-        if file_format in self._file_formats:
-            self.__file_format = file_format
-        else:
-            raise AttributeError('_file_format must be "varian", "bruker", or None.')
-
-    @classmethod
-    def _is_iter(cls, i):
-        try:
-            iter(i)
-            return True
-        except TypeError:
-            return False
-
-    @classmethod
-    def _is_iter_of_iters(cls, i):
-        if type(i) == list and len(i) == 0:
-            return False
-        elif cls._is_iter(i) and all(cls._is_iter(j) for j in i):
-            return True
-        return False
-
-    @classmethod
-    def _is_flat_iter(cls, i):
-        if type(i) == list and len(i) == 0:
-            return True
-        elif cls._is_iter(i) and not any(cls._is_iter(j) for j in i):
-            return True
-        return False
-
-    @property
-    def _procpar(self):
-        return self.__procpar
-
-    @_procpar.setter
-    def _procpar(self, procpar):
-        if procpar is None:
-            self.__procpar = procpar 
-        elif isinstance(procpar, dict):
-            self.__procpar = procpar 
-            self._params = self._extract_procpar(procpar)
-        else:
-            raise AttributeError('procpar must be a dictionary or None.')
-
-    @property
-    def _params(self):
-        return self.__params
-
-    @_params.setter
-    def _params(self, params):
-        if isinstance(params, dict) or params is None:
-            self.__params = params
-        else:
-            raise AttributeError('params must be a dictionary or None.')
-
-    #processing
-    def _extract_procpar(self, procpar):
-        if self._file_format == 'bruker':
-            return self._extract_procpar_bruker(procpar)
-        elif self._file_format == 'varian':
-            return self._extract_procpar_varian(procpar)
-        #else:
-        #    raise AttributeError('Could not parse procpar.') 
-
-    @staticmethod
-    def _extract_procpar_varian(procpar):
-        """
-        Extract some commonely-used NMR parameters (using Varian denotations)
-        and return a parameter dictionary 'params'.
-        """
-        at = float(procpar['procpar']['at']['values'][0])
-        d1 = float(procpar['procpar']['d1']['values'][0])
-        sfrq = float(procpar['procpar']['sfrq']['values'][0])
-        reffrq = float(procpar['procpar']['reffrq']['values'][0])
-        rfp = float(procpar['procpar']['rfp']['values'][0])
-        rfl = float(procpar['procpar']['rfl']['values'][0])
-        tof = float(procpar['procpar']['tof']['values'][0])
-        rt = at+d1
-        nt = numpy.array(
-            [procpar['procpar']['nt']['values']], dtype=int).flatten()
-        acqtime = numpy.zeros(nt.shape)
-        acqtime[0] = (rt * nt[0] / 2)
-        for i in range(1, len(nt)):
-            acqtime[i] = acqtime[i - 1] + (nt[i - 1] + nt[i]) / 2 * rt
-        acqtime /= 60.   # convert to min
-        sw_hz = float(procpar['procpar']['sw']['values'][0])
-        sw = round(sw_hz/reffrq, 2)
-        sw_left = (0.5+1e6*(sfrq-reffrq)/sw_hz)*sw_hz/sfrq
-        params = dict(
-            at=at,
-            d1=d1,
-            rt=rt,
-            nt=nt,
-            acqtime=acqtime,
-            sw=sw,
-            sw_hz=sw_hz,
-            sfrq=sfrq,
-            reffrq=reffrq,
-            rfp=rfp,
-            rfl=rfl,
-            tof=tof,
-            sw_left=sw_left,
-            )
-        return params
-
-    @staticmethod
-    def _extract_procpar_bruker(procpar): 
-        """
-        Extract some commonly-used NMR parameters (using Bruker denotations)
-        and return a parameter dictionary 'params'.
-        """
-        d1 = procpar['acqus']['D'][1]
-        reffrq = procpar['acqus']['SFO1']
-        nt = procpar['acqus']['NS']
-        sw_hz = procpar['acqus']['SW_h']
-        sw = procpar['acqus']['SW']
-        # lefthand offset of the processed data in ppm
-        if 'procs' in procpar:
-            sfrq = procpar['procs']['SF']
-            sw_left = procpar['procs']['OFFSET']
-        else:
-            sfrq = procpar['acqus']['BF1']
-            sw_left = (0.5+1e6*(sfrq-reffrq)/sw_hz)*sw_hz/sfrq
-        at = procpar['acqus']['TD']/(2*sw_hz)
-        rt = at+d1
-        td = procpar['tdelta']
-        cumulative = procpar['tcum']
-        single = procpar['tsingle']
-        tstart = cumulative - 0.5*single    # tstart for acquisition
-        al = procpar['arraylength']
-        a = procpar['arrayset']
-        acqtime = numpy.zeros((al))
-        acqtime[0] = tstart[a-1]
-        for i in range(1, al):
-            acqtime[i] = acqtime[i-1] + td
-        params = dict(
-            at=at,
-            d1=d1,
-            rt=rt,
-            nt=nt,
-            acqtime=acqtime,
-            sw=sw,
-            sw_hz=sw_hz,
-            sfrq=sfrq,
-            reffrq=reffrq,
-            sw_left=sw_left,
-            )
-        return params
-
-class Fid(Base):
+class Fid(FidCore):
     '''
     The basic FID (Free Induction Decay) class contains all the data for a single spectrum (:attr:`~nmrpy.data_objects.Fid.data`), and the
     necessary methods to process these data.
@@ -227,13 +36,24 @@ class Fid(Base):
         """
         The spectral data. This is the primary object upon which the processing and analysis functions work.
         """
+        if isinstance(self.__data, _LazyRow):
+            return self.__data.load()
         return self.__data
     
-    @data.setter    
+    @data.setter
     def data(self, data):
         if Fid._is_valid_dataset(data):
             self.__data = numpy.array(data)
 
+    def _set_data_view(self, data):
+        """
+        Bind :attr:`~nmrpy.data_objects.Fid.data` to an existing array without
+        copying or validating it. This is used by
+        :class:`~nmrpy.data_objects.FidArray` to make each
+        :attr:`~nmrpy.data_objects.Fid.data` a row view of its 2D data block.
+        """
+        self.__data = data
+
     @property
     def _ppm(self):
         """
@@ -256,7 +76,7 @@ class Fid(Base):
         if peaks is not None:
             if not Fid._is_flat_iter(peaks):
                 raise AttributeError('peaks must be a flat iterable')
-            if not all(isinstance(i, numbers.Number) for i in peaks):
+            if not Fid._is_number_iter(peaks):
                 raise AttributeError('peaks must be numbers')
             self._peaks = numpy.array(peaks)
         else:
@@ -279,9 +99,8 @@ class Fid(Base):
         ranges = numpy.array(ranges)
         if ranges.shape[1] != 2:
             raise AttributeError('ranges must be an iterable of 2-length iterables or an empty iterables e.g. [[]]')
-        for r in ranges:
-            if not all(isinstance(i, numbers.Number) for i in r):
-                raise AttributeError('ranges must be numbers')
+        if not Fid._is_number_iter(ranges.flatten()):
+            raise AttributeError('ranges must be numbers')
         self._ranges = ranges
 
     @property
@@ -294,7 +113,7 @@ class Fid(Base):
             if not Fid._is_flat_iter(bl_ppm):
                 raise AttributeError('baseline indices must be a flat iterable')
             if len(bl_ppm) > 0:
-                if not all(isinstance(i, numbers.Number) for i in bl_ppm):
+                if not Fid._is_number_iter(bl_ppm):
                     raise AttributeError('baseline indices must be numbers')
                 self.__bl_ppm = numpy.sort(list(set(bl_ppm)))[::-1]
             else:
@@ -318,7 +137,7 @@ class Fid(Base):
         if bl_poly is not None:
             if not Fid._is_flat_iter(bl_poly):
                 raise AttributeError('baseline polynomial must be a flat iterable')
-            if not all(isinstance(i, numbers.Number) for i in bl_poly):
+            if not Fid._is_number_iter(bl_poly):
                 raise AttributeError('baseline polynomial must be numbers')
             self.__bl_poly = numpy.array(bl_poly)
         else:
@@ -330,7 +149,9 @@ class Fid(Base):
         :attr:`~nmrpy.data_objects.Fid.peaks` converted to indices rather than ppm
         """
         if self.peaks is not None:
-            return self._conv_to_index(self.data, self.peaks, self._params['sw_left'], self._params['sw'])
+            # only the length of the data is needed, which does not require
+            # lazily opened data to be read
+            return self._conv_to_index(self.__data, self.peaks, self._params['sw_left'], self._params['sw'])
         else:
             return [] 
 
@@ -341,7 +162,7 @@ class Fid(Base):
         """
         if self.ranges is not None:
             shp = self.ranges.shape
-            index_ranges = self._conv_to_index(self.data, self.ranges.flatten(), self._params['sw_left'], self._params['sw'])
+            index_ranges = self._conv_to_index(self.__data, self.ranges.flatten(), self._params['sw_left'], self._params['sw'])
             return index_ranges.reshape(shp)
         else:
             return [] 
@@ -393,12 +214,8 @@ class Fid(Base):
         An array of integrals for each deconvoluted peak.
         """
         if self._deconvoluted_peaks is not None:
-            integrals = []
-            for peak in self._deconvoluted_peaks:
-                int_gauss = peak[-1]*Fid._f_gauss_int(peak[3], peak[1])
-                int_lorentz = (1-peak[-1])*Fid._f_lorentz_int(peak[3], peak[2])
-                integrals.append(int_gauss+int_lorentz)
-            return integrals
+            peaks = numpy.asarray(self._deconvoluted_peaks, dtype='f8').reshape(-1, 5)
+            return list(Fid._f_pks_int(peaks))
             
     def _get_plots(self):
         """
@@ -436,19 +253,6 @@ class Fid(Base):
         for w in widgets:
             delattr(self, w)
 
-    @classmethod
-    def _is_valid_dataset(cls, data):
-        if isinstance(data, str):
-            raise TypeError('Data must be iterable not a string.')
-        if not cls._is_iter(data):
-            raise TypeError('Data must be an iterable.')
-        if not cls._is_flat_iter(data):
-            raise TypeError('Data must not be nested.')
-        if not all(isinstance(i, numbers.Number) for i in data):
-            raise TypeError('Data must consist of numbers only.')
-        return True 
-        
-
     @classmethod
     def from_data(cls, data):
         """
@@ -472,7 +276,7 @@ class Fid(Base):
         in an artificially increased resolution once Fourier-transformed.
 
         """
-        self.data = numpy.append(self.data, 0*self.data)
+        self.data = Fid._zf(self.data)
 
     def emhz(self, lb=5.0):
         """
@@ -483,7 +287,7 @@ class Fid(Base):
         :keyword lb: degree of line-broadening in Hz.
 
         """
-        self.data = numpy.exp(-numpy.pi*numpy.arange(len(self.data)) * (lb/self._params['sw_hz'])) * self.data
+        self.data = Fid._emhz(self.data, lb, self._params['sw_hz'])
 
     def real(self):
         """
@@ -509,128 +313,46 @@ class Fid(Base):
             self.data = Fid._ft(list_params)
             self._flags['ft'] = True
 
-    @classmethod
-    def _ft(cls, list_params):
-        """
-        Class method for Fourier-transforming data using multiprocessing.
-        list_params is a tuple of (<data>, <file_format>).
-        """
-        if len(list_params) != 2:
-            raise ValueError('Wrong number of parameters. list_params must contain [<data>, <file_format>]')
-        data, file_format = list_params
-        if Fid._is_valid_dataset(data) and file_format in Fid._file_formats:
-            data = numpy.array(numpy.fft.fft(data), dtype=data.dtype)
-            s = len(data)
-            if file_format == 'varian' or file_format == None:
-                    ft_data = numpy.append(data[int(s / 2.0):], data[: int(s / 2.0)])
-            if file_format == 'bruker':
-                    ft_data = numpy.append(data[int(s / 2.0):: -1], data[s: int(s / 2.0): -1])
-            return ft_data
-
-
-    @staticmethod
-    def _conv_to_ppm(data, index, sw_left, sw):
-            """
-            Convert index array to ppm. 
-            """
-            if isinstance(index, list):
-                    index = numpy.array(index)
-            frc_sw = index/float(len(data))
-            ppm = sw_left-sw*frc_sw
-            if Fid._is_iter(ppm):
-                return numpy.array([round(i, 2) for i in ppm])
-            else:
-                return round(ppm, 2)
-
-    @staticmethod
-    def _conv_to_index(data, ppm, sw_left, sw):
-            """
-            Convert ppm array to index. 
-            """
-            conv_to_int = False
-            if not Fid._is_iter(ppm):
-                ppm = [ppm]
-                conv_to_int = True
-            if isinstance(ppm, list):
-                    ppm = numpy.array(ppm)
-            if any(ppm > sw_left) or any(ppm < sw_left-sw):
-                raise ValueError('ppm must be within spectral width.')
-            indices = len(data)*(sw_left-ppm)/sw
-            if conv_to_int:
-                return int(numpy.ceil(indices))
-            return numpy.array(numpy.ceil(indices), dtype=int)
-    
-    def phase_correct(self, method='leastsq'):
+    def phase_correct(self, method='leastsq', start=None):
             """
 
             Automatically phase-correct :attr:`~nmrpy.data_objects.Fid.data` by minimising
-            total absolute area.
+            total absolute area. The phases are first scanned and fitted on a
+            decimated spectrum and then refined on the full spectrum. The
+            fitted phases are stored in :attr:`~nmrpy.data_objects.Fid.phase_correction`.
 
-            :keyword method: The fitting method to use. Default is 'leastsq', the Levenberg-Marquardt algorithm, which is usually sufficient. Additional options include:
+            :keyword method: The minimisation method to use. Default is 'leastsq', which minimises the total absolute area with L-BFGS-B using its analytic gradient. Additional options include:
                     
                     Nelder-Mead (nelder)
 
                     L-BFGS-B (l-bfgs-b)
 
+                    BFGS (bfgs)
+
                     Conjugate Gradient (cg)
 
                     Powell (powell)
 
                     Newton-CG  (newton)
+
+            :keyword start: (p0, p1) in degrees from which to start the fit on the full spectrum, skipping the coarse stage, e.g. a phase shared by a series of spectra
             """
             if self.data.dtype not in self._complex_dtypes:
                 raise TypeError('Only complex data can be phase-corrected.')
             if not self._flags['ft']:
                 raise ValueError('Only Fourier-transformed data can be phase-corrected.')
             print('phasing: %s'%self.id)
-            self.data = Fid._phase_correct((self.data, method))
-
-    @classmethod
-    def _phase_correct(cls, list_params):
-            """
-            Class method for phase-correction using multiprocessing.
-            list_params is a tuple of (<data>, <fitting method>).
-            """
-            data, method = list_params
-            p = lmfit.Parameters()
-            p.add_many(
-                    ('p0', 1.0, True),
-                    ('p1', 0.0, True),
-                    )
-            mz = lmfit.minimize(Fid._phased_data_sum, p, args=([data]), method=method)
-            phased_data = Fid._ps(data, p0=mz.params['p0'].value, p1=mz.params['p1'].value)
-            if abs(phased_data.min()) > abs(phased_data.max()):
-                    phased_data *= -1
-            if sum(phased_data) < 0.0:
-                    phased_data *= -1
-            print('%d\t%d'%(mz.params['p0'].value, mz.params['p1'].value))
-            return phased_data
-        
-    @classmethod
-    def _phased_data_sum(cls, pars, data):
-            err = Fid._ps(data, p0=pars['p0'].value, p1=pars['p1'].value).real
-            return numpy.array([abs(err).sum()]*2)
+            self.data, p0, p1 = Fid._phase_correct((self.data, method, start))
+            self._phase_correction = (p0, p1)
 
-    @classmethod
-    def _ps(cls, data, p0=0.0, p1=0.0):
-            """
-            Linear phase correction
-            
-            :keyword p0: Zero order phase in degrees.
-    
-            :keyword p1: First order phase in degrees.
-
-            """
-            if not all(isinstance(i, (float, int)) for i in [p0, p1]):
-                raise TypeError('p0 and p1 must be floats or ints.')
-            if not data.dtype in Fid._complex_dtypes:
-                raise TypeError('data must be complex.')
-            # convert to radians
-            p0 = p0*numpy.pi/180.0
-            p1 = p1*numpy.pi/180.0
-            size = len(data)
-            ph = numpy.exp(1.0j*(p0+(p1*numpy.arange(size)/size)))
-            return ph*data
+    @property
+    def phase_correction(self):
+        """
+        The zero- and first-order phases (p0, p1), in degrees, fitted by the
+        last automatic phase-correction (see
+        :meth:`~nmrpy.data_objects.Fid.phase_correct`), or None.
+        """
+        return getattr(self, '_phase_correction', None)
 
     def ps(self, p0=0.0, p1=0.0):
         """
@@ -641,16 +363,7 @@ class Fid(Base):
         :keyword p1: First order phase in degrees
         
         """
-        if not all(isinstance(i, (float, int)) for i in [p0, p1]):
-            raise TypeError('p0 and p1 must be floats or ints.')
-        if not self.data.dtype in self._complex_dtypes:
-            raise TypeError('data must be complex.')
-        # convert to radians
-        p0 = p0*numpy.pi/180.0
-        p1 = p1*numpy.pi/180.0
-        size = len(self.data)
-        ph = numpy.exp(1.0j*(p0+(p1*numpy.arange(size)/size)))
-        self.data = ph*self.data
+        self.data = Fid._ps(self.data, p0=p0, p1=p1)
 
     def phaser(self):
         """
@@ -786,335 +499,7 @@ Ctrl+Alt+Right - assign
                                 label=plot_label,
                                 )
   
-    @classmethod
-    def _f_gauss(cls, offset, amplitude, gauss_sigma, x):
-        return amplitude*numpy.exp(-((offset-x)**2.0)/(2.0*gauss_sigma**2.0))
-    
-    @classmethod
-    def _f_lorentz(cls, offset, amplitude, lorentz_hwhm, x):
-        #return amplitude*lorentz_hwhm**2.0/(lorentz_hwhm**2.0+4.0*(offset-x)**2.0)
-        return amplitude*lorentz_hwhm**2.0/(lorentz_hwhm**2.0+(x-offset)**2.0)
-
-    @classmethod
-    def _f_gauss_int(cls, amplitude, gauss_sigma):
-        return amplitude*numpy.sqrt(2.0*numpy.pi*gauss_sigma**2.0)
-
-    @classmethod
-    def _f_lorentz_int(cls, amplitude, lorentz_hwhm):
-        #empirical integral commented out
-        #x = numpy.arange(1000*lorentz_hwhm)
-        #return numpy.sum(amplitude*lorentz_hwhm**2.0/(lorentz_hwhm**2.0+(x-len(x)/2)**2.0))
-        #this integral forumula from http://magicplot.com/wiki/fit_equations
-        return amplitude*lorentz_hwhm*numpy.pi
-
-    @classmethod
-    def _f_pk(cls, x, offset=0.0, gauss_sigma=1.0, lorentz_hwhm=1.0, amplitude=1.0, frac_gauss=0.0):
-        """
-
-        Return the a combined Gaussian/Lorentzian peakshape for deconvolution
-        of :attr:`~nmrpy.data_objects.Fid.data`.
-        
-        :arg x: array of equal length to :attr:`~nmrpy.data_objects.Fid.data`
-        
-
-        :keyword offset: spectral offset in x
-
-        :keyword gauss_sigma: 2*sigma**2 specifying the width of the Gaussian peakshape
-
-        :keyword lorentz_hwhm: Lorentzian half width at half maximum height
-
-        :keyword amplitude: amplitude of peak
-
-        :keyword frac_gauss: fraction of function to be Gaussian (0 -> 1). Note:
-            specifying a Gaussian fraction of 0 will produce a pure Lorentzian and vice
-            versa.  """
-        
-        #validation
-        parameters = [offset, gauss_sigma, lorentz_hwhm, amplitude, frac_gauss]
-        if not all(isinstance(i, numbers.Number) for i in parameters):
-            raise TypeError('Keyword parameters must be numbers.') 
-        if not cls._is_iter(x):
-            raise TypeError('x must be an iterable') 
-        if not isinstance(x, numpy.ndarray):
-            x = numpy.array(x) 
-        if frac_gauss > 1.0:
-            frac_gauss = 1.0
-        if frac_gauss < 0.0:
-            frac_gauss = 0.0
-        
-        gauss_peak = cls._f_gauss(offset, amplitude, gauss_sigma, x)
-        lorentz_peak = cls._f_lorentz(offset, amplitude, lorentz_hwhm, x)
-        peak = frac_gauss*gauss_peak + (1-frac_gauss)*lorentz_peak
-        
-        return peak
-   
-
-
-    @classmethod
-    def _f_makep(cls, data, peaks, frac_gauss=None):
-        """
-        Make a set of initial peak parameters for deconvolution.
-        
-
-        :arg data: data to be fitted
-
-        :arg peaks: selected peak positions (see peakpicker())
-       
-        :returns: an array of peaks, each consisting of the following parameters:
-
-                    spectral offset (x)
-
-                    gauss: 2*sigma**2
-
-                    lorentz: scale (HWHM)
-
-                    amplitude: amplitude of peak
-
-                    frac_gauss: fraction of function to be Gaussian (0 -> 1)
-        """
-        if not cls._is_flat_iter(data):
-            raise TypeError('data must be a flat iterable') 
-        if not cls._is_flat_iter(peaks):
-            raise TypeError('peaks must be a flat iterable') 
-        if not isinstance(data, numpy.ndarray):
-            data = numpy.array(data) 
-        
-        p = []
-        for i in peaks:
-            pamp = 0.9*abs(data[int(i)])
-            single_peak = [i, 10, 0.1, pamp, frac_gauss]
-            p.append(single_peak)
-        return numpy.array(p)
-
-    @classmethod
-    def _f_conv(cls, parameterset_list, data):
-        """
-        Returns the maximum of a convolution of an initial set of lineshapes and the data to be fitted.
-        
-        parameterset_list -- a list of parameter lists: n*[[spectral offset (x), 
-                                        gauss: 2*sigma**2, 
-                                        lorentz: scale (HWHM), 
-                                        amplitude: amplitude of peak, 
-                                        frac_gauss: fraction of function to be Gaussian (0 -> 1)]]
-                            where n is the number of peaks
-        data -- 1D spectral array
-        
-        """
-
-        if not cls._is_flat_iter(data):
-            raise TypeError('data must be a flat iterable') 
-        if not cls._is_iter(parameterset_list):
-            raise TypeError('parameterset_list must be an iterable') 
-        if not isinstance(data, numpy.ndarray):
-            data = numpy.array(data) 
-        
-        data[data == 0.0] = 1e-6
-        x = numpy.arange(len(data), dtype='f8')
-        peaks_init = cls._f_pks(parameterset_list, x)
-        data_convolution = numpy.convolve(data, peaks_init[::-1])
-        auto_convolution = numpy.convolve(peaks_init, peaks_init[::-1])
-        max_data_convolution = numpy.where(data_convolution == data_convolution.max())[0][0]
-        max_auto_convolution = numpy.where(auto_convolution == auto_convolution.max())[0][0]
-        return max_data_convolution - max_auto_convolution
-
-    @classmethod 
-    def _f_pks_list(cls, parameterset_list, x):
-        """
-        Return a list of peak evaluations for deconvolution. See _f_pk().
-        
-        Keyword arguments:
-        parameterset_list -- a list of parameter lists: [spectral offset (x), 
-                                        gauss: 2*sigma**2, 
-                                        lorentz: scale (HWHM), 
-                                        amplitude: amplitude of peak, 
-                                        frac_gauss: fraction of function to be Gaussian (0 -> 1)]
-        x -- array of equal length to FID
-        """
-        if not cls._is_iter_of_iters(parameterset_list):
-            raise TypeError('Parameter set must be an iterable of iterables') 
-        for p in parameterset_list:
-            if not cls._is_iter(p):
-                raise TypeError('Parameter set must be an iterable') 
-            if not all(isinstance(i, numbers.Number) for i in p):
-                raise TypeError('Keyword parameters must be numbers.') 
-        if not cls._is_iter(x):
-            raise TypeError('x must be an iterable') 
-        if not isinstance(x, numpy.ndarray):
-            x = numpy.array(x) 
-        return numpy.array([Fid._f_pk(x, *peak) for peak in parameterset_list])
-        
-
-    @classmethod 
-    def _f_pks(cls, parameterset_list, x):
-        """
-        Return the sum of a series of peak evaluations for deconvolution. See _f_pk().
-        
-        Keyword arguments:
-        parameterset_list -- a list of parameter lists: [spectral offset (x), 
-                                        gauss: 2*sigma**2, 
-                                        lorentz: scale (HWHM), 
-                                        amplitude: amplitude of peak, 
-                                        frac_gauss: fraction of function to be Gaussian (0 -> 1)]
-        x -- array of equal length to FID
-        """
-        
-        if not cls._is_iter_of_iters(parameterset_list):
-            raise TypeError('Parameter set must be an iterable of iterables') 
-        for p in parameterset_list:
-            if not cls._is_iter(p):
-                raise TypeError('Parameter set must be an iterable') 
-            if not all(isinstance(i, numbers.Number) for i in p):
-                raise TypeError('Keyword parameters must be numbers.') 
-        if not cls._is_iter(x):
-            raise TypeError('x must be an iterable') 
-        if not isinstance(x, numpy.ndarray):
-            x = numpy.array(x) 
-       
-        peaks = x*0.0
-        for p in parameterset_list:
-            peak = cls._f_pk(x, 
-                    offset=p[0], 
-                    gauss_sigma=p[1], 
-                    lorentz_hwhm=p[2], 
-                    amplitude=p[3], 
-                    frac_gauss=p[4],
-                    )
-            peaks += peak
-        return peaks
-
-    @classmethod
-    def _f_res(cls, p, data):
-        """
-        Objective function for deconvolution. Returns residuals of the devonvolution fit.
-        
-        x -- array of equal length to FID
-        
-        Keyword arguments:
-        p -- lmfit parameters object:
-                            offset_n -- spectral offset in x
-                            sigma_n -- gaussian 2*sigma**2
-                            hwhm_n -- lorentzian half width at half maximum height
-                            amplitude_n -- amplitude of peak
-                            frac_gauss_n -- fraction of function to be Gaussian (0 -> 1)
-            where n is the peak number (zero-indexed)
-        data -- spectrum array
-        
-        """
-        if not isinstance(p, lmfit.parameter.Parameters):
-            raise TypeError('Parameters must be of type lmfit.parameter.Parameters.') 
-        if not cls._is_flat_iter(data):
-            raise TypeError('data must be a flat iterable.')
-        if not isinstance(data, numpy.ndarray):
-            data = numpy.array(data) 
-       
-        params = Fid._parameters_to_list(p)
-        x = numpy.arange(len(data), dtype='f8')
-        res = data-cls._f_pks(params, x)
-        return res
-
-    @classmethod
-    def _f_fitp(cls, data, peaks, frac_gauss=None, method='leastsq'):
-        """Fit a section of spectral data with a combination of Gaussian/Lorentzian peaks for deconvolution.
-        
-        Keyword arguments:
-        peaks -- selected peak positions (see peakpicker())
-        frac_gauss -- fraction of fitted function to be Gaussian (1 - Guassian, 0 - Lorentzian)
-   
-        returns:
-            fits -- list of fitted peak parameter sets
-            
-        Note: peaks are fitted by default using the Levenberg-Marquardt algorithm[1]. Other fitting algorithms are available (http://cars9.uchicago.edu/software/python/lmfit/fitting.html#choosing-different-fitting-methods).
-        
-        [1] Marquardt, Donald W. 'An algorithm for least-squares estimation of nonlinear parameters.' Journal of the Society for Industrial & Applied Mathematics 11.2 (1963): 431-441.
-        """
-        data = numpy.real(data)
-        if not cls._is_flat_iter(data):
-            raise TypeError('data must be a flat iterable') 
-        if not cls._is_flat_iter(peaks):
-            raise TypeError('peaks must be a flat iterable') 
-        if any(peak > (len(data)-1)  for peak in peaks):
-            raise ValueError('peaks must be within the length of data.')
-        if not isinstance(data, numpy.ndarray):
-            data = numpy.array(data) 
-        p = cls._f_makep(data, peaks, frac_gauss=0.5)
-        init_ref = cls._f_conv(p, data)
-        if any(peaks+init_ref < 0) or any(peaks+init_ref > len(data)-1):
-            init_ref = 0 
-        if frac_gauss==None:
-            p = cls._f_makep(data, peaks+init_ref, frac_gauss=0.5)
-        else:
-            p = cls._f_makep(data, peaks+init_ref, frac_gauss=frac_gauss)
-        
-        params = lmfit.Parameters()
-        for parset in range(len(p)):
-            current_parset = dict(zip(['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss'], p[parset]))
-            for k,v in current_parset.items():
-                par_name = '%s_%i'%(k, parset)
-                params.add(name=par_name, 
-                        value=v, 
-                        vary=True, 
-                        min=0.0)
-                if 'offset' in par_name:
-                    params[par_name].max = len(data)-1
-                if 'frac_gauss' in par_name:
-                    params[par_name].max = 1.0
-                    if frac_gauss is not None:
-                        params[par_name].vary = False
-                #if 'sigma' in par_name or 'hwhm' in par_name:
-                #    params[par_name].max = 0.01*current_parset['amplitude'] 
-                if 'amplitude' in par_name:
-                    params[par_name].max = 2.0*data.max()
-                    
-        try:
-            mz = lmfit.minimize(cls._f_res, params, args=([data]), method=method)
-            fits = Fid._parameters_to_list(mz.params)
-        except:
-            fits = None
-        return fits
-
-    @classmethod
-    def _parameters_to_list(cls, p):
-        n_pks = int(len(p)/5)
-        params = []
-        for i in range(n_pks):
-            current_params = [p['%s_%s'%(par, i)].value for par in ['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss']]
-            params.append(current_params)
-        return params
-
-
-    @classmethod
-    def _deconv_datum(cls, list_parameters):
-        if len(list_parameters) != 5:
-            raise ValueError('list_parameters must consist of five objects.')
-        if (type(list_parameters[1]) == list and len(list_parameters[1]) == 0) or \
-           (type(list_parameters[2]) == list and len(list_parameters[2]) == 0):
-            return []
-
-        datum, peaks, ranges, frac_gauss, method = list_parameters
-
-        if not cls._is_iter_of_iters(ranges):
-            raise TypeError('ranges must be an iterable of iterables') 
-        if not all(len(rng) == 2 for rng in ranges):
-            raise ValueError('ranges must contain two values.')
-        if not all(rng[0] != rng[1] for rng in ranges):
-            raise ValueError('data_index must contain different values.')
-        if not isinstance(datum, numpy.ndarray):
-            datum = numpy.array(datum) 
-        if datum.dtype in cls._complex_dtypes:
-            raise TypeError('data must be not be complex.')
-
-        fit = []
-        for j in zip(peaks, ranges):
-            d_slice = datum[j[1][0]:j[1][1]]
-            p_slice = j[0]-j[1][0]
-            f = cls._f_fitp(d_slice, p_slice, frac_gauss=frac_gauss, method=method)
-            f = numpy.array(f).transpose()
-            f[0] += j[1][0]
-            f = f.transpose()
-            fit.append(f)
-        return fit
-
-    def deconv(self, method='leastsq', frac_gauss=0.0):
+    def deconv(self, method='leastsq', frac_gauss=0.0, jacobian=True, init=None, window=None):
         """
 
         Deconvolute :attr:`~nmrpy.data_obects.Fid.data` object by fitting a
@@ -1136,9 +521,29 @@ Ctrl+Alt+Right - assign
             Powell (powell)
         
             Newton-CG  (newton)
-        
+
+        :keyword jacobian: pass the analytic derivatives of the peakshapes to the 'leastsq' and 'least_squares' methods instead of estimating them by finite differences. Set to False to fall back to finite differences.
+
+        :keyword init: peak parameters to start the fit from instead of the initial guesses, e.g. the :attr:`~nmrpy.data_objects.Fid._deconvoluted_peaks` of a similar spectrum. Ignored if the number of peaks differs.
+
+        :keyword window: only evaluate each peak within this many linewidths (the larger of its Gaussian sigma and Lorentzian hwhm) of its centre, treating it as zero further out. This makes fits of wide ranges with many narrow peaks much cheaper, but truncates the Lorentzian tails, so choose a window of at least several tens of linewidths. The default of None evaluates every peak over the whole range.
+
         """
 
+        self._check_deconv()
+        print('deconvoluting {}'.format(self.id))
+        list_parameters = [self.data, self._grouped_index_peaklist, self._index_ranges, frac_gauss, method, jacobian, init, window]
+        self._deconvoluted_peaks = numpy.array([j for i in Fid._deconv_datum(list_parameters) for j in i])
+        print('deconvolution completed')
+
+
+    def _check_deconv(self):
+        """
+        Raise an error if :attr:`~nmrpy.data_objects.Fid.data` cannot be
+        deconvoluted, i.e. it is empty or complex, or no
+        :attr:`~nmrpy.data_objects.Fid.peaks` or
+        :attr:`~nmrpy.data_objects.Fid.ranges` have been specified.
+        """
         if not len(self.data):
             raise AttributeError('data does not exist.')
         if self.data.dtype in self._complex_dtypes:
@@ -1147,11 +552,6 @@ Ctrl+Alt+Right - assign
             raise AttributeError('peaks must be picked.')
         if self.ranges is None:
             raise AttributeError('ranges must be specified.')
-        print('deconvoluting {}'.format(self.id))
-        list_parameters = [self.data, self._grouped_index_peaklist, self._index_ranges, frac_gauss, method]
-        self._deconvoluted_peaks = numpy.array([j for i in Fid._deconv_datum(list_parameters) for j in i])
-        print('deconvolution completed')
-
 
     def plot_ppm(self, **kwargs):
         """
@@ -1208,6 +608,11 @@ class FidArray(Base):
     where 'XX' is an increasing integer .
 
     '''
+
+    _deconvoluted_dtype = numpy.dtype([('fid', 'i8'), ('range', 'i8'), ('peak', 'i8'),
+                                       ('offset', 'f8'), ('sigma', 'f8'), ('hwhm', 'f8'),
+                                       ('amplitude', 'f8'), ('frac_gauss', 'f8'), ('integral', 'f8')])
+
     def __str__(self):
         return 'FidArray of {} FID(s)'.format(len(self.data))
 
@@ -1273,9 +678,77 @@ class FidArray(Base):
     def data(self):
         """
         An array of all :attr:`~nmrpy.data_objects.Fid.data` objects belonging to the :class:`~nmrpy.data_objects.Fid` objects owned by this :class:`~nmrpy.data_objects.FidArray`.
+
+        The data are held in a single contiguous 2D block of which each
+        :attr:`~nmrpy.data_objects.Fid.data` is a row view, so reading this
+        property does not copy. The block is only rebuilt once a
+        :class:`~nmrpy.data_objects.Fid` has been added or deleted, or has had
+        its data replaced.
         """
-        data = numpy.array([fid.data for fid in self.get_fids()])
-        return data
+        fids = self.get_fids()
+        if self._data_block_is_current(fids):
+            return self._data_block
+        return self._consolidate_data(fids)
+
+    def _get_data_block(self, fids):
+        """
+        Return the 2D data block of which the data of fids are row views, or
+        None if their data are of unequal length or dtype.
+        """
+        if not self._data_block_is_current(fids):
+            self._consolidate_data(fids)
+        return getattr(self, '_data_block', None)
+
+    def _data_block_is_current(self, fids):
+        """
+        Check whether every :attr:`~nmrpy.data_objects.Fid.data` is still the
+        corresponding row view of the 2D data block.
+        """
+        rows = getattr(self, '_data_rows', None)
+        if rows is None or len(rows) != len(fids):
+            return False
+        return all(fid.data is row for fid, row in zip(fids, rows))
+
+    def _set_data_block(self, block, fids):
+        """
+        Store a 2D data block and bind each :attr:`~nmrpy.data_objects.Fid.data`
+        in fids to the corresponding row view.
+        """
+        rows = list(block)
+        for fid, row in zip(fids, rows):
+            fid._set_data_view(row)
+        self._data_block = block
+        self._data_rows = rows
+
+    def _consolidate_data(self, fids):
+        """
+        Collect the data of fids into a new contiguous 2D block. Data of
+        unequal length or dtype cannot share a block and are returned as a
+        plain array without rebinding :attr:`~nmrpy.data_objects.Fid.data`.
+        """
+        self._data_block = None
+        self._data_rows = None
+        datasets = [fid.data for fid in fids]
+        if len(set(d.shape for d in datasets)) > 1:
+            return numpy.array(datasets, dtype=object)
+        if len(datasets) == 0 or len(set(d.dtype for d in datasets)) > 1:
+            return numpy.array(datasets)
+        block = numpy.array(datasets)
+        self._set_data_block(block, fids)
+        return block
+
+    def __getstate__(self):
+        # the data block is rebuilt from the Fid objects on first access, so
+        # the spectra are not pickled twice; the deconvolution cache is only
+        # kept in memory
+        state = self.__dict__.copy()
+        state.pop('_data_block', None)
+        state.pop('_data_rows', None)
+        state.pop('_deconv_cache', None)
+        state.pop('_deconvoluted_table', None)
+        state.pop('_deconvoluted_sources', None)
+        state.pop('_deconvoluted_integrals', None)
+        return state
 
     @property
     def t(self):
@@ -1294,25 +767,115 @@ class FidArray(Base):
     @property
     def deconvoluted_integrals(self):
         """
-        Collected :class:`~nmrpy.data_objects.Fid.deconvoluted_integrals`
-        """
-        deconvoluted_integrals = []
-        for fid in self.get_fids():
-            deconvoluted_integrals.append(fid.deconvoluted_integrals)
-        return numpy.array(deconvoluted_integrals)
+        Collected :class:`~nmrpy.data_objects.Fid.deconvoluted_integrals` as
+        an (n_fids, n_peaks) array, padded with NaN for FIDs with fewer peaks
+        (or not deconvoluted). The array is computed from
+        :attr:`~nmrpy.data_objects.FidArray.deconvoluted_table` and cached
+        until the deconvoluted peaks or ranges change (see
+        :attr:`~nmrpy.data_objects.FidArray.deconvoluted_table`), so it is
+        read-only; copy it to modify it.
+        """
+        table = self.deconvoluted_table
+        if getattr(self, '_deconvoluted_integrals', None) is None:
+            n_fids = len(self._deconvoluted_sources)
+            counts = numpy.bincount(table['fid'], minlength=n_fids)
+            integrals = numpy.full((n_fids, counts.max() if n_fids else 0), numpy.nan)
+            integrals[table['fid'], table['peak']] = table['integral']
+            integrals.flags.writeable = False
+            self._deconvoluted_integrals = integrals
+        return self._deconvoluted_integrals
 
     @property
     def _deconvoluted_peaks(self):
         """
         Collected :class:`~nmrpy.data_objects.Fid._deconvoluted_peaks`
         """
-        deconvoluted_peaks = []
-        for fid in self.get_fids():
-            try:
-                deconvoluted_peaks.append(fid._deconvoluted_peaks)
-            except:
-                deconvoluted_peaks.append([])
-        return numpy.array(deconvoluted_peaks)
+        fids = self.get_fids()
+        deconvoluted_peaks = numpy.empty(len(fids), dtype=object)
+        for i, fid in enumerate(fids):
+            peaks = getattr(fid, '_deconvoluted_peaks', None)
+            deconvoluted_peaks[i] = [] if peaks is None else peaks
+        return deconvoluted_peaks
+
+    @property
+    def deconvoluted_table(self):
+        """
+        All deconvoluted peaks of this :class:`~nmrpy.data_objects.FidArray`
+        as a structured array with one row per peak and the fields 'fid'
+        (index of the :class:`~nmrpy.data_objects.Fid`), 'range' (index of
+        the range containing the peak, -1 if none), 'peak' (index of the peak
+        in its :class:`~nmrpy.data_objects.Fid`), 'offset', 'sigma', 'hwhm',
+        'amplitude', 'frac_gauss' and 'integral', ordered by FID and peak.
+        Eg. the integrals of the first range are ::
+
+            table = fid_array.deconvoluted_table
+            table['integral'][table['range'] == 0]
+
+        The table is built once and only rebuilt when the deconvoluted peaks
+        of a :class:`~nmrpy.data_objects.Fid` have been replaced or edited in
+        place, or its ranges have been replaced.
+        """
+        fids = self.get_fids()
+        sources = getattr(self, '_deconvoluted_sources', None)
+        if sources is None or len(sources) != len(fids) or \
+                not all(self._is_deconvoluted_source(fid, source) for fid, source in zip(fids, sources)):
+            self._deconvoluted_table = self._build_deconvoluted_table(fids)
+            self._deconvoluted_sources = [self._deconvoluted_source(fid) for fid in fids]
+            self._deconvoluted_integrals = None
+        return self._deconvoluted_table
+
+    @staticmethod
+    def _deconvoluted_source(fid):
+        """
+        The inputs of the rows of fid in the
+        :attr:`~nmrpy.data_objects.FidArray.deconvoluted_table`: its
+        deconvoluted peaks and ranges, and a hash of the peaks, so that edits
+        made in place are noticed as well.
+        """
+        return (fid._deconvoluted_peaks, fid._ranges, FidArray._deconvoluted_digest(fid._deconvoluted_peaks))
+
+    @staticmethod
+    def _is_deconvoluted_source(fid, source):
+        """
+        True if source, as returned by
+        :meth:`~nmrpy.data_objects.FidArray._deconvoluted_source`, holds the
+        current inputs of fid.
+        """
+        return fid._deconvoluted_peaks is source[0] and fid._ranges is source[1] and \
+                FidArray._deconvoluted_digest(fid._deconvoluted_peaks) == source[2]
+
+    @staticmethod
+    def _deconvoluted_digest(peaks):
+        if peaks is None:
+            return None
+        return hashlib.blake2b(numpy.asarray(peaks, dtype='f8').tobytes(), digest_size=16).digest()
+
+    def _build_deconvoluted_table(self, fids):
+        """
+        Collect the :attr:`~nmrpy.data_objects.Fid._deconvoluted_peaks` of
+        fids into a :attr:`~nmrpy.data_objects.FidArray.deconvoluted_table`.
+        """
+        peaks = [numpy.asarray([] if fid._deconvoluted_peaks is None else fid._deconvoluted_peaks, dtype='f8').reshape(-1, 5) for fid in fids]
+        counts = [len(p) for p in peaks]
+        table = numpy.zeros(sum(counts), dtype=self._deconvoluted_dtype)
+        if not len(table):
+            return table
+        table['fid'] = numpy.repeat(numpy.arange(len(fids)), counts)
+        table['peak'] = numpy.concatenate([numpy.arange(n) for n in counts])
+        peaks = numpy.concatenate(peaks)
+        for column, name in enumerate(['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss']):
+            table[name] = peaks[:, column]
+        table['integral'] = Fid._f_pks_int(peaks)
+        table['range'] = -1
+        for i, fid in enumerate(fids):
+            ranges = numpy.sort(numpy.asarray(fid._index_ranges, dtype='f8').reshape(-1, 2), axis=1)
+            rows = table['fid'] == i
+            if not len(ranges) or not rows.any():
+                continue
+            inside = (table['offset'][rows, numpy.newaxis] >= ranges[:, 0]) & \
+                     (table['offset'][rows, numpy.newaxis] <= ranges[:, 1])
+            table['range'][rows] = numpy.where(inside.any(1), inside.argmax(1), -1)
+        return table
 
     def add_fid(self, fid):
         """
@@ -1373,6 +936,14 @@ class FidArray(Base):
         if not cls._is_iter_of_iters(data):
             raise TypeError('data must be an iterable of iterables.')
         fid_array = cls()
+        try:
+            block = numpy.array(data)
+        except ValueError:
+            block = None
+        if block is not None and block.ndim == 2 and block.dtype.kind in 'iufc':
+            # a numeric 2D array consists of flat datasets of numbers only,
+            # so the rows need no further validation
+            return cls._from_block(block)
         fids = []
         for fid_index, datum in zip(range(len(data)), data):
             fid_id = 'fid%i'%fid_index
@@ -1382,7 +953,20 @@ class FidArray(Base):
         return fid_array
 
     @classmethod
-    def from_path(cls, fid_path='.', file_format=None, arrayset=None):
+    def _from_block(cls, block):
+        """
+        Instantiate a new :class:`~nmrpy.data_objects.FidArray` object from a
+        numeric 2D array without copying it: the data of the
+        :class:`~nmrpy.data_objects.Fid` objects are row views of block.
+        """
+        fid_array = cls()
+        fids = [Fid() for fid_index in range(len(block))]
+        fid_array.add_fids(fids)
+        fid_array._set_data_block(numpy.ascontiguousarray(block), fids)
+        return fid_array
+
+    @classmethod
+    def from_path(cls, fid_path='.', file_format=None, arrayset=None, lazy=False, max_resident=storage.MAX_ROWS, pdata=None):
         """
         Instantiate a new :class:`~nmrpy.data_objects.FidArray` object from a .fid directory.
 
@@ -1392,27 +976,41 @@ class FidArray(Base):
         
         :keyword arrayset: (int) array set for interleaved spectra, 
                                  user is prompted if not specified 
+                                 (:meth:`~nmrpy.data_objects.BrukerImporter.get_arraysets`
+                                 lists them without prompting)
+
+        :keyword lazy: for projects saved with compression, only read the metadata (peaks, ranges, deconvoluted peaks, parameters) on opening, and decompress each :attr:`~nmrpy.data_objects.Fid.data` when it is accessed; uncompressed projects are always memory-mapped, and projects pickled by earlier versions of NMRPy are read whole
+
+        :keyword max_resident: with lazy, the number of spectra kept decompressed in memory; the least recently used are released (and decompressed again on their next access)
+
+        :keyword pdata: (int) for Bruker data, import the spectra processed by TopSpin in pdata/<pdata> (the 1r and 1i files) rather than the FIDs; the :class:`~nmrpy.data_objects.Fid` objects are flagged as Fourier-transformed
         """
         if not file_format:
+            if storage.is_project_file(fid_path):
+                return cls._from_project_file(fid_path, lazy=lazy, max_resident=max_resident)
             try:
                 with open(fid_path, 'rb') as f:
                     return pickle.load(f)
             except:
                 print('Not NMRPy data file.')
                 importer = Importer(fid_path=fid_path)
-                importer.import_fid(arrayset=arrayset)
+                importer.import_fid(arrayset=arrayset, pdata=pdata)
         elif file_format == 'varian':
             importer = VarianImporter(fid_path=fid_path)
             importer.import_fid()
         elif file_format == 'bruker':
             importer = BrukerImporter(fid_path=fid_path)
-            importer.import_fid(arrayset=arrayset)
+            importer.import_fid(arrayset=arrayset, pdata=pdata)
         elif file_format == 'nmrpy':
+            if storage.is_project_file(fid_path):
+                return cls._from_project_file(fid_path, lazy=lazy, max_resident=max_resident)
             with open(fid_path, 'rb') as f:
                 return pickle.load(f)
        
         if cls._is_iter(importer.data):
-            fid_array = cls.from_data(importer.data)
+            # the imported data are not referenced elsewhere, so they can
+            # become the data block without being copied
+            fid_array = cls._from_block(importer.data)
             fid_array._file_format = importer._file_format
             fid_array.fid_path = fid_path
             fid_array._procpar = importer._procpar
@@ -1420,6 +1018,7 @@ class FidArray(Base):
                 fid._file_format = fid_array._file_format
                 fid.fid_path = fid_array.fid_path
                 fid._procpar = fid_array._procpar
+                fid._flags['ft'] = importer._processed
             return fid_array 
         else:
             raise IOError('Data could not be imported.')
@@ -1428,8 +1027,13 @@ class FidArray(Base):
         """ 
         Zero-fill all :class:`~nmrpy.data_objects.Fid` objects owned by this :class:`~nmrpy.data_objects.FidArray`
         """
-        for fid in self.get_fids():
-            fid.zf()
+        fids = self.get_fids()
+        block = self._get_data_block(fids)
+        if block is None:
+            for fid in fids:
+                fid.zf()
+            return
+        self._set_data_block(Fid._zf(block), fids)
 
     def emhz_fids(self, lb=5.0):
         """ 
@@ -1437,26 +1041,63 @@ class FidArray(Base):
 
         :keyword lb: degree of line-broadening in Hz.
         """
-        for fid in self.get_fids():
-            fid.emhz(lb=lb)
+        fids = self.get_fids()
+        block = self._get_data_block(fids)
+        if block is None:
+            for fid in fids:
+                fid.emhz(lb=lb)
+            return
+        sw_hz = numpy.array([fid._params['sw_hz'] for fid in fids])
+        if numpy.all(sw_hz == sw_hz[0]):
+            sw_hz = sw_hz[0]
+        else:
+            sw_hz = sw_hz[:, numpy.newaxis]
+        self._apply_to_data_block(Fid._emhz, block, fids, lb, sw_hz)
+
+    def _apply_to_data_block(self, kernel, block, fids, *args, **kwargs):
+        """
+        Apply kernel to the 2D data block, in place if its dtype can hold the
+        result, and rebind the data of fids to a new block otherwise.
+        """
+        if block.dtype.kind in 'fc':
+            kernel(block, *args, out=block, **kwargs)
+        else:
+            self._set_data_block(kernel(block, *args, **kwargs), fids)
 
     def ft_fids(self, mp=True, cpus=None):
         """ 
         Fourier-transform all FIDs.
 
+        If all FIDs share a length and file format, the whole
+        :attr:`~nmrpy.data_objects.FidArray.data` block is transformed in a
+        single batched FFT, using multiple threads if 'mp' is set to True.
+        Otherwise each FID is transformed separately.
+
         :keyword mp: parallelise over multiple processors, significantly reducing computation time
 
         :keyword cpus: defines number of CPUs to utilise if 'mp' is set to True
         """
-        if mp:
-            fids = self.get_fids()
+        fids = self.get_fids()
+        if any(fid._flags['ft'] for fid in fids):
+            raise ValueError('Data have already been Fourier Transformed.')
+        block = self._get_data_block(fids)
+        file_formats = set(fid._file_format for fid in fids)
+        if block is not None and len(file_formats) == 1:
+            workers = 1
+            if mp:
+                workers = -1 if cpus is None else cpus
+            ft_data = Fid._ft_block(block, file_formats.pop(), workers=workers)
+            self._set_data_block(ft_data, fids)
+            for fid in fids:
+                fid._flags['ft'] = True
+        elif mp:
             list_params = [[fid.data, fid._file_format] for fid in fids]
-            ft_data = self._generic_mp(Fid._ft, list_params, cpus)
+            ft_data = self._generic_mp(FidCore._ft, list_params, cpus)
             for fid, datum in zip(fids, ft_data):
                 fid.data = datum
                 fid._flags['ft'] = True
         else: 
-            for fid in self.get_fids():
+            for fid in fids:
                 fid.ft()
         print('Fourier-transformation completed')
 
@@ -1465,19 +1106,29 @@ class FidArray(Base):
         Discard imaginary component of FID data sets.
 
         """
-        for fid in self.get_fids():
-            fid.real()
+        fids = self.get_fids()
+        block = self._get_data_block(fids)
+        if block is None:
+            for fid in fids:
+                fid.real()
+            return
+        self._set_data_block(numpy.ascontiguousarray(block.real), fids)
 
     def norm_fids(self):
         """ 
         Normalise FIDs by maximum data value in :attr:`~nmrpy.data_objects.FidArray.data`.
 
         """
-        dmax = self.data.max()
-        for fid in self.get_fids():
-            fid.data = fid.data/dmax
+        fids = self.get_fids()
+        block = self._get_data_block(fids)
+        if block is None:
+            dmax = max(fid.data.max() for fid in fids)
+            for fid in fids:
+                fid.data = fid.data/dmax
+            return
+        self._apply_to_data_block(numpy.divide, block, fids, block.max())
 
-    def phase_correct_fids(self, method='leastsq', mp=True, cpus=None):
+    def phase_correct_fids(self, method='leastsq', mp=True, cpus=None, shared=False, reference=None, refine=False):
         """ 
         Apply automatic phase-correction to all :class:`~nmrpy.data_objects.Fid` objects owned by this :class:`~nmrpy.data_objects.FidArray`
 
@@ -1486,22 +1137,85 @@ class FidArray(Base):
         :keyword mp: parallelise the phasing process over multiple processors, significantly reducing computation time
 
         :keyword cpus: defines number of CPUs to utilise if 'mp' is set to True
+
+        :keyword shared: fit a single phase to a reference spectrum and apply it to all :class:`~nmrpy.data_objects.Fid` objects at once, instead of fitting each one. Spectra of an arrayed experiment, such as a reaction time-course, usually share their phase.
+
+        :keyword reference: if shared, the indices (in :meth:`~nmrpy.data_objects.FidArray.get_fids`) of the spectra summed into the reference spectrum, e.g. a subset with high signal-to-noise ratio; default is all spectra
+
+        :keyword refine: if shared, refine the phase of each :class:`~nmrpy.data_objects.Fid` starting from the shared phase
         """
+        fids = self.get_fids()
+        if not all(fid.data.dtype in self._complex_dtypes for fid in fids):
+            raise TypeError('Only complex data can be phase-corrected.')
+        if not all(fid._flags['ft'] for fid in fids):
+            raise ValueError('Only Fourier-transformed data can be phase-corrected.')
+        start = None
+        if shared:
+            start = self._fit_shared_phase(fids, method, reference)
+            if not refine:
+                block = self._get_data_block(fids)
+                if block is None:
+                    for fid in fids:
+                        fid.data = Fid._ps(fid.data, p0=start[0], p1=start[1])
+                else:
+                    Fid._ps(block, p0=start[0], p1=start[1], out=block)
+                for fid in fids:
+                    fid._phase_correction = start
+                print('phase-correction completed')
+                return
         if mp: 
-            fids = self.get_fids()
-            if not all(fid.data.dtype in self._complex_dtypes for fid in fids):
-                raise TypeError('Only complex data can be phase-corrected.')
-            if not all(fid._flags['ft'] for fid in fids):
-                raise ValueError('Only Fourier-transformed data can be phase-corrected.')
-            list_params = [[fid.data, method] for fid in fids]
-            phased_data = self._generic_mp(Fid._phase_correct, list_params, cpus)
-            for fid, datum in zip(fids, phased_data):
-                fid.data = datum
+            block = self._get_data_block(fids)
+            if block is None:
+                list_params = [[fid.data, method, start] for fid in fids]
+                phased_data = self._generic_mp(FidCore._phase_correct, list_params, cpus)
+                for fid, (datum, p0, p1) in zip(fids, phased_data):
+                    fid.data = datum
+                    fid._phase_correction = (p0, p1)
+            else:
+                pool = get_worker_pool(cpus)
+                with pool.share(block) as shared_data:
+                    list_params = [[shared_data, index, method, start] for index in range(len(fids))]
+                    phases = pool.map(FidCore._phase_correct_shared, list_params)
+                    if shared_data.array is not block:
+                        block[...] = shared_data.array
+                for fid, phase in zip(fids, phases):
+                    fid._phase_correction = phase
         else:
-            for fid in self.get_fids():
-                fid.phase_correct(method=method)
+            for fid in fids:
+                fid.phase_correct(method=method, start=start)
         print('phase-correction completed')
 
+    def _fit_shared_phase(self, fids, method, reference=None):
+        """
+        Fit the phase (p0, p1) of the sum of the spectra of fids selected by
+        the indices in reference (default all), see
+        :meth:`~nmrpy.data_objects.FidArray.phase_correct_fids`.
+        """
+        if reference is None:
+            reference = range(len(fids))
+        if len(reference) == 0:
+            raise ValueError('reference must contain at least one index.')
+        block = self._get_data_block(fids)
+        if block is None:
+            if len(set(len(fid.data) for fid in fids)) > 1:
+                raise ValueError('A shared phase requires spectra of equal length.')
+            reference_data = numpy.sum([fids[i].data for i in reference], axis=0)
+        else:
+            reference_data = block[list(reference)].sum(0)
+        phased_data, p0, p1 = Fid._phase_correct((reference_data, method))
+        return p0, p1
+
+    @property
+    def phase_corrections(self):
+        """
+        An array of the (p0, p1) phases, in degrees, fitted by the last
+        automatic phase-correction of each :class:`~nmrpy.data_objects.Fid`
+        (see :attr:`~nmrpy.data_objects.Fid.phase_correction`), with NaN for
+        those that have not been phase-corrected.
+        """
+        phases = [fid.phase_correction for fid in self.get_fids()]
+        return numpy.array([phase if phase is not None else (numpy.nan, numpy.nan) for phase in phases])
+
     def baseliner_fids(self):
         """
 
@@ -1579,27 +1293,205 @@ Ctrl+Alt+Right - assign
     def integral_traces(self, integral_traces):
         self._integral_traces = integral_traces 
 
-    def deconv_fids(self, mp=True, cpus=None, method='leastsq', frac_gauss=0.0):
+    def deconv_fids(self, mp=True, cpus=None, method='leastsq', frac_gauss=0.0, jacobian=True, warm_start=False, window=None, cache=True):
         """ 
         Apply deconvolution to all :class:`~nmrpy.data_objects.Fid` objects owned by this :class:`~nmrpy.data_objects.FidArray`, using the :attr:`~nmrpy.data_objects.Fid.peaks` and  :attr:`~nmrpy.data_objects.Fid.ranges` attribute of each respective :class:`~nmrpy.data_objects.Fid`.
 
         :keyword method: see :meth:`~nmrpy.data_objects.Fid.phase_correct`
 
-        :keyword mp: parallelise the phasing process over multiple processors, significantly reduces computation time
+        :keyword mp: parallelise the deconvolution over multiple processors, significantly reduces computation time. Each range of each :class:`~nmrpy.data_objects.Fid` is fitted as a separate task, and the tasks are started in order of decreasing size, so that a crowded range does not hold up the whole run.
 
         :keyword cpus: defines number of CPUs to utilise if 'mp' is set to True, default is n-1 cores
+
+        :keyword jacobian: see :meth:`~nmrpy.data_objects.Fid.deconv`
+
+        :keyword warm_start: start the fit of each :class:`~nmrpy.data_objects.Fid` from the fitted peaks of the previous one rather than from fresh initial guesses. Consecutive spectra of a time-course are usually similar, so this needs fewer iterations and keeps peak assignments consistent. With 'mp', the series is split into one contiguous chunk per worker, each warm-started internally range by range.
+
+        :keyword window: see :meth:`~nmrpy.data_objects.Fid.deconv`
+
+        :keyword cache: reuse the fits of the previous call for every range whose data, peaks and fitting options are unchanged, so that only ranges affected by edits to the peaks or ranges are refitted. Only the fits of the latest call are kept. The cache is not used with 'warm_start', where each fit depends on the one before.
         """
+        fids = self.get_fids()
+        if mp and not all(fid._flags['ft'] for fid in fids):
+            raise ValueError('Only Fourier-transformed data can be deconvoluted.')
+        for fid in fids:
+            fid._check_deconv()
         if mp: 
-            fids = self.get_fids()
-            if not all(fid._flags['ft'] for fid in fids):
-                raise ValueError('Only Fourier-transformed data can be deconvoluted.')
-            list_params = [[fid.data, fid._grouped_index_peaklist, fid._index_ranges, frac_gauss, method] for fid in fids]
-            deconv_datum = self._generic_mp(Fid._deconv_datum, list_params, cpus)
-            for fid, datum in zip(fids, deconv_datum):
-                fid._deconvoluted_peaks = numpy.array([j for i in datum for j in i])
+            pool = get_worker_pool(cpus)
+            if warm_start:
+                chunks = [[int(i) for i in chunk] for chunk in numpy.array_split(range(len(fids)), min(pool.cpus, len(fids))) if len(chunk)]
+            else:
+                chunks = [[index] for index in range(len(fids))]
+            peaklists = [fid._grouped_index_peaklist for fid in fids]
+            ranges = [fid._index_ranges for fid in fids]
+            fits, pending, keys = self._deconv_cached(fids, peaklists, ranges, cache and not warm_start, method, frac_gauss, jacobian, window)
+            tasks = self._deconv_tasks(peaklists, ranges, chunks, pending)
+            block = self._get_data_block(fids)
+            if block is None:
+                list_params = [[[fids[i].data for i, r in task], [[peaklists[i][r]] for i, r in task], [[ranges[i][r]] for i, r in task], frac_gauss, method, jacobian, warm_start, window] for task in tasks]
+                for task, task_fits in zip(tasks, pool.map(FidCore._deconv_series, list_params)):
+                    fits.update(zip(task, task_fits))
+            else:
+                fits.update(self._deconv_shared(block, pool, peaklists, ranges, tasks, method, frac_gauss, jacobian, warm_start, window))
+            self._set_deconv_fits(fids, peaklists, fits, keys)
+        elif warm_start:
+            init = None
+            for fid in fids:
+                fid.deconv(method=method, frac_gauss=frac_gauss, jacobian=jacobian, init=init, window=window)
+                if len(fid._deconvoluted_peaks):
+                    init = fid._deconvoluted_peaks
         else:
-            for fid in self.get_fids():
-                fid.deconv(frac_gauss=frac_gauss)
+            peaklists = [fid._grouped_index_peaklist for fid in fids]
+            ranges = [fid._index_ranges for fid in fids]
+            fits, pending, keys = self._deconv_cached(fids, peaklists, ranges, cache, method, frac_gauss, jacobian, window)
+            for i, fid in enumerate(fids):
+                fid_pending = [r for j, r in pending if j == i]
+                if not fid_pending:
+                    continue
+                print('deconvoluting {}'.format(fid.id))
+                list_parameters = [fid.data, [peaklists[i][r] for r in fid_pending], [ranges[i][r] for r in fid_pending], frac_gauss, method, jacobian, None, window]
+                fits.update(((i, r), fit) for r, fit in zip(fid_pending, FidCore._deconv_datum(list_parameters)))
+            self._set_deconv_fits(fids, peaklists, fits, keys)
+        print('deconvolution completed')
+
+    @staticmethod
+    def _deconv_tasks(peaklists, ranges, chunks, pending):
+        """
+        Split the deconvolution of a series of FIDs, given the grouped index
+        peaklists and index ranges of each, into one task per chunk of FID
+        indices and range, as lists of (FID index, range index) pairs. Only
+        the pairs in pending are included. The tasks are ordered by
+        decreasing estimated cost (number of points times number of peaks),
+        so that the longest fits are started first and do not hold up the
+        end of the run.
+        """
+        pending = set(pending)
+        tasks = []
+        costs = []
+        for chunk in chunks:
+            for r in range(max(len(ranges[i]) for i in chunk)):
+                task = [(i, r) for i in chunk if (i, r) in pending]
+                if task:
+                    tasks.append(task)
+                    costs.append(sum(len(peaklists[i][r])*abs(ranges[i][r][1]-ranges[i][r][0]) for i, r in task))
+        order = numpy.argsort(-numpy.array(costs), kind='stable')
+        return [tasks[i] for i in order]
+
+    @staticmethod
+    def _deconv_key(data, peaks, index_range, *options):
+        """
+        Hash of the data slice, peaks and range of one deconvolution fit, and
+        the fitting options, identifying it in the cache of
+        :meth:`~nmrpy.data_objects.FidArray.deconv_fids`.
+        """
+        key = hashlib.blake2b(digest_size=16)
+        key.update(numpy.ascontiguousarray(data[index_range[0]:index_range[1]]).tobytes())
+        key.update(numpy.asarray(peaks, dtype='f8').tobytes())
+        key.update(repr(([int(i) for i in index_range], data.dtype.str, options)).encode())
+        return key.hexdigest()
+
+    def _deconv_cached(self, fids, peaklists, ranges, cache, *options):
+        """
+        Return a dict of the cached fits of every (FID index, range index)
+        pair of fids whose inputs are unchanged since the last call of
+        :meth:`~nmrpy.data_objects.FidArray.deconv_fids`, a list of the
+        remaining pairs that need fitting (ranges without peaks are left
+        out), and a dict of the cache keys of all pairs, which is None if
+        cache is False.
+        """
+        pairs = [(i, r) for i in range(len(fids)) for r in range(len(ranges[i])) if len(peaklists[i][r])]
+        if not cache:
+            return {}, pairs, None
+        keys = {(i, r): self._deconv_key(fids[i].data, peaklists[i][r], ranges[i][r], *options) for i, r in pairs}
+        cached = getattr(self, '_deconv_cache', {})
+        fits = {pair: cached[key] for pair, key in keys.items() if key in cached}
+        return fits, [pair for pair in pairs if pair not in fits], keys
+
+    def _set_deconv_fits(self, fids, peaklists, fits, keys):
+        """
+        Assemble the fits of each (FID index, range index) pair into the
+        :attr:`~nmrpy.data_objects.Fid._deconvoluted_peaks` of fids, in
+        range order, and, unless keys is None, store them under their keys as
+        the new deconvolution cache.
+        """
+        for i, fid in enumerate(fids):
+            fid_fits = [fits[(i, r)] for r in range(len(peaklists[i])) if (i, r) in fits]
+            fid._deconvoluted_peaks = numpy.concatenate(fid_fits) if fid_fits else numpy.array([])
+        if keys is not None:
+            self._deconv_cache = {keys[pair]: fit for pair, fit in fits.items()}
+
+    def _deconv_shared(self, block, pool, peaklists, ranges, tasks, method, frac_gauss, jacobian, warm_start, window):
+        """
+        Deconvolute the rows of the 2D data block of a series of FIDs in
+        parallel, one task per range of a chunk of rows (see
+        :meth:`~nmrpy.data_objects.FidArray._deconv_tasks`), and return a
+        dict of the fits of each (FID index, range index) pair. The workers
+        read their data from, and write the fitted peak parameters into,
+        shared blocks (see :meth:`~nmrpy.parallel.WorkerPool.share`), so
+        that only indices and peak lists are sent to them.
+        """
+        pairs = [pair for task in tasks for pair in task]
+        n_peaks = [len(peaklists[i][r]) for i, r in pairs]
+        starts = dict(zip(pairs, numpy.cumsum([0]+n_peaks)))
+        with pool.share(block) as shared_data, \
+                pool.share(numpy.zeros((sum(n_peaks), 5))) as shared_peaks:
+            list_params = [[shared_data, [i for i, r in task], [[peaklists[i][r]] for i, r in task], [[ranges[i][r]] for i, r in task], frac_gauss, method, jacobian, warm_start, window, shared_peaks, [starts[pair] for pair in task]] for task in tasks]
+            pool.map(FidCore._deconv_shared, list_params)
+            peaks = numpy.array(shared_peaks.array)
+        return {pair: peaks[starts[pair]:starts[pair]+n] for pair, n in zip(pairs, n_peaks)}
+
+    def deconv_fids_joint(self, mp=True, cpus=None, frac_gauss=0.0, shared_offsets=False, window=None):
+        """
+        Deconvolute all :class:`~nmrpy.data_objects.Fid` objects owned by this
+        :class:`~nmrpy.data_objects.FidArray` in a single fit per range, in
+        which the peak widths and Gaussian fractions are shared by all FIDs
+        and only the amplitudes (and positions) are fitted to each FID. This
+        has far fewer parameters than :meth:`~nmrpy.data_objects.FidArray.deconv_fids`
+        on long time-courses and avoids noisy per-FID linewidths, at the
+        expense of assuming that the peakshapes do not change over the series.
+        All FIDs must have the same :attr:`~nmrpy.data_objects.Fid.peaks` and
+        :attr:`~nmrpy.data_objects.Fid.ranges`, and data of the same length.
+
+        :keyword mp: parallelise the fits of the ranges over multiple processors, significantly reducing computation time
+
+        :keyword cpus: defines number of CPUs to utilise if 'mp' is set to True, default is n-1 cores
+
+        :keyword frac_gauss: (0-1) determines the Gaussian fraction of the peaks, setting this argument to None will allow the shared fraction of each peak to be fitted
+
+        :keyword shared_offsets: also share the peak positions between all FIDs, rather than fitting them to each FID
+
+        :keyword window: see :meth:`~nmrpy.data_objects.Fid.deconv`
+        """
+        fids = self.get_fids()
+        if not all(fid._flags['ft'] for fid in fids):
+            raise ValueError('Only Fourier-transformed data can be deconvoluted.')
+        block = self._get_data_block(fids)
+        if block is None:
+            raise ValueError('All FIDs must have data of the same length.')
+        if block.dtype in self._complex_dtypes:
+            raise TypeError('data must be not be complex.')
+        for fid in fids:
+            if fid.peaks is None or not len(fid.peaks):
+                raise AttributeError('peaks must be picked.')
+            if fid.ranges is None:
+                raise AttributeError('ranges must be specified.')
+        peaklist = fids[0]._grouped_index_peaklist
+        ranges = fids[0]._index_ranges
+        for fid in fids[1:]:
+            if not (numpy.array_equal(fid._index_ranges, ranges) and
+                    len(fid._grouped_index_peaklist) == len(peaklist) and
+                    all(numpy.array_equal(i, j) for i, j in zip(fid._grouped_index_peaklist, peaklist))):
+                raise ValueError('All FIDs must have the same peaks and ranges.')
+        list_params = [[block[:, index_range[0]:index_range[1]], peaks, index_range[0], frac_gauss, shared_offsets, window] for peaks, index_range in zip(peaklist, ranges) if len(peaks)]
+        if mp:
+            fits = self._generic_mp(FidCore._deconv_joint, list_params, cpus)
+        else:
+            fits = [FidCore._deconv_joint(params) for params in list_params]
+        if not fits:
+            raise ValueError('peaks must lie within ranges.')
+        peaks = numpy.concatenate(fits, axis=1)
+        for fid, fid_peaks in zip(fids, peaks):
+            fid._deconvoluted_peaks = fid_peaks
         print('deconvolution completed')
 
     def get_masked_integrals(self):
@@ -1608,13 +1500,13 @@ Ctrl+Alt+Right - assign
         """
         result = []
         try:
-            ints = [list(i) for i in self.deconvoluted_integrals]
-            for i in self._trace_mask:
-                ints_current = numpy.zeros_like(i, dtype='f8')
-                for j in range(len(i)):
-                    if i[j] != -1:
-                        ints_current[j] = ints[j].pop(0)
-                result.append(ints_current)
+            mask = numpy.array(self._trace_mask) != -1
+            table = self.deconvoluted_table
+            counts = numpy.bincount(table['fid'], minlength=mask.shape[1])
+            # the nth trace through a FID takes its nth integral
+            peak = numpy.cumsum(mask, axis=0)-1
+            rows = numpy.where(mask & (peak < counts), numpy.cumsum(counts)-counts+peak, len(table))
+            result = list(numpy.append(table['integral'], 0.0)[rows])
         except AttributeError:
            print('peakpicker_traces() or deconv_fids() probably not yet run.')
         return result
@@ -1628,18 +1520,23 @@ Ctrl+Alt+Right - assign
 
         :keyword p1: First order phase in degrees
         """
-        for fid in self.get_fids():
-            fid.ps(p0=p0, p1=p1)  
+        fids = self.get_fids()
+        block = self._get_data_block(fids)
+        if block is None:
+            for fid in fids:
+                fid.ps(p0=p0, p1=p1)
+            return
+        Fid._ps(block, p0=p0, p1=p1, out=block)
 
     @staticmethod
     def _generic_mp(fcn, iterable, cpus):
-        if cpus is None:
-            cpus = cpu_count()-1
-        proc_pool = Pool(cpus)
-        result = proc_pool.map(fcn, iterable)
-        proc_pool.close()
-        proc_pool.join()
-        return result
+        """
+        Map fcn over iterable using the shared worker pool (see
+        :func:`~nmrpy.parallel.get_worker_pool`). fcn should be defined in
+        :mod:`nmrpy.core` so that worker processes need not import the
+        plotting libraries.
+        """
+        return get_worker_pool(cpus).map(fcn, iterable)
 
 
     def plot_array(self, **kwargs):
@@ -1860,22 +1757,38 @@ Ctrl+Alt+Right - assign
         """
         Returns peakshapes for all FIDs
         """
+        fids = self.get_fids()
+        if not fids:
+            return []
+        x = numpy.arange(len(fids[0].data), dtype='f8')
+        for fid in fids:
+            Fid._check_parameterset_list(fid._deconvoluted_peaks, x)
+        # all peaks of a FID are evaluated at once into buffers shared by all FIDs
+        n_peaks = max(len(fid._deconvoluted_peaks) for fid in fids)
+        out = numpy.empty((n_peaks, len(x)))
+        work = numpy.empty((n_peaks, len(x)))
         peaks = []
-        for fid in self.get_fids():
-            #x = numpy.arange(len(self.get_fids()[0].data))
-            x = numpy.arange(len(self.get_fids()[0].data))
-            peaks.append(Fid._f_pks(fid._deconvoluted_peaks, x))
+        for fid in fids:
+            n = len(fid._deconvoluted_peaks)
+            peaks.append(Fid._f_pks_array(fid._deconvoluted_peaks, x, out=out[:n], work=work[:n]).sum(0))
         return peaks
 
     def _get_all_list_peakshapes(self):
         """
         Returns peakshapes for all FIDs
         """
+        fids = self.get_fids()
+        if not fids:
+            return []
+        x = numpy.arange(len(fids[0].data), dtype='f8')
+        for fid in fids:
+            Fid._check_parameterset_list(fid._deconvoluted_peaks, x)
+        n_peaks = max(len(fid._deconvoluted_peaks) for fid in fids)
+        work = numpy.empty((n_peaks, len(x)))
         peaks = []
-        for fid in self.get_fids():
-            #x = numpy.arange(len(self.get_fids()[0].data))
-            x = numpy.arange(len(self.get_fids()[0].data))
-            peaks.append(Fid._f_pks_list(fid._deconvoluted_peaks, x))
+        for fid in fids:
+            n = len(fid._deconvoluted_peaks)
+            peaks.append(Fid._f_pks_array(fid._deconvoluted_peaks, x, work=work[:n]))
         return peaks
 
     def _get_truncated_peak_shapes_for_plotting(self):
@@ -1911,7 +1824,7 @@ Ctrl+Alt+Right - assign
         """
         if self.data is None:
             raise AttributeError('No FIDs.')
-        if (self.deconvoluted_integrals==None).any():
+        if any(fid._deconvoluted_peaks is None for fid in self.get_fids()):
             raise AttributeError('No integrals.')
         peakshapes = self._get_all_summed_peakshapes()
         #pk_x, pk_y = self._get_truncated_peak_shapes_for_plotting()
@@ -1935,31 +1848,43 @@ Ctrl+Alt+Right - assign
         :class:`~nmrpy.data_objects.Fid` objects calculated from trace dictionary
         :attr:`~nmrpy.data_objects.FidArray.integral_traces`.
         """
-        if self.deconvoluted_integrals is None or \
-                                None in self.deconvoluted_integrals:
+        if any(fid._deconvoluted_peaks is None for fid in self.get_fids()):
             raise AttributeError('No integrals.')
         if not hasattr(self, '_integral_traces'):
             raise AttributeError('No integral traces. First run select_integral_traces().')
         integrals_set = {}
-        decon_set = self.deconvoluted_integrals 
+        table = self.deconvoluted_table
+        counts = numpy.bincount(table['fid'], minlength=len(self.get_fids()))
+        starts = numpy.cumsum(counts)-counts
         for i, tr in self.integral_traces.items():
             tr_keys = numpy.array([fid for fid in tr.keys()])
             tr_vals = numpy.array([val for val in tr.values()])
             tr_sort = numpy.argsort(tr_keys)
             tr_keys = tr_keys[tr_sort]
             tr_vals = tr_vals[tr_sort]
-            integrals = decon_set[tr_keys, tr_vals]
+            integrals = table['integral'][starts[tr_keys]+tr_vals]
             integrals_set[i] = integrals    
         return integrals_set
 
-    def save_to_file(self, filename=None, overwrite=False):
+    def save_to_file(self, filename=None, overwrite=False, compress=False):
         """
         Save :class:`~nmrpy.data_objects.FidArray` object to file, including all objects owned.
 
+        The file is written in a binary project format (see
+        :mod:`~nmrpy.storage`): the spectra are stored as one aligned array
+        and the peaks, ranges, deconvoluted peaks and parameters as small
+        arrays and metadata. When the file is opened with
+        :meth:`~nmrpy.data_objects.FidArray.from_path`, uncompressed spectra
+        are memory-mapped rather than read, so that opening is fast and only
+        the data that are used are loaded. Files saved by earlier versions of
+        NMRPy can still be opened.
+
         :keyword filename: filename to save :class:`~nmrpy.data_objects.FidArray` to
 
         :keyword overwrite: if True, overwrite existing file
 
+        :keyword compress: if True, compress the spectra (in independent chunks); this makes the file smaller, but the spectra must then be decompressed rather than memory-mapped when the file is opened
+
         """
         if filename is None:
             basename = os.path.split(os.path.splitext(self.fid_path)[0])[-1]
@@ -1979,14 +1904,88 @@ Ctrl+Alt+Right - assign
         self._del_widgets()
         for fid in self.get_fids():
             fid._del_widgets()
-        with open(filename, 'wb') as f:
-            pickle.dump(self, f)
+        storage.dump(self._project_tree(), filename, compress=compress)
+
+    def _project_tree(self):
+        """
+        Return the state of this :class:`~nmrpy.data_objects.FidArray` and its
+        :class:`~nmrpy.data_objects.Fid` objects as a tree for
+        :func:`~nmrpy.storage.dump`. The spectra are stored once, as the 2D
+        data block if there is one, and the other attributes as returned by
+        __getstate__; attributes that the container cannot represent are
+        pickled by :func:`~nmrpy.storage.dump`.
+        """
+        fids = self.get_fids()
+        block = self._get_data_block(fids)
+        state = {key: value for key, value in self.__getstate__().items() if not isinstance(value, Fid)}
+        fid_states = []
+        for fid in fids:
+            fid_state = fid.__dict__.copy()
+            fid_state.pop('_Fid__data')
+            fid_states.append(fid_state)
+        return {
+            'fid_array': state,
+            'fid_keys': [key for key in sorted(self.__dict__) if isinstance(self.__dict__[key], Fid)],
+            'fids': fid_states,
+            'data': block if block is not None else [fid.data for fid in fids],
+            }
+
+    @classmethod
+    def _from_project_file(cls, filename, lazy=False, max_resident=storage.MAX_ROWS):
+        """
+        Instantiate a :class:`~nmrpy.data_objects.FidArray` from a project file
+        written by :meth:`~nmrpy.data_objects.FidArray.save_to_file`.
+        """
+        tree = storage.load(filename, lazy=lazy, max_rows=max_resident)
+        fid_array = cls.__new__(cls)
+        fid_array.__dict__.update(tree['fid_array'])
+        for key, fid_state in zip(tree['fid_keys'], tree['fids']):
+            fid = Fid.__new__(Fid)
+            fid.__dict__.update(fid_state)
+            fid_array.__dict__[key] = fid
+        fids = fid_array.get_fids()
+        if isinstance(tree['data'], list):
+            for fid, data in zip(fids, tree['data']):
+                fid._set_data_view(data)
+        elif isinstance(tree['data'], storage.ChunkedArray):
+            for i, fid in enumerate(fids):
+                fid._set_data_view(_LazyRow(tree['data'], i))
+        else:
+            fid_array._set_data_block(tree['data'], fids)
+        return fid_array
+
+class _LazyRow():
+    '''
+    Placeholder for the :attr:`~nmrpy.data_objects.Fid.data` of a lazily
+    opened project: row index of a :class:`~nmrpy.storage.ChunkedArray`,
+    which is read on every access so that the row can be released again.
+    Assigning to :attr:`~nmrpy.data_objects.Fid.data` replaces it, and it is
+    pickled as the row itself.
+    '''
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+
+    def __len__(self):
+        return self.source.shape[1]
+
+    def load(self):
+        return self.source[self.index]
+
+    def __reduce__(self):
+        return numpy.array, (self.load(),)
   
 class Importer(Base):
 
+    # bytes of raw binary data decoded at a time
+    _chunk_size = 4*2**20
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.data = None
+        # True if data are processed spectra rather than FIDs
+        self._processed = False
 
     @property
     def data(self):
@@ -2007,23 +2006,27 @@ class Importer(Base):
             raise TypeError('data must be complex.')
 
 
-    def import_fid(self, arrayset=None):
+    def import_fid(self, arrayset=None, pdata=None):
         """
-        This will first attempt to import Bruker data. Failing that, Varian.
+        This will first attempt to import Bruker data. Failing that, Varian
+        (unless processed Bruker data were requested with pdata).
         """
         try:
             print('Attempting Bruker')
             brukerimporter = BrukerImporter(fid_path=self.fid_path)
-            brukerimporter.import_fid(arrayset=arrayset)
+            brukerimporter.import_fid(arrayset=arrayset, pdata=pdata)
             self.data = brukerimporter.data
             self._procpar = brukerimporter._procpar
             self._file_format = brukerimporter._file_format
+            self._processed = brukerimporter._processed
             return
         except (FileNotFoundError, OSError):
             print('fid_path does not specify a valid .fid directory.')
             return 
         except (TypeError, IndexError):
             print('probably not Bruker data')
+        if pdata is not None:
+            return
         try: 
             print('Attempting Varian')
             varianimporter = VarianImporter(fid_path=self.fid_path)
@@ -2039,54 +2042,107 @@ class VarianImporter(Importer):
 
     def import_fid(self):
         try:
-            procpar, data = nmrglue.varian.read(self.fid_path)
-            self.data = data 
+            procpar, data = self._read_binary(os.path.join(self.fid_path, 'fid'))
+            procpar['procpar'] = nmrglue.varian.read_procpar(os.path.join(self.fid_path, 'procpar'))
+            self.data = data
             self._procpar = procpar
             self._file_format = 'varian'
         except FileNotFoundError:
             print('fid_path does not specify a valid .fid directory.')
         except OSError:
             print('fid_path does not specify a valid .fid directory.')
+
+    @classmethod
+    def _read_binary(cls, filename):
+        """
+        Read a Varian fid file and return its file header as a dict and its
+        data as a 2D complex array with one trace per row, in the order of
+        the file. The file is memory-mapped and decoded a chunk of blocks at
+        a time straight into the preallocated array, so that the raw data are
+        never held in memory as a whole. As with nmrglue, int16 and float32
+        data give complex64, and int32 data complex128.
+        """
+        with open(filename, 'rb') as f:
+            header = nmrglue.varian.fileheader2dic(nmrglue.varian.get_fileheader(f))
+        nblocks, ntraces, points = header['nblocks'], header['ntraces'], header['np']
+        dtype = nmrglue.varian.find_dtype(header)
+        cdtype = numpy.complex128 if dtype.kind == 'i' and dtype.itemsize == 4 else numpy.complex64
+        # each block consists of nbheaders block headers of 28 bytes
+        # followed by ntraces traces of np values
+        raw = numpy.memmap(filename, dtype='u1', mode='r')
+        traces = numpy.ndarray((nblocks, ntraces, points), dtype=dtype, buffer=raw,
+                offset=32+28*header['nbheaders'],
+                strides=(header['bbytes'], points*dtype.itemsize, dtype.itemsize))
+        data = numpy.empty((nblocks, ntraces, points//2), dtype=cdtype)
+        step = max(cls._chunk_size//max(header['bbytes'], 1), 1)
+        for start in range(0, nblocks, step):
+            data.real[start:start+step] = traces[start:start+step, :, 0::2]
+            data.imag[start:start+step] = traces[start:start+step, :, 1::2]
+        return header, data.reshape(nblocks*ntraces, points//2)
         
 class BrukerImporter(Importer):
 
-    def import_fid(self, arrayset=None):
+    def import_fid(self, arrayset=None, threads=8, pdata=None):
+        """
+        Import the numbered experiment directories of a Bruker dataset.
+        Interleaved arraysets are first identified from the acqus headers
+        alone (see :meth:`~nmrpy.data_objects.BrukerImporter.get_arraysets`),
+        and only the FIDs of the selected arrayset are then read. Both are
+        read concurrently by a pool of threads, which hides the latency of
+        (network) file systems. The binary files are memory-mapped, and each
+        FID is decoded, has the digital filter removed and is written into
+        its row of a preallocated 2D block, so that the data are only held in
+        memory once.
+
+        If fid_path is a single pseudo-2D experiment with a ser file, its
+        increments are imported instead (see
+        :meth:`~nmrpy.data_objects.BrukerImporter.import_ser`).
+
+        :keyword arrayset: (int) array set for interleaved spectra,
+                                 user is prompted if not specified
+
+        :keyword threads: maximum number of experiments read at the same time
+
+        :keyword pdata: (int) import the spectra processed by TopSpin in pdata/<pdata> instead of the FIDs (see :meth:`~nmrpy.data_objects.BrukerImporter._read_processed`)
+        """
+        if self._is_pseudo_2d(self.fid_path):
+            if pdata is not None:
+                raise ValueError('Processed pseudo-2D spectra cannot be imported.')
+            self.import_ser()
+            return
         try:
-            dirs = [int(i) for i in os.listdir(self.fid_path) if \
-                    os.path.isdir(self.fid_path+os.path.sep+i)]
-            dirs.sort()
-            dirs = [str(i) for i in dirs]
-            alldata = []
-            for d in dirs:
-                procpar, data = nmrglue.bruker.read(self.fid_path+os.path.sep+d)
-                alldata.append((procpar, data))
-            self.alldata = alldata
-            incr = 1
-            while True:
-                if len(alldata) == 1:
-                    break
-                if alldata[incr][1].shape == alldata[0][1].shape:
-                    break
-                incr += 1
-            if incr > 1:
-                if arrayset == None:
-                    print('Total of '+str(incr)+' alternating FidArrays found.')
-                    arrayset = input('Which one to import? ')
-                    arrayset = int(arrayset)
+            pool = WorkerPool(cpus=threads, backend='thread')
+            try:
+                paths, headers = self._read_headers(pool)
+                incr = self._get_period(headers)
+                if incr > 1:
+                    if arrayset == None:
+                        print('Total of '+str(incr)+' alternating FidArrays found.')
+                        self._print_arraysets(paths, headers, incr)
+                        arrayset = input('Which one to import? ')
+                        arrayset = int(arrayset)
+                    else:
+                        arrayset = arrayset
+                    if arrayset < 1 or arrayset > incr:
+                        raise ValueError('Select a value between 1 and '
+                                          + str(incr) + '.')
                 else:
-                    arrayset = arrayset
-                if arrayset < 1 or arrayset > incr:
-                    raise ValueError('Select a value between 1 and '
-                                      + str(incr) + '.')
-            else:
-                arrayset = 1
-            self.incr = incr
-            procpar = alldata[arrayset-1][0]
-            data = numpy.vstack([d[1] for d in alldata[(arrayset-1)::incr]])
+                    arrayset = 1
+                self.incr = incr
+                self._arrayset_procpars = headers[:incr]
+                paths = paths[(arrayset-1)::incr]
+                headers = headers[(arrayset-1)::incr]
+                procpar = self._read_procpar(paths[0], pdata=pdata)
+                if pdata is None:
+                    data = self._read_fids(pool, paths, headers, procpar)
+                else:
+                    data = self._read_processed(pool, paths, pdata)
+                    self._processed = True
+            finally:
+                pool.terminate()
             self.data = data
             self._procpar = procpar
             self._file_format = 'bruker'
-            self.data = nmrglue.bruker.remove_digital_filter(procpar, self.data)
             self._procpar['tdelta'], self._procpar['tcum'],\
                     self._procpar['tsingle'] = self._get_time_delta()
             self._procpar['arraylength'] = self.data.shape[0]
@@ -2095,13 +2151,280 @@ class BrukerImporter(Importer):
             print('fid_path does not specify a valid .fid directory.')
         except OSError:
             print('fid_path does not specify a valid .fid directory.')
+
+    def _read_fids(self, pool, paths, headers, procpar):
+        """
+        Read the FIDs of the experiment directories paths, with acqus
+        headers, into a 2D block with the threads of pool, removing the
+        digital filter described by procpar.
+        """
+        # the first FID gives the number of FIDs per experiment and their
+        # length once the digital filter has been removed
+        raw = self._map_binary(paths[0], procpar['acqus'])
+        rows = len(raw)
+        width = self._decode(raw[:1], procpar).shape[-1]
+        del raw
+        data = numpy.empty((len(paths)*rows, width), dtype=numpy.complex128)
+        def read(index):
+            raw = self._map_binary(paths[index], headers[index]['acqus'])
+            if raw.shape[0] != rows:
+                raise ValueError('Experiments differ in shape.')
+            self._decode_into(raw, procpar, data[index*rows:(index+1)*rows])
+        for index, result in pool.imap_unordered(read, range(len(paths))):
+            pass
+        return data
+
+    def _read_processed(self, pool, paths, pdata):
+        """
+        Read the spectra processed by TopSpin in pdata/<pdata> of the
+        experiment directories paths into a 2D complex block with the threads
+        of pool. The 1r (real) and 1i (imaginary, zero if absent) files are
+        memory-mapped with the byte order (BYTORDP) and data type (DTYPP,
+        int32 or float64) of their procs file, and scaled by 2**NC_proc.
+        """
+        def map_spectrum(index):
+            path = os.path.join(paths[index], 'pdata', str(pdata))
+            procs = nmrglue.bruker.read_jcamp(os.path.join(path, 'procs'))
+            dtype = numpy.dtype('f8' if procs.get('DTYPP', 0) == 2 else 'i4')
+            dtype = dtype.newbyteorder('>' if procs.get('BYTORDP', 0) == 1 else '<')
+            real = numpy.memmap(os.path.join(path, '1r'), dtype=dtype, mode='r')
+            if os.path.isfile(os.path.join(path, '1i')):
+                imag = numpy.memmap(os.path.join(path, '1i'), dtype=dtype, mode='r')
+            else:
+                imag = None
+            return 2.0**procs.get('NC_proc', 0), real, imag
+        scale, real, imag = map_spectrum(0)
+        data = numpy.zeros((len(paths), len(real)), dtype=numpy.complex128)
+        def read(index):
+            scale, real, imag = map_spectrum(index)
+            if len(real) != data.shape[1]:
+                raise ValueError('Spectra differ in size.')
+            numpy.multiply(real, scale, out=data[index].real)
+            if imag is not None:
+                numpy.multiply(imag, scale, out=data[index].imag)
+        for index, result in pool.imap_unordered(read, range(len(paths))):
+            pass
+        return data
+
+    def import_ser(self):
+        """
+        Import the increments of a pseudo-2D experiment, whose FIDs are
+        stored together in the ser file of fid_path. The ser file is
+        memory-mapped and decoded in one sequential pass into a preallocated
+        (increments x points) block. The acquisition time of each increment
+        is calculated from the scan time (AQ+D1), NS, and the vdlist (delay
+        before each increment) and vclist (loop counter multiplying NS) of
+        the experiment if present; the lists are cycled if they are shorter
+        than the number of increments, as on the spectrometer. Each vd is
+        counted once per increment, not once per scan, so the times of pulse
+        programs that repeat the delay in every scan, e.g. inversion
+        recovery, are underestimated.
+        """
+        try:
+            procpar = self._read_procpar(self.fid_path)
+            raw = self._map_binary(self.fid_path, procpar['acqus'])
+            # the ser file of an experiment in progress may hold fewer
+            # increments than acquired, or padding beyond them
+            raw = raw[:procpar['acqu2s']['TD']]
+            if len(raw) == 0:
+                raise ValueError('ser file contains no increments.')
+            data = numpy.empty((len(raw), self._decode(raw[:1], procpar).shape[-1]), dtype=numpy.complex128)
+            self._decode_into(raw, procpar, data)
+            del raw
+            self.data = data
+            self._procpar = procpar
+            self._file_format = 'bruker'
+            self.incr = 1
+            self._procpar['tdelta'], self._procpar['tcum'], self._procpar['tsingle'], \
+                    self._procpar['acqtime'] = self._get_increment_times(len(data))
+            self._procpar['arraylength'] = self.data.shape[0]
+            self._procpar['arrayset'] = 1
+        except FileNotFoundError:
+            print('fid_path does not specify a valid .fid directory.')
+        except OSError:
+            print('fid_path does not specify a valid .fid directory.')
+
+    @staticmethod
+    def _is_pseudo_2d(path):
+        return os.path.isfile(os.path.join(path, 'ser')) and \
+                os.path.isfile(os.path.join(path, 'acqu2s'))
+
+    def _get_increment_times(self, n):
+        """
+        Return the total time, the cumulative and single times of the n
+        increments of a pseudo-2D experiment, and the time at the middle of
+        the acquisition of each increment, all in minutes. The vd of each
+        increment is counted once, as a delay before its scans; this is not
+        correct for pulse programs that apply it in every scan, such as
+        inversion recovery.
+        """
+        acqus = self._procpar['acqus']
+        scan = acqus['TD']/(2*acqus['SW_h']) + acqus['D'][1]
+        if os.path.isfile(os.path.join(self.fid_path, 'vdlist')):
+            vd = numpy.resize(numpy.array(nmrglue.bruker.read_vdlist(self.fid_path), dtype='f8'), n)
+        else:
+            vd = numpy.zeros(n)
+        if os.path.isfile(os.path.join(self.fid_path, 'vclist')):
+            with open(os.path.join(self.fid_path, 'vclist')) as f:
+                vc = numpy.resize(numpy.array([float(i) for i in f.read().split()]), n)
+        else:
+            vc = numpy.ones(n)
+        acquisition = scan*acqus['NS']*vc/60.   # convert to mins
+        tsingle = vd/60.+acquisition
+        tcum = numpy.cumsum(tsingle)
+        acqtime = tcum-0.5*acquisition
+        return (tcum[-1], tcum, tsingle, acqtime)
+
+    def get_arraysets(self, threads=8):
+        """
+        Return the interleaved arraysets of a Bruker dataset, reading only the
+        acqus headers of the experiments. This is a non-interactive
+        alternative to the prompt of
+        :meth:`~nmrpy.data_objects.BrukerImporter.import_fid`. Each arrayset
+        is described by a dict with its number ('arrayset', as passed to
+        :meth:`~nmrpy.data_objects.BrukerImporter.import_fid`), its experiment
+        directories ('experiments'), and the pulse program ('PULPROG'), 'TD'
+        and 'NS' of its first experiment.
+
+        :keyword threads: maximum number of headers read at the same time
+        """
+        pool = WorkerPool(cpus=threads, backend='thread')
+        try:
+            paths, headers = self._read_headers(pool)
+        finally:
+            pool.terminate()
+        incr = self._get_period(headers)
+        arraysets = []
+        for i in range(incr):
+            acqus = headers[i]['acqus']
+            arraysets.append({
+                'arrayset': i+1,
+                'experiments': [os.path.basename(path) for path in paths[i::incr]],
+                'PULPROG': acqus['PULPROG'],
+                'TD': acqus['TD'],
+                'NS': acqus['NS'],
+                })
+        return arraysets
+
+    def _print_arraysets(self, paths, headers, incr):
+        for i in range(incr):
+            acqus = headers[i]['acqus']
+            print('{}: {} experiments, {}, TD {}, NS {}'.format(
+                i+1, len(paths[i::incr]), acqus['PULPROG'], acqus['TD'], acqus['NS']))
+
+    def _read_headers(self, pool):
+        """
+        Return the paths of the numbered experiment directories, in numeric
+        order, and their acqus headers, read with the threads of pool.
+        """
+        dirs = [int(i) for i in os.listdir(self.fid_path) if \
+                os.path.isdir(self.fid_path+os.path.sep+i)]
+        dirs.sort()
+        paths = [self.fid_path+os.path.sep+str(i) for i in dirs]
+        return paths, list(self._imap_ordered(pool, self._read_header, paths))
+
+    @staticmethod
+    def _read_procpar(path, pdata=None):
+        """
+        Return the parameter dictionary of nmrglue.bruker.read for the
+        experiment directory path: its acqus and procs files and pulse
+        program. Only the parameter files are read, so that the size of the
+        binary file, which may be incomplete or padded, does not matter. The
+        procs are read from pdata/<pdata> if given, else from nmrglue's
+        default.
+        """
+        procs_files = None
+        if pdata is not None:
+            procs_files = [os.path.join(path, 'pdata', str(pdata), 'procs')]
+        procpar = nmrglue.bruker.read_procs_file(path, procs_files)
+        procpar.update(BrukerImporter._read_header(path))
+        if os.path.isfile(os.path.join(path, 'pulseprogram')):
+            procpar['pprog'] = nmrglue.bruker.read_pprog(os.path.join(path, 'pulseprogram'))
+        return procpar
+
+    @staticmethod
+    def _read_header(path):
+        header = nmrglue.bruker.read_acqus_file(path)
+        if 'acqus' not in header:
+            raise FileNotFoundError('No acqus file in {}.'.format(path))
+        return header
+
+    @staticmethod
+    def _get_period(headers):
+        """
+        Return the number of interleaved arraysets: the distance to the next
+        experiment with the pulse program and TD of the first.
+        """
+        if len(headers) == 1:
+            return 1
+        signature = [(header['acqus']['PULPROG'], header['acqus']['TD']) for header in headers]
+        for incr in range(1, len(signature)):
+            if signature[incr] == signature[0]:
+                return incr
+        raise IndexError('No repeating experiment found.')
+
+    @staticmethod
+    def _map_binary(path, acqus):
+        """
+        Memory-map the fid (or ser) file of the experiment directory path as
+        a 2D array with one FID of interleaved real and imaginary values per
+        row, padded as stored (each FID starts on a 1024 byte boundary). The
+        byte order (BYTORDA) and data type (DTYPA, int32 or float64) are
+        taken from acqus.
+        """
+        if acqus.get('AQ_mod', 0) not in (1, 3):
+            raise TypeError('data must be complex.')
+        filename = os.path.join(path, 'fid')
+        if not os.path.isfile(filename):
+            filename = os.path.join(path, 'ser')
+        dtype = numpy.dtype('f8' if acqus.get('DTYPA', 0) == 2 else 'i4')
+        dtype = dtype.newbyteorder('>' if acqus.get('BYTORDA', 0) == 1 else '<')
+        points = -(-int(acqus['TD'])*dtype.itemsize//1024)*1024//dtype.itemsize
+        raw = numpy.memmap(filename, dtype=dtype, mode='r')
+        return raw[:len(raw)//points*points].reshape(-1, points)
+
+    def _decode_into(self, raw, procpar, out):
+        """
+        Decode the rows of raw with
+        :meth:`~nmrpy.data_objects.BrukerImporter._decode` into out, a chunk
+        of rows at a time.
+        """
+        step = max(self._chunk_size//max(raw[:1].nbytes, 1), 1)
+        for start in range(0, len(raw), step):
+            out[start:start+step] = self._decode(raw[start:start+step], procpar)
+
+    @staticmethod
+    def _decode(raw, procpar):
+        """
+        Convert rows of raw values from
+        :meth:`~nmrpy.data_objects.BrukerImporter._map_binary` to complex FIDs
+        and remove the digital filter described by procpar.
+        """
+        fids = numpy.empty((len(raw), raw.shape[1]//2), dtype=numpy.complex128)
+        fids.real = raw[:, 0::2]
+        fids.imag = raw[:, 1::2]
+        return nmrglue.bruker.remove_digital_filter(procpar, fids)
+
+    @staticmethod
+    def _imap_ordered(pool, fcn, paths):
+        """
+        Apply fcn to paths with the threads of pool, and yield the results in
+        the order of paths as soon as they are available.
+        """
+        pending = {}
+        next_index = 0
+        for index, result in pool.imap_unordered(fcn, paths):
+            pending[index] = result
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
             
     def _get_time_delta(self):
         td = 0.0
         tcum = []
         tsingle = []
         for i in range(self.incr):
-            pp = self.alldata[i][0]['acqus']
+            pp = self._arrayset_procpars[i]['acqus']
             sw_hz = pp['SW_h']
             at = pp['TD']/(2*sw_hz)
             d1 = pp['D'][1]
@@ -0,0 +1,259 @@
+import atexit
+import numpy
+from multiprocessing import Pool, cpu_count, shared_memory
+from multiprocessing.pool import ThreadPool
+
+class WorkerPool():
+    '''
+    A persistent pool of workers for the parallel methods of
+    :class:`~nmrpy.data_objects.FidArray`. The workers are started on first use
+    and kept alive until :meth:`~nmrpy.parallel.WorkerPool.close` is called,
+    so that consecutive processing calls do not pay the start-up cost again.
+
+    Used as a context manager, the pool replaces the shared pool returned by
+    :func:`~nmrpy.parallel.get_worker_pool` for the duration of the block, and
+    is closed on exit. Eg. ::
+
+        with WorkerPool(cpus=4):
+            fid_array.phase_correct_fids()
+            fid_array.deconv_fids()
+
+    :keyword cpus: number of workers, default is one less than the number of CPUs (but at least one)
+
+    :keyword backend: 'process' (default) or 'thread'; threads avoid starting
+        new processes but only run in parallel where the work releases the GIL
+        (e.g. FFTs)
+    '''
+
+    _backends = ['process', 'thread']
+
+    def __init__(self, cpus=None, backend='process'):
+        if cpus is None:
+            cpus = max(cpu_count()-1, 1)
+        if not isinstance(cpus, int) or cpus < 1:
+            raise ValueError('cpus must be a positive integer.')
+        if backend not in self._backends:
+            raise ValueError('backend must be "process" or "thread".')
+        self.cpus = cpus
+        self.backend = backend
+        self._pool = None
+
+    def __str__(self):
+        return 'WorkerPool of {} {} worker(s)'.format(self.cpus, self.backend)
+
+    def __enter__(self):
+        _active_pools.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_pools.remove(self)
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.backend == 'process':
+                self._pool = Pool(self.cpus)
+            else:
+                self._pool = ThreadPool(self.cpus)
+        return self._pool
+
+    def imap_unordered(self, fcn, iterable, chunksize=1):
+        """
+        Apply fcn to every item of iterable and yield (index, result) pairs in
+        the order in which the tasks complete, where index is the position of
+        the item in iterable.
+
+        :keyword chunksize: number of items sent to a worker at a time
+        """
+        tasks = ((fcn, index, item) for index, item in enumerate(iterable))
+        return self._get_pool().imap_unordered(_call_indexed, tasks, chunksize)
+
+    def map(self, fcn, iterable, chunksize=1):
+        """
+        Apply fcn to every item of iterable and return a list of the results
+        in the order of iterable. Tasks are handed out to idle workers in
+        chunks of chunksize and collected as they complete, so that a few slow
+        tasks do not hold up the others.
+
+        :keyword chunksize: number of items sent to a worker at a time
+        """
+        items = list(iterable)
+        results = [None]*len(items)
+        for index, result in self.imap_unordered(fcn, items, chunksize):
+            results[index] = result
+        return results
+
+    def share(self, array):
+        """
+        Return a handle on array, with the array itself as its ``array``
+        attribute, that can be passed to the workers of this pool without
+        pickling the data. For the process backend the array is copied once
+        into a :class:`~nmrpy.parallel.SharedArray`, and results written into
+        it by the workers must be copied back; the thread backend shares array
+        itself. Use the handle as a context manager to release the shared
+        memory afterwards.
+
+        :arg array: a numpy.ndarray
+        """
+        if self.backend == 'process':
+            return SharedArray.from_array(array)
+        return _LocalArray(array)
+
+    def close(self):
+        """
+        Wait for outstanding tasks and shut the workers down. The pool is
+        restarted if it is used again.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        """
+        Stop the workers immediately, discarding outstanding tasks.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+class SharedArray():
+    '''
+    A numpy.ndarray, available as the ``array`` attribute, held in a
+    :class:`multiprocessing.shared_memory.SharedMemory` block. Pickling a
+    SharedArray only transfers the name, shape and dtype of the block, and the
+    unpickled copy in a worker process maps the same memory, so that workers
+    can read their input from and write their results into it directly.
+
+    The process that creates a SharedArray owns the memory and releases it on
+    :meth:`~nmrpy.parallel.SharedArray.unlink`, or on exit when used as a
+    context manager.
+
+    :arg shape: shape of the array
+
+    :arg dtype: dtype of the array
+    '''
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(self.shape))*self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._owner = True
+        self._map()
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Create a SharedArray holding a copy of array.
+
+        :arg array: a numpy.ndarray
+        """
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def _map(self):
+        self.array = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.dtype = numpy.dtype(state['dtype'])
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._map()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the shared memory from this process. :attr:`array` is no longer
+        available afterwards.
+        """
+        if getattr(self, 'array', None) is not None:
+            self.array = None
+            self._shm.close()
+
+    def unlink(self):
+        """
+        Close and, if this process created it, free the shared memory.
+        """
+        self.close()
+        if self._owner:
+            self._owner = False
+            self._shm.unlink()
+
+class _LocalArray():
+    '''
+    Stand-in for :class:`~nmrpy.parallel.SharedArray` with the thread backend,
+    where the workers can use the array itself.
+    '''
+
+    def __init__(self, array):
+        self.array = array
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+def _call_indexed(task):
+    fcn, index, item = task
+    return index, fcn(item)
+
+_active_pools = []
+_shared_pool = None
+
+def get_worker_pool(cpus=None, backend=None):
+    """
+    Return the :class:`~nmrpy.parallel.WorkerPool` used by the parallel
+    methods of :class:`~nmrpy.data_objects.FidArray`. Inside a ``with
+    WorkerPool(...)`` block this is that pool. Otherwise a shared pool is
+    created on first use and reused by later calls; it is only replaced when a
+    different number of cpus or backend is requested.
+
+    :keyword cpus: number of workers, None keeps the current shared pool (see :class:`~nmrpy.parallel.WorkerPool`)
+
+    :keyword backend: 'process' or 'thread', None keeps the current shared pool
+    """
+    global _shared_pool
+    if _active_pools:
+        return _active_pools[-1]
+    if _shared_pool is not None:
+        if cpus is None:
+            cpus = _shared_pool.cpus
+        if backend is None:
+            backend = _shared_pool.backend
+        if (cpus, backend) == (_shared_pool.cpus, _shared_pool.backend):
+            return _shared_pool
+        _shared_pool.close()
+    if backend is None:
+        backend = 'process'
+    _shared_pool = WorkerPool(cpus=cpus, backend=backend)
+    return _shared_pool
+
+def close_worker_pool():
+    """
+    Shut down the shared worker pool returned by :func:`~nmrpy.parallel.get_worker_pool`.
+    """
+    global _shared_pool
+    if _shared_pool is not None:
+        _shared_pool.close()
+        _shared_pool = None
+
+atexit.register(close_worker_pool)
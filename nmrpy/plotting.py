@@ -403,6 +403,8 @@ class Plot():
     def _is_iter_of_iters(cls, i):
         if type(i) == list and len(i) == 0:
             return False
+        elif isinstance(i, numpy.ndarray) and i.dtype.kind in 'iufc':
+            return i.ndim > 1 or (i.ndim == 1 and len(i) == 0)
         elif cls._is_iter(i) and all(cls._is_iter(j) for j in i):
             return True
         return False
@@ -411,6 +413,8 @@ class Plot():
     def _is_flat_iter(cls, i):
         if type(i) == list and len(i) == 0:
             return True
+        elif isinstance(i, numpy.ndarray) and i.dtype.kind in 'iufc':
+            return i.ndim == 1 or (i.ndim > 1 and len(i) == 0)
         elif cls._is_iter(i) and not any(cls._is_iter(j) for j in i):
             return True
         return False
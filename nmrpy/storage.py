@@ -0,0 +1,359 @@
+'''
+Binary container for NMRPy project (.nmrpy) files.
+
+A project file consists of a fixed-size prefix, the data sections and a JSON
+header at the end of the file:
+
+    prefix:   magic (8 bytes), format version (uint32), reserved (uint32),
+              header offset (uint64), header length (uint64)
+    sections: the arrays of the project, each starting at a multiple of
+              ALIGNMENT bytes; stored whole if uncompressed, or as a series of
+              independently zlib-compressed chunks along the first axis
+    header:   a JSON tree of the project metadata, in which every array, and
+              the pickle of every other object that JSON cannot represent,
+              is replaced by a reference to its section
+
+Large uncompressed arrays can thus be memory-mapped straight from the file,
+and the metadata is read without touching the data. Large compressed arrays
+can be opened lazily as a :class:`~nmrpy.storage.ChunkedArray`, which only
+decompresses the chunks that are used. The format version is increased
+whenever the layout changes; files of a newer version than
+:data:`~nmrpy.storage.VERSION` are refused.
+'''
+
+import collections
+import json
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import zlib
+import numpy
+
+MAGIC = b'NMRPYBIN'
+VERSION = 1
+ALIGNMENT = 64
+CHUNK_SIZE = 2**20
+MMAP_SIZE = 2**16
+MAX_ROWS = 100
+
+_prefix = struct.Struct('<8sIIQQ')
+
+def is_project_file(filename):
+    """
+    Return True if filename is a project file in the binary container format.
+    """
+    if not isinstance(filename, str) or not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def dump(tree, filename, compress=False, chunk_size=CHUNK_SIZE):
+    """
+    Write tree to filename in the binary container format. tree may consist
+    of dicts, lists, tuples, strings, numbers, None and numpy arrays, nested
+    to any depth; arrays of a numeric dtype are written to their own
+    sections. Any other object is pickled, and the pickle written to its own
+    section. The file is written to a temporary file that then replaces
+    filename, so that memory maps of an earlier version of the file remain
+    valid.
+
+    :arg tree: the object tree to save
+
+    :arg filename: path of the file to write
+
+    :keyword compress: compress the arrays with zlib in chunks of about chunk_size bytes, in which case they cannot be memory-mapped on loading
+
+    :keyword chunk_size: approximate size in bytes of the compressed chunks
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(_prefix.pack(MAGIC, VERSION, 0, 0, 0))
+            sections = []
+            encoder = _Encoder(tree, lambda array: _write_array(f, array, sections, compress, chunk_size))
+            header = {
+                'version': VERSION,
+                'tree': encoder.encode(tree),
+                'shared': encoder.shared,
+                'sections': sections,
+                }
+            header = json.dumps(header).encode('utf-8')
+            header_offset = f.tell()
+            f.write(header)
+            f.seek(0)
+            f.write(_prefix.pack(MAGIC, VERSION, 0, header_offset, len(header)))
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(path, 0o666 & ~umask)
+        os.replace(path, filename)
+    except:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+def load(filename, mmap=True, lazy=False, max_rows=MAX_ROWS):
+    """
+    Read an object tree written by :func:`~nmrpy.storage.dump`. Uncompressed
+    arrays of at least MMAP_SIZE bytes are returned as copy-on-write
+    numpy.memmap objects, so that only the parts that are used are read from
+    disk and changes are not written back to the file.
+
+    :arg filename: path of the file to read
+
+    :keyword mmap: memory-map large uncompressed arrays rather than reading them into memory
+
+    :keyword lazy: return large compressed arrays of two or more dimensions as :class:`~nmrpy.storage.ChunkedArray` objects rather than decompressing them
+
+    :keyword max_rows: number of rows a :class:`~nmrpy.storage.ChunkedArray` keeps decompressed
+    """
+    with open(filename, 'rb') as f:
+        magic, version, reserved, header_offset, header_length = _prefix.unpack(f.read(_prefix.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not an NMRPy project file.'.format(filename))
+        if version > VERSION:
+            raise ValueError('{} was written by a newer version of NMRPy (format version {}).'.format(filename, version))
+        f.seek(header_offset)
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        sections = header['sections']
+        decoder = _Decoder(header['shared'], lambda index: _read_array(f, filename, sections[index], mmap, lazy, max_rows))
+        return decoder.decode(header['tree'])
+
+def _write_array(f, array, sections, compress, chunk_size):
+    array = numpy.ascontiguousarray(array)
+    section = {'dtype': array.dtype.str, 'shape': list(array.shape), 'compressed': bool(compress), 'chunks': []}
+    if array.ndim == 0:
+        array = array.reshape(1)
+    if compress:
+        row_size = max(array[:1].nbytes, 1)
+        rows = max(chunk_size//row_size, 1)
+        chunks = [array[i:i+rows] for i in range(0, max(len(array), 1), rows)]
+    else:
+        chunks = [array]
+    for chunk in chunks:
+        data = chunk.tobytes()
+        if compress:
+            data = zlib.compress(data)
+        f.write(b'\0'*(-f.tell() % ALIGNMENT))
+        section['chunks'].append([f.tell(), len(data), len(chunk)])
+        f.write(data)
+    sections.append(section)
+    return len(sections)-1
+
+def _read_array(f, filename, section, mmap, lazy, max_rows):
+    dtype = numpy.dtype(section['dtype'])
+    shape = tuple(section['shape'])
+    large = int(numpy.prod(shape))*dtype.itemsize >= MMAP_SIZE
+    if not section['compressed']:
+        offset, length, rows = section['chunks'][0]
+        if mmap and large:
+            return numpy.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape)
+        f.seek(offset)
+        return numpy.frombuffer(f.read(length), dtype=dtype).reshape(shape).copy()
+    if lazy and large and len(shape) > 1:
+        return ChunkedArray(filename, section, max_rows=max_rows)
+    array = numpy.empty(shape, dtype=dtype)
+    flat = array.reshape((-1,)+shape[1:]) if len(shape) else array.reshape(1)
+    row = 0
+    for offset, length, rows in section['chunks']:
+        f.seek(offset)
+        chunk = numpy.frombuffer(zlib.decompress(f.read(length)), dtype=dtype)
+        flat[row:row+rows] = chunk.reshape((rows,)+flat.shape[1:])
+        row += rows
+    return array
+
+class ChunkedArray():
+    '''
+    A read-only array stored in compressed chunks along its first axis in a
+    project file, as returned by :func:`~nmrpy.storage.load` with lazy=True.
+    Indexing with an integer returns a row, decompressing only the chunk that
+    holds it; the most recently used chunks are kept in memory up to max_rows
+    rows in total (but at least one chunk), and the others are released.
+    numpy.asarray() reads the whole array.
+
+    :arg filename: path of the project file
+
+    :arg section: the section of the file header describing the array
+
+    :keyword max_rows: number of rows to keep decompressed
+    '''
+
+    def __init__(self, filename, section, max_rows=MAX_ROWS):
+        self.dtype = numpy.dtype(section['dtype'])
+        self.shape = tuple(section['shape'])
+        self.max_rows = max_rows
+        self._chunks = section['chunks']
+        self._starts = numpy.cumsum([0]+[rows for offset, length, rows in self._chunks])
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._file = open(filename, 'rb')
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def resident_rows(self):
+        """
+        Number of rows currently held decompressed.
+        """
+        return sum(len(rows) for rows in self._cache.values())
+
+    def __getitem__(self, index):
+        if not isinstance(index, (int, numpy.integer)):
+            return numpy.asarray(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index {} is out of bounds for axis 0 with size {}.'.format(index, len(self)))
+        chunk = int(numpy.searchsorted(self._starts, index, side='right'))-1
+        return self._get_chunk(chunk)[index-self._starts[chunk]]
+
+    def __array__(self, dtype=None):
+        array = numpy.empty(self.shape, dtype=self.dtype)
+        for chunk, start in enumerate(self._starts[:-1]):
+            rows = self._cache.get(chunk)
+            array[start:start+self._chunks[chunk][2]] = rows if rows is not None else self._read_chunk(chunk)
+        if dtype is not None:
+            return array.astype(dtype, copy=False)
+        return array
+
+    def _read_chunk(self, chunk):
+        offset, length, rows = self._chunks[chunk]
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        # arrays on a bytes buffer are read-only, so in-place changes to a
+        # row cannot be lost when its chunk is released
+        return numpy.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape((rows,)+self.shape[1:])
+
+    def _get_chunk(self, chunk):
+        if chunk in self._cache:
+            self._cache.move_to_end(chunk)
+            return self._cache[chunk]
+        rows = list(self._read_chunk(chunk))
+        self._cache[chunk] = rows
+        while len(self._cache) > 1 and self.resident_rows > self.max_rows:
+            self._cache.popitem(last=False)
+        return rows
+
+    def close(self):
+        """
+        Release the decompressed chunks and close the file.
+        """
+        self._cache.clear()
+        self._file.close()
+
+    def __del__(self):
+        if hasattr(self, '_file'):
+            self.close()
+
+class _Encoder():
+    '''
+    Convert an object tree into JSON-compatible objects, writing arrays, and
+    the pickles of objects of other types, with write_array. Containers that occur more than once in the tree (such as
+    the procpar shared by all FIDs) are encoded once, in shared, and
+    referenced elsewhere, so that they are also shared again on loading.
+    '''
+
+    def __init__(self, tree, write_array):
+        self.write_array = write_array
+        self.counts = {}
+        self._count(tree)
+        self.index = {}
+        self.shared = []
+
+    def _count(self, obj):
+        if not isinstance(obj, (dict, list, tuple, numpy.ndarray)):
+            return
+        self.counts[id(obj)] = self.counts.get(id(obj), 0)+1
+        if self.counts[id(obj)] > 1:
+            return
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                self._count(key)
+                self._count(value)
+        elif not isinstance(obj, numpy.ndarray) or obj.dtype.hasobject:
+            for i in (obj.ravel() if isinstance(obj, numpy.ndarray) else obj):
+                self._count(i)
+
+    def encode(self, obj):
+        if self.counts.get(id(obj), 0) > 1:
+            if id(obj) not in self.index:
+                self.index[id(obj)] = len(self.shared)
+                self.shared.append(None)
+                self.shared[self.index[id(obj)]] = self._encode(obj)
+            return {'__shared__': self.index[id(obj)]}
+        return self._encode(obj)
+
+    def _encode(self, obj):
+        encode = self.encode
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        if isinstance(obj, complex):
+            return {'__complex__': [obj.real, obj.imag]}
+        if isinstance(obj, numpy.generic):
+            return encode(obj.item())
+        if isinstance(obj, numpy.ndarray):
+            if obj.dtype.hasobject:
+                return {'__objarray__': [encode(i) for i in obj.ravel()], 'shape': list(obj.shape)}
+            return {'__array__': self.write_array(obj)}
+        if isinstance(obj, tuple):
+            return {'__tuple__': [encode(i) for i in obj]}
+        if isinstance(obj, list):
+            return [encode(i) for i in obj]
+        if isinstance(obj, dict):
+            if all(isinstance(key, str) and not key.startswith('__') for key in obj):
+                return {key: encode(value) for key, value in obj.items()}
+            return {'__items__': [[encode(key), encode(value)] for key, value in obj.items()]}
+        return {'__pickle__': self.write_array(numpy.frombuffer(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), dtype=numpy.uint8))}
+
+class _Decoder():
+    '''
+    Inverse of :class:`~nmrpy.storage._Encoder`, reading arrays with
+    read_array.
+    '''
+
+    def __init__(self, shared, read_array):
+        self.read_array = read_array
+        self.shared = shared
+        self.decoded = {}
+
+    def decode(self, obj):
+        decode = self.decode
+        if isinstance(obj, list):
+            return [decode(i) for i in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if '__shared__' in obj:
+            index = obj['__shared__']
+            if index not in self.decoded:
+                self.decoded[index] = decode(self.shared[index])
+            return self.decoded[index]
+        if '__array__' in obj:
+            return self.read_array(obj['__array__'])
+        if '__pickle__' in obj:
+            return pickle.loads(numpy.asarray(self.read_array(obj['__pickle__'])).tobytes())
+        if '__objarray__' in obj:
+            items = [decode(i) for i in obj['__objarray__']]
+            array = numpy.empty(len(items), dtype=object)
+            for i, item in enumerate(items):
+                array[i] = item
+            return array.reshape(obj['shape'])
+        if '__complex__' in obj:
+            return complex(*obj['__complex__'])
+        if '__tuple__' in obj:
+            return tuple(decode(i) for i in obj['__tuple__'])
+        if '__items__' in obj:
+            return {_hashable(decode(key)): decode(value) for key, value in obj['__items__']}
+        return {key: decode(value) for key, value in obj.items()}
+
+def _hashable(key):
+    if isinstance(key, list):
+        return tuple(_hashable(i) for i in key)
+    return key
@@ -1,7 +1,18 @@
 import unittest
+from unittest import mock
 from nmrpy.data_objects import *
+from nmrpy.parallel import WorkerPool, SharedArray, get_worker_pool, close_worker_pool
+from nmrpy import storage
 import numpy
+import lmfit
 import os
+import pickle
+import time
+import tempfile
+import datetime
+import threading
+import shutil
+import nmrglue
 
 testpath = os.path.dirname(__file__)
 
@@ -139,6 +150,38 @@ class TestFidInitialisation(unittest.TestCase):
             with self.assertRaises(TypeError):
                Fid.from_data(test_data)
 
+    def test_ndarray_validation(self):
+        self.assertTrue(Fid._is_flat_iter(numpy.arange(10.0)))
+        self.assertFalse(Fid._is_flat_iter(numpy.ones((2, 3))))
+        self.assertTrue(Fid._is_iter_of_iters(numpy.ones((2, 3))))
+        self.assertFalse(Fid._is_iter_of_iters(numpy.arange(10.0)))
+        self.assertTrue(Fid._is_valid_dataset(numpy.arange(10, dtype='complex')))
+        for test_data in [
+                numpy.ones((2, 3)),
+                numpy.array(['a', 'b']),
+                numpy.array([True, False]),
+                numpy.array([1, [2]], dtype=object),
+                ]:
+            with self.assertRaises(TypeError):
+               Fid.from_data(test_data)
+
+    def test_f_pks_nocheck(self):
+        x = numpy.arange(100, dtype='f8')
+        p = numpy.array([[10.0, 1.0, 1.0, 1.0, 0.5], [20.0, 2.0, 3.0, 1.0, 1.5]])
+        self.assertTrue(numpy.allclose(Fid._f_pks(p, x), Fid._f_pks_nocheck(p, x)))
+        self.assertTrue(numpy.allclose(Fid._f_pks_list(p, x), Fid._f_pks_list_nocheck(p, x)))
+
+    def test_f_pks_array(self):
+        x = numpy.arange(100, dtype='f8')
+        p = numpy.array([[10.0, 1.0, 1.0, 1.0, 0.5], [20.0, 2.0, 3.0, 1.0, 1.5], [30.0, 2.0, 3.0, 2.0, -0.5]])
+        peaks = numpy.array([Fid._f_pk(x, *peak) for peak in p])
+        out = numpy.empty((3, 100))
+        self.assertIs(Fid._f_pks_array(p, x, out=out, work=numpy.empty((3, 100))), out)
+        self.assertTrue(numpy.allclose(out, peaks))
+        self.assertTrue(numpy.allclose(Fid._f_pks(p, x), peaks.sum(0)))
+        self.assertEqual(Fid._f_pks_array(numpy.zeros((0, 5)), x).shape, (0, 100))
+        self.assertTrue(numpy.array_equal(Fid._f_pks(numpy.array([]), x), numpy.zeros(100)))
+
     def test__is_iter_of_iters(self):
         Fid._is_iter_of_iters([[]])
 
@@ -230,6 +273,19 @@ class TestFidInitialisation(unittest.TestCase):
         fid._f_conv([p1, p2], data)
         fid._f_conv([p1, p2], list(data))
 
+    def test_f_conv_direct(self):
+        x = numpy.arange(300, dtype='f8')
+        data = Fid._f_pks([[143.0, 5.0, 2.0, 1.0, 0.5], [171.0, 3.0, 1.0, 0.5, 0.5]], x)
+        data[:50] = 0.0
+        for p in [[[130.0, 10.0, 0.1, 0.9, 0.5], [160.0, 10.0, 0.1, 0.4, 0.5]],
+                  [[250.0, 4.0, 2.0, 1.0, 0.0]]]:
+            peaks = Fid._f_pks(p, x)
+            data_direct = numpy.where(data == 0.0, 1e-6, data)
+            direct = numpy.argmax(numpy.convolve(data_direct, peaks[::-1])) - \
+                    numpy.argmax(numpy.convolve(peaks, peaks[::-1]))
+            self.assertEqual(Fid._f_conv(p, data), direct)
+        self.assertEqual(data[0], 0.0)
+
     def test_f_conv_failed(self):
         fid = Fid()
         x = 1+numpy.arange(100)
@@ -336,6 +392,13 @@ class TestFidArrayInitialisation(unittest.TestCase):
         self.assertIsInstance(fid_array._procpar, dict)
         self.assertIsInstance(fid_array._params, dict)
 
+    def test_nmrpy_from_path(self):
+        import nmrpy
+        path = os.path.join(testpath, 'test_data', 'test1.fid')
+        fid_array = nmrpy.from_path(fid_path=path)
+        self.assertIsInstance(fid_array, FidArray)
+        self.assertEqual(len(fid_array.get_fids()), len(FidArray.from_path(fid_path=path).get_fids()))
+
     def test_fid_params_setter_failed(self):
         fid = Fid()
         with self.assertRaises(AttributeError):
@@ -368,6 +431,120 @@ class TestFidArrayInitialisation(unittest.TestCase):
         self.assertIsInstance(fid_array._procpar, dict)
         self.assertIsInstance(fid_array._params, dict)
 
+    def test_bruker_importer_threads(self):
+        path = os.path.join(testpath, 'test_data', 'bruker2')
+        importer = BrukerImporter(fid_path=path)
+        importer.import_fid(arrayset=2, threads=1)
+        map_binary = BrukerImporter._map_binary
+        def slow_map_binary(path, acqus):
+            # experiments with lower numbers complete last
+            time.sleep(0.01*(30-int(os.path.basename(path))))
+            return map_binary(path, acqus)
+        with mock.patch.object(BrukerImporter, '_map_binary', side_effect=slow_map_binary) as mock_read:
+            threaded_importer = BrukerImporter(fid_path=path)
+            threaded_importer.import_fid(arrayset=2, threads=8)
+        # only the FIDs of the selected arrayset are read (the first twice,
+        # to size the data block)
+        self.assertEqual(mock_read.call_count, len(os.listdir(path))//3+1)
+        self.assertEqual(threaded_importer.incr, 3)
+        self.assertTrue(numpy.array_equal(threaded_importer.data, importer.data))
+        self.assertTrue(numpy.array_equal(threaded_importer._procpar['tcum'], importer._procpar['tcum']))
+
+    def test_native_readers(self):
+        for fid_file in ['test1.fid', 'test2.fid']:
+            path = os.path.join(testpath, 'test_data', fid_file)
+            procpar, data = nmrglue.varian.read(path)
+            importer = VarianImporter(fid_path=path)
+            importer.import_fid()
+            self.assertEqual(importer.data.dtype, data.dtype)
+            self.assertTrue(numpy.array_equal(importer.data, numpy.atleast_2d(data)))
+            self.assertEqual(importer._procpar, procpar)
+        path = os.path.join(testpath, 'test_data', 'bruker2')
+        importer = BrukerImporter(fid_path=path)
+        importer.import_fid(arrayset=3)
+        experiments = [os.path.join(path, str(i)) for i in range(3, 25, 3)]
+        procpar = nmrglue.bruker.read(experiments[0])[0]
+        data = numpy.array([nmrglue.bruker.read(experiment)[1] for experiment in experiments])
+        data = nmrglue.bruker.remove_digital_filter(procpar, data)
+        self.assertTrue(numpy.allclose(importer.data, data))
+        self.assertEqual(importer._procpar['acqus'], procpar['acqus'])
+        # the imported block becomes the data block without a copy
+        fid_array = FidArray._from_block(importer.data)
+        self.assertIs(fid_array.data, importer.data)
+
+    @staticmethod
+    def _write_ser(path, ser_path, td, experiments):
+        # a pseudo-2D experiment made of the given FIDs of bruker2 with TD
+        # increments in acqu2s
+        shutil.copy(os.path.join(path, '1', 'acqus'), ser_path)
+        with open(os.path.join(path, '1', 'acqus')) as f:
+            acqu2s = f.read().replace('##$TD= 36360', '##$TD= {}'.format(td))
+        with open(os.path.join(ser_path, 'acqu2s'), 'w') as f:
+            f.write(acqu2s)
+        with open(os.path.join(ser_path, 'ser'), 'wb') as f:
+            for i in experiments:
+                with open(os.path.join(path, str(i), 'fid'), 'rb') as fid:
+                    f.write(fid.read())
+
+    def test_from_path_ser(self):
+        # a pseudo-2D experiment made of the first three FIDs of arrayset 1
+        path = os.path.join(testpath, 'test_data', 'bruker2')
+        ser_path = tempfile.mkdtemp()
+        try:
+            self._write_ser(path, ser_path, 3, [1, 4, 7])
+            with open(os.path.join(ser_path, 'vdlist'), 'w') as f:
+                f.write('60s\n')
+            fid_array = FidArray.from_path(fid_path=ser_path, file_format='bruker')
+            reference = FidArray.from_path(fid_path=path, file_format='bruker', arrayset=1)
+            self.assertEqual(len(fid_array.get_fids()), 3)
+            self.assertTrue(numpy.allclose(fid_array.data, reference.data[:3]))
+            acqtime = fid_array._params['acqtime']
+            single = reference._procpar['tsingle'][0]
+            self.assertTrue(numpy.allclose(acqtime, 1+0.5*single+(1+single)*numpy.arange(3)))
+        finally:
+            shutil.rmtree(ser_path)
+
+    def test_from_path_ser_incomplete(self):
+        path = os.path.join(testpath, 'test_data', 'bruker2')
+        reference = FidArray.from_path(fid_path=path, file_format='bruker', arrayset=1)
+        # an experiment in progress, with fewer increments than TD, and a ser
+        # file padded beyond TD
+        for td, experiments in [(5, [1, 4, 7]), (3, [1, 4, 7, 10])]:
+            ser_path = tempfile.mkdtemp()
+            try:
+                self._write_ser(path, ser_path, td, experiments)
+                fid_array = FidArray.from_path(fid_path=ser_path, file_format='bruker')
+                self.assertEqual(len(fid_array.get_fids()), 3)
+                self.assertTrue(numpy.allclose(fid_array.data, reference.data[:3]))
+            finally:
+                shutil.rmtree(ser_path)
+
+    def test_from_path_pdata(self):
+        path = os.path.join(testpath, 'test_data', 'bruker2')
+        fid_array = FidArray.from_path(fid_path=path, file_format='bruker', arrayset=2, pdata=1)
+        fids = fid_array.get_fids()
+        self.assertEqual(len(fids), 8)
+        self.assertTrue(all(fid._flags['ft'] for fid in fids))
+        procpar, data = nmrglue.bruker.read_pdata(os.path.join(path, '5', 'pdata', '1'), all_components=True)
+        self.assertTrue(numpy.allclose(fids[1].data, data[0]+1j*data[1]))
+        self.assertEqual(fid_array._params['sw_left'], procpar['procs']['OFFSET'])
+        with self.assertRaises(ValueError):
+            fids[0].ft()
+        import nmrpy
+        fid_array = nmrpy.from_path(path, 'bruker', 2, pdata=1)
+        self.assertTrue(numpy.array_equal(fid_array.data, numpy.array([fid.data for fid in fids])))
+
+    def test_bruker_importer_get_arraysets(self):
+        path = os.path.join(testpath, 'test_data', 'bruker2')
+        with mock.patch.object(BrukerImporter, '_map_binary') as mock_read:
+            arraysets = BrukerImporter(fid_path=path).get_arraysets()
+        mock_read.assert_not_called()
+        self.assertEqual([a['arrayset'] for a in arraysets], [1, 2, 3])
+        self.assertEqual(arraysets[1]['experiments'][:3], ['2', '5', '8'])
+        self.assertEqual(arraysets[2]['PULPROG'], 'zgprse.bb')
+        path = os.path.join(testpath, 'test_data', 'bruker1')
+        self.assertEqual(len(BrukerImporter(fid_path=path).get_arraysets()), 1)
+
     def test_failed_from_path_array_varian(self):
         path = os.path.join(testpath, 'test_data', 'bruker1')
         with self.assertRaises(AttributeError):
@@ -395,6 +572,130 @@ class TestFidArrayInitialisation(unittest.TestCase):
         fid_array = FidArray.from_path(path)
         self.assertIsInstance(fid_array.data, numpy.ndarray)
 
+    def test_data_block_views(self):
+        path = os.path.join(testpath, 'test_data', 'test1.fid')
+        fid_array = FidArray.from_path(path)
+        data = fid_array.data
+        self.assertIs(data, fid_array.data)
+        self.assertTrue(data.flags['C_CONTIGUOUS'])
+        for fid, row in zip(fid_array.get_fids(), data):
+            self.assertTrue(numpy.shares_memory(fid.data, data))
+            self.assertTrue(numpy.array_equal(fid.data, row))
+        fid = fid_array.get_fids()[1]
+        fid.data = 2*fid.data
+        self.assertIsNot(data, fid_array.data)
+        self.assertTrue(numpy.array_equal(fid_array.data[1], 2*data[1]))
+        self.assertTrue(numpy.shares_memory(fid.data, fid_array.data))
+        fid_array.del_fid(fid.id)
+        self.assertEqual(len(fid_array.data), len(data)-1)
+
+    def test_data_block_ragged(self):
+        fid_array = FidArray()
+        fid_array.add_fids([Fid(data=[1, 2, 3]), Fid(data=[1.0, 2.0, 3.0])])
+        data = fid_array.data
+        self.assertEqual(data.shape, (2, 3))
+        self.assertNotEqual(fid_array.get_fids()[0].data.dtype, data.dtype)
+
+    def test_data_block_unequal_length(self):
+        fid_array = FidArray()
+        fid_array.add_fids([Fid(data=[1.0, 2.0, 3.0]), Fid(data=[1.0, 2.0])])
+        data = fid_array.data
+        self.assertEqual(data.shape, (2,))
+        self.assertEqual(data.dtype, object)
+        for fid, row in zip(fid_array.get_fids(), data):
+            self.assertIs(row, fid.data)
+
+    def test_save_to_file(self):
+        path = os.path.join(testpath, 'test_data', 'test1.nmrpy')
+        fid_array = FidArray.from_path(path)
+        fid_array.get_fids()[0]._flags = {'ft': True}
+        fid_array._integral_traces = {0: {1: 2, 3: 1}}
+        fid_array.created = datetime.datetime(2020, 1, 2, 3, 4)
+        filename = os.path.join(testpath, 'test_data', 'test_save.nmrpy')
+        try:
+            for compress in [False, True]:
+                fid_array.save_to_file(filename, overwrite=True, compress=compress)
+                self.assertTrue(storage.is_project_file(filename))
+                loaded = FidArray.from_path(filename)
+                self.assertEqual(isinstance(loaded.data, numpy.memmap), not compress)
+                self.assertTrue(numpy.array_equal(loaded.data, fid_array.data))
+                self.assertEqual(loaded.integral_traces, fid_array.integral_traces)
+                self.assertEqual(loaded.created, fid_array.created)
+                self.assertTrue(numpy.allclose(loaded.deconvoluted_integrals, fid_array.deconvoluted_integrals, equal_nan=True))
+                for fid, loaded_fid in zip(fid_array.get_fids(), loaded.get_fids()):
+                    self.assertEqual(loaded_fid.id, fid.id)
+                    self.assertEqual(loaded_fid._flags, fid._flags)
+                    self.assertTrue(numpy.array_equal(loaded_fid.peaks, fid.peaks))
+                    self.assertTrue(numpy.shares_memory(loaded_fid.data, loaded.data))
+                    self.assertIs(loaded_fid._procpar, loaded.get_fids()[0]._procpar)
+            # overwrite the file that the loaded project is mapped from
+            loaded.save_to_file(filename, overwrite=True)
+            self.assertTrue(numpy.array_equal(FidArray.from_path(filename).data, fid_array.data))
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_from_path_lazy(self):
+        path = os.path.join(testpath, 'test_data', 'test1.nmrpy')
+        fid_array = FidArray.from_path(path)
+        filename = os.path.join(testpath, 'test_data', 'test_lazy.nmrpy')
+        try:
+            fid_array.save_to_file(filename, overwrite=True, compress=True)
+            loaded = FidArray.from_path(filename, lazy=True, max_resident=2)
+            source = loaded.get_fids()[0]._Fid__data.source
+            self.assertIsInstance(source, storage.ChunkedArray)
+            self.assertEqual(source.resident_rows, 0)
+            self.assertTrue(numpy.allclose(loaded.deconvoluted_integrals, fid_array.deconvoluted_integrals, equal_nan=True))
+            self.assertEqual(source.resident_rows, 0)
+            for fid, loaded_fid in zip(fid_array.get_fids(), loaded.get_fids()):
+                self.assertTrue(numpy.array_equal(loaded_fid.data, fid.data))
+                self.assertLessEqual(source.resident_rows, max(2, len(source)//len(source._chunks)+1))
+            with self.assertRaises(ValueError):
+                loaded.get_fids()[0].data[0] = 0
+            loaded_fid = pickle.loads(pickle.dumps(loaded.get_fids()[1]))
+            self.assertTrue(numpy.array_equal(loaded_fid.data, fid_array.get_fids()[1].data))
+            self.assertTrue(numpy.array_equal(loaded.data, fid_array.data))
+            self.assertTrue(loaded.data.flags.writeable)
+            import nmrpy
+            loaded = nmrpy.from_path(filename, None, None, True, 2)
+            source = loaded.get_fids()[0]._Fid__data.source
+            self.assertIsInstance(source, storage.ChunkedArray)
+            self.assertEqual(source.max_rows, 2)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_storage(self):
+        filename = os.path.join(testpath, 'test_data', 'test_storage.nmrpy')
+        tree = {
+            'array': numpy.arange(12, dtype=numpy.complex128).reshape(3, 4),
+            'scalar': numpy.float64(1.5),
+            'objects': numpy.array([None, [1, 2]], dtype=object),
+            'keys': {0: 'a', (1, 2): 'b', '__x': 1j},
+            'tuple': (1, 'a', None),
+            'other': [datetime.datetime(2020, 1, 2, 3, 4), {'a': 1}],
+            }
+        try:
+            for compress in [False, True]:
+                storage.dump(tree, filename, compress=compress, chunk_size=16)
+                loaded = storage.load(filename)
+                self.assertTrue(numpy.array_equal(loaded['array'], tree['array']))
+                self.assertEqual(loaded['scalar'], 1.5)
+                self.assertEqual(list(loaded['objects']), [None, [1, 2]])
+                self.assertEqual(loaded['keys'], tree['keys'])
+                self.assertEqual(loaded['tuple'], tree['tuple'])
+                self.assertEqual(loaded['other'], tree['other'])
+            with self.assertRaises(TypeError):
+                storage.dump({'a': threading.Lock()}, filename)
+            with open(filename, 'r+b') as f:
+                f.seek(8)
+                f.write(numpy.uint32(storage.VERSION+1).tobytes())
+            with self.assertRaises(ValueError):
+                storage.load(filename)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
     def test_failed_from_path_array(self):
         path = None
         with self.assertRaises(AttributeError):
@@ -521,8 +822,24 @@ class TestFidUtils(unittest.TestCase):
 
         fid = self.fid_array_bruker.get_fids()[0]
         fid.ft()
+        self.assertIsNone(fid.phase_correction)
+        data = fid.data
         fid.phase_correct()
-        
+        p0, p1 = fid.phase_correction
+        self.assertTrue(numpy.allclose(Fid._ps(data, p0=p0, p1=p1), fid.data))
+
+    def test_phase_fit(self):
+        x = numpy.arange(8192, dtype='f8')
+        spectrum = sum(a/(w-1j*(x-c)) for a, w, c in [(1.0, 5.0, 1000), (2.0, 3.0, 3000), (0.5, 8.0, 6000)])
+        for method in ['leastsq', 'nelder', 'powell']:
+            data = Fid._ps(spectrum, p0=40.0, p1=-30.0)
+            phased_data, p0, p1 = Fid._phase_correct((data, method))
+            self.assertAlmostEqual(p0, -40.0, delta=2.0)
+            self.assertAlmostEqual(p1, 30.0, delta=2.0)
+            self.assertTrue(numpy.allclose(phased_data, spectrum, atol=0.01*abs(spectrum).max()))
+        with self.assertRaises(ValueError):
+            Fid._phase_fit(spectrum, method='string')
+
     def test_peakpick(self):
         fid = self.fid_array_varian.get_fids()[0]
         fid.ft()
@@ -539,6 +856,99 @@ class TestFidUtils(unittest.TestCase):
             Fid._f_fitp(d_slice, p_slice, frac_gauss=0.5)
             d_slice = list(d_slice)
             Fid._f_fitp(d_slice, p_slice, frac_gauss=0.5)
+            Fid._f_fitp(d_slice, p_slice, frac_gauss=0.5, jacobian=False)
+            Fid._f_fitp(d_slice, p_slice, method='least_squares')
+
+    def test_f_jac(self):
+        x = numpy.arange(200, dtype='f8')
+        data = Fid._f_pks([[90.0, 5.0, 3.0, 2.0, 0.3], [110.0, 8.0, 2.0, 1.0, 0.3]], x)
+        p = lmfit.Parameters()
+        for i, peak in enumerate([[92.0, 6.0, 2.5, 1.8, 0.5], [108.0, 7.0, 2.2, 1.1, 0.5]]):
+            for par, value in zip(['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss'], peak):
+                p.add('%s_%i'%(par, i), value=value)
+        p['frac_gauss_1'].vary = False
+        jac = Fid._f_jac(p, data)
+        self.assertEqual(jac.shape, (200, 9))
+        names = [name for name in p if p[name].vary]
+        for column, name in enumerate(names):
+            p_step = p.copy()
+            p_step[name].value += 1e-6
+            finite_difference = (Fid._f_res(p_step, data)-Fid._f_res(p, data))/1e-6
+            self.assertTrue(numpy.allclose(jac[:, column], finite_difference, atol=1e-4))
+
+    def test_f_initp(self):
+        data = numpy.linspace(0.0, 1.0, 100)
+        init = [[120.0, numpy.inf, 2.0, numpy.nan, 0.0], [50.0, 5.0, -1.0, 5.0, 0.3]]
+        p = Fid._f_initp(data, init, frac_gauss=0.0)
+        self.assertTrue(numpy.allclose(p, [[99.0, 10.0, 2.0, 0.9, 0.0], [50.0, 5.0, 0.1, 2.0, 0.0]]))
+        p = Fid._f_initp(data, init)
+        self.assertTrue(numpy.allclose(p[:, 1:3], [[10.0, 0.1], [10.0, 0.1]]))
+        self.assertTrue(numpy.allclose(p[:, 4], 0.5))
+        x = numpy.arange(200, dtype='f8')
+        data = Fid._f_pks([[90.0, 5.0, 3.0, 2.0, 0.0]], x)
+        fit = Fid._f_fitp(data, [88], frac_gauss=0.0, init=[[91.0, 5.0, 2.5, 1.8, 0.0]])
+        self.assertTrue(numpy.allclose(fit[0][0], 90.0, atol=1e-3))
+        self.assertTrue(numpy.allclose(fit[0][2:4], [3.0, 2.0], rtol=1e-3))
+
+    def test_f_fit_joint(self):
+        x = numpy.arange(200, dtype='f8')
+        amplitudes = numpy.linspace(1.0, 2.0, 6)
+        data = numpy.array([Fid._f_pks([[90.0, 5.0, 3.0, a, 0.0], [110.0, 5.0, 2.0, 2.0-0.5*a, 0.0]], x) for a in amplitudes])
+        index, n = Fid._f_joint_index(6, 2, frac_gauss=0.0)
+        self.assertEqual(n, 2+6*2*2)
+        self.assertTrue((index[:, :, [1, 4]] == -1).all())
+        index, n = Fid._f_joint_index(6, 2, frac_gauss=None, shared_offsets=True)
+        self.assertEqual(n, 4*2+6*2)
+        for shared_offsets in [False, True]:
+            fit = Fid._f_fit_joint(data, [88, 111], frac_gauss=0.0, shared_offsets=shared_offsets)
+            self.assertEqual(fit.shape, (6, 2, 5))
+            self.assertTrue(numpy.allclose(fit[:, :, 0], [90.0, 110.0], atol=1e-3))
+            self.assertTrue(numpy.allclose(fit[:, :, 2], [3.0, 2.0], rtol=1e-3))
+            self.assertTrue(numpy.allclose(fit[:, 0, 3], amplitudes, rtol=1e-3))
+            self.assertTrue(numpy.allclose(fit[:, 1, 3], 2.0-0.5*amplitudes, rtol=1e-3))
+        with self.assertRaises(TypeError):
+            Fid._f_fit_joint(data[0], [88, 111])
+        with self.assertRaises(ValueError):
+            Fid._f_fit_joint(data, [88, 250])
+
+    def test_f_pks_windowed(self):
+        x = numpy.arange(1000, dtype='f8')
+        parameterset_list = [[200.0, 3.0, 2.0, 1.0, 0.0], [600.0, 4.0, 2.0, 2.0, 1.0], [990.0, 3.0, 5.0, 1.0, 0.5]]
+        start, stop = Fid._f_windows(parameterset_list, x, 20)
+        self.assertEqual(list(start), [159, 519, 889])
+        self.assertEqual(list(stop), [242, 682, 1000])
+        windowed = Fid._f_pks_windowed(parameterset_list, x, 20)
+        full = Fid._f_pks_array(parameterset_list, x)
+        for peak, i, j in zip(full, start, stop):
+            peak[:i] = 0.0
+            peak[j:] = 0.0
+        self.assertTrue(numpy.allclose(windowed, full.sum(0)))
+        self.assertTrue(numpy.allclose(Fid._f_pks_windowed(parameterset_list, x, 1e6), Fid._f_pks(parameterset_list, x)))
+        grad = Fid._f_pks_grad_windowed(parameterset_list, x, 20)
+        full = Fid._f_pks_grad(parameterset_list, x).reshape(3, 5, -1)
+        for peak, i, j in zip(full, start, stop):
+            peak[:, :i] = 0.0
+            peak[:, j:] = 0.0
+        self.assertEqual(grad.shape, (15, 1000))
+        self.assertEqual(grad.nnz, 5*(stop-start).sum())
+        self.assertTrue(numpy.allclose(grad.toarray(), full.reshape(15, -1)))
+
+    def test_f_fitp_windowed(self):
+        x = numpy.arange(2000, dtype='f8')
+        data = Fid._f_pks([[300.0, 5.0, 3.0, 2.0, 0.0], [1500.0, 5.0, 2.0, 1.0, 0.0]], x)
+        p = lmfit.Parameters()
+        for i, peak in enumerate([[302.0, 6.0, 2.5, 1.8, 0.0], [1498.0, 7.0, 2.2, 1.1, 0.0]]):
+            for par, value in zip(['offset', 'sigma', 'hwhm', 'amplitude', 'frac_gauss'], peak):
+                p.add('%s_%i'%(par, i), value=value, vary=par not in ['sigma', 'frac_gauss'])
+        jac = Fid._f_jac(p, data, window=50)
+        p_step = p.copy()
+        p_step['hwhm_1'].value += 1e-6
+        finite_difference = (Fid._f_res(p_step, data, window=50)-Fid._f_res(p, data, window=50))/1e-6
+        self.assertTrue(numpy.allclose(jac[:, 4], finite_difference, atol=1e-4))
+        fit = numpy.array(Fid._f_fitp(data, numpy.array([302, 1498]), frac_gauss=0.0, window=200))
+        self.assertTrue(numpy.allclose(fit[:, 2:4], [[3.0, 2.0], [2.0, 1.0]], rtol=1e-2))
+        with self.assertRaises(ValueError):
+            Fid._f_fitp(data, [302, 1498], window=0)
 
     def test_f_fitp_failed(self):
         fid = self.fid_array_varian.get_fids()[0]
@@ -568,6 +978,9 @@ class TestFidUtils(unittest.TestCase):
         fid.phase_correct() 
         fid.real()
         fid.deconv()
+        integrals = fid.deconvoluted_integrals
+        fid.deconv(window=1000)
+        self.assertTrue(numpy.allclose(fid.deconvoluted_integrals, integrals, rtol=0.05))
 
 class TestFidArrayUtils(unittest.TestCase):
 
@@ -591,13 +1004,56 @@ class TestFidArrayUtils(unittest.TestCase):
     def test_ft_fids(self):
         self.fid_array_varian.ft_fids(mp=False)
 
+    def test_ft_fids_batched(self):
+        for fid_array in [self.fid_array_varian, self.fid_array_bruker]:
+            ft_data = numpy.array([Fid._ft([fid.data, fid._file_format])
+                                   for fid in fid_array.get_fids()])
+            fid_array.ft_fids(mp=False)
+            self.assertTrue(numpy.allclose(ft_data, fid_array.data))
+            self.assertTrue(all(fid._flags['ft'] for fid in fid_array.get_fids()))
+            with self.assertRaises(ValueError):
+                fid_array.ft_fids()
+
+    def test_ft_block_odd_length(self):
+        data = numpy.arange(7, dtype='complex')
+        fft_data = numpy.fft.fft(data)
+        s = len(data)
+        varian = numpy.append(fft_data[int(s / 2.0):], fft_data[: int(s / 2.0)])
+        bruker = numpy.append(fft_data[int(s / 2.0):: -1], fft_data[s: int(s / 2.0): -1])
+        self.assertTrue(numpy.allclose(Fid._ft_block(data, 'varian'), varian))
+        self.assertTrue(numpy.allclose(Fid._ft_block(data, 'bruker'), bruker))
+        block = Fid._ft_block(numpy.array([data, 2*data]), 'bruker')
+        self.assertTrue(numpy.allclose(block[1], 2*bruker))
+
     def test_phase_correct_fids_mp(self):
         self.fid_array_varian.ft_fids()
         self.fid_array_varian.phase_correct_fids()
 
     def test_phase_correct_fids(self):
         self.fid_array_varian.ft_fids()
+        self.assertTrue(numpy.isnan(self.fid_array_varian.phase_corrections).all())
         self.fid_array_varian.phase_correct_fids(mp=False)
+        self.assertEqual(self.fid_array_varian.phase_corrections.shape, (len(self.fid_array_varian.get_fids()), 2))
+        self.assertFalse(numpy.isnan(self.fid_array_varian.phase_corrections).any())
+
+    def test_phase_correct_fids_shared(self):
+        fid_array = self.fid_array_varian
+        fid_array.ft_fids()
+        data = fid_array.data.copy()
+        block = fid_array.data
+        fid_array.phase_correct_fids(shared=True, reference=[0, 1, 2])
+        self.assertIs(block, fid_array.data)
+        phases = fid_array.phase_corrections
+        self.assertTrue(numpy.allclose(phases, phases[0]))
+        self.assertTrue(numpy.allclose(fid_array.data, Fid._ps(data, p0=phases[0][0], p1=phases[0][1])))
+        block[...] = data
+        for mp in [False, True]:
+            fid_array.phase_correct_fids(shared=True, refine=True, mp=mp)
+            for datum, phase, fid in zip(data, fid_array.phase_corrections, fid_array.get_fids()):
+                self.assertTrue(numpy.allclose(fid.data, Fid._ps(datum, p0=phase[0], p1=phase[1])))
+            fid_array.data[...] = data
+        with self.assertRaises(ValueError):
+            fid_array.phase_correct_fids(shared=True, reference=[])
 
     def test_phase_correct_fids_mp_nelder(self):
         self.fid_array_varian.ft_fids()
@@ -615,6 +1071,35 @@ class TestFidArrayUtils(unittest.TestCase):
         self.fid_array_varian.ft_fids()
         self.fid_array_varian.ps_fids(p0=20, p1=20)
 
+    def test_batched_processing_fids(self):
+        fid_array = self.fid_array_varian
+        fids = fid_array.get_fids()
+        expected = []
+        for fid in fids:
+            single = Fid.from_data(fid.data)
+            single._params = fid._params
+            single._file_format = fid._file_format
+            single.emhz(lb=3.0)
+            single.zf()
+            single.ft()
+            single.ps(p0=20, p1=-10)
+            single.real()
+            expected.append(single.data)
+        expected = numpy.array(expected)
+        expected /= expected.max()
+        fid_array.emhz_fids(lb=3.0)
+        fid_array.zf_fids()
+        fid_array.ft_fids()
+        block = fid_array.data
+        fid_array.ps_fids(p0=20, p1=-10)
+        self.assertIs(block, fid_array.data)
+        fid_array.real_fids()
+        fid_array.norm_fids()
+        self.assertFalse(fid_array.data.dtype in fid_array._complex_dtypes)
+        self.assertTrue(numpy.allclose(expected, fid_array.data, atol=1e-6))
+        for fid, row in zip(fids, fid_array.data):
+            self.assertTrue(numpy.shares_memory(fid.data, row))
+
     def test_deconv_fids(self):
         self.fid_array_varian.ft_fids()
         self.fid_array_varian.phase_correct_fids()
@@ -627,10 +1112,235 @@ class TestFidArrayUtils(unittest.TestCase):
         self.fid_array_varian.real_fids()
         self.fid_array_varian.deconv_fids(mp=True, frac_gauss=None)
 
+    def test_deconv_tasks(self):
+        peaklists = [[[10, 20], [60]], [[10], []], [[10], [60, 70, 80]]]
+        ranges = [[[0, 50], [50, 100]], [[0, 50], [50, 100]], [[0, 50], [50, 100]]]
+        pending = [(0, 0), (0, 1), (1, 0), (2, 0), (2, 1)]
+        tasks = FidArray._deconv_tasks(peaklists, ranges, [[0], [1], [2]], pending)
+        self.assertEqual(tasks, [[(2, 1)], [(0, 0)], [(0, 1)], [(1, 0)], [(2, 0)]])
+        tasks = FidArray._deconv_tasks(peaklists, ranges, [[0, 1], [2]], pending)
+        self.assertEqual(tasks, [[(0, 0), (1, 0)], [(2, 1)], [(0, 1)], [(2, 0)]])
+        tasks = FidArray._deconv_tasks(peaklists, ranges, [[0, 1], [2]], [(1, 0), (2, 0)])
+        self.assertEqual(tasks, [[(1, 0)], [(2, 0)]])
+
+    def test_deconv_fids_mp_ranges(self):
+        self.fid_array_varian.ft_fids()
+        self.fid_array_varian.phase_correct_fids(shared=True)
+        self.fid_array_varian.real_fids()
+        fids = self.fid_array_varian.get_fids()
+        self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0)
+        sequential = [fid._deconvoluted_peaks for fid in fids]
+        with WorkerPool(cpus=2):
+            self.fid_array_varian.deconv_fids(frac_gauss=0.0)
+        for fid, peaks in zip(fids, sequential):
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks, peaks))
+        fids[0].data = fids[0].data[:-1]
+        with WorkerPool(cpus=2, backend='thread'):
+            self.fid_array_varian.deconv_fids(frac_gauss=0.0)
+        for fid, peaks in zip(fids[1:], sequential[1:]):
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks, peaks))
+
+    def test_deconv_fids_cache(self):
+        self.fid_array_varian.ft_fids()
+        self.fid_array_varian.phase_correct_fids(shared=True)
+        self.fid_array_varian.real_fids()
+        fids = self.fid_array_varian.get_fids()
+        self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0)
+        self.assertEqual(len(self.fid_array_varian._deconv_cache), 2*len(fids))
+        first = [fid._deconvoluted_peaks for fid in fids]
+        fids[3].peaks = [4.71, 4.64, 0.57]
+        with mock.patch.object(FidCore, '_deconv_datum', wraps=FidCore._deconv_datum) as deconv_datum:
+            self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0)
+        self.assertEqual(deconv_datum.call_count, 1)
+        self.assertEqual(len(deconv_datum.call_args[0][0][2]), 1)
+        self.assertEqual(fids[3]._deconvoluted_peaks.shape, (3, 5))
+        self.assertTrue(numpy.allclose(fids[3]._deconvoluted_peaks[2], first[3][3]))
+        for fid, peaks in zip(fids[4:], first[4:]):
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks, peaks))
+        with WorkerPool(cpus=1, backend='thread'):
+            self.fid_array_varian.deconv_fids(frac_gauss=0.0, cache=False)
+        for fid, peaks in zip(fids[4:], first[4:]):
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks, peaks))
+        state = self.fid_array_varian.__getstate__()
+        self.assertNotIn('_deconv_cache', state)
+
+    def test_deconvoluted_table(self):
+        for fid in self.fid_array_varian.get_fids()[3:]:
+            self.fid_array_varian.del_fid(fid.id)
+        fids = self.fid_array_varian.get_fids()
+        index_ranges = fids[0]._index_ranges
+        for i, fid in enumerate(fids):
+            offsets = [index_ranges[0][0]+10, index_ranges[0][0]+20, index_ranges[1][0]+5][:3-i%2]
+            fid._deconvoluted_peaks = numpy.array([[offset, 2.0, 3.0, 1.0+i, 0.5] for offset in offsets])
+        table = self.fid_array_varian.deconvoluted_table
+        self.assertIs(table, self.fid_array_varian.deconvoluted_table)
+        self.assertEqual(list(table['fid']), [0, 0, 0, 1, 1, 2, 2, 2])
+        self.assertEqual(list(table['peak']), [0, 1, 2, 0, 1, 0, 1, 2])
+        self.assertEqual(list(table['range']), [0, 0, 1, 0, 0, 0, 0, 1])
+        integrals = numpy.concatenate([fid.deconvoluted_integrals for fid in fids])
+        self.assertTrue(numpy.allclose(table['integral'], integrals))
+        self.assertTrue(numpy.allclose(integrals[:3], 0.5*1.0*numpy.sqrt(2*numpy.pi*4.0)+0.5*1.0*3.0*numpy.pi))
+        ragged = self.fid_array_varian.deconvoluted_integrals
+        self.assertIs(ragged, self.fid_array_varian.deconvoluted_integrals)
+        self.assertEqual(ragged.shape, (3, 3))
+        self.assertTrue(numpy.isnan(ragged[1, 2]))
+        self.assertTrue(numpy.allclose(ragged[~numpy.isnan(ragged)], integrals))
+        with self.assertRaises(ValueError):
+            ragged[0, 0] = 0.0
+        self.fid_array_varian._trace_mask = [[0, 0, 0], [-1, 1, 1], [2, -1, 2]]
+        masked = self.fid_array_varian.get_masked_integrals()
+        self.assertTrue(numpy.allclose(masked, [[integrals[0], integrals[3], integrals[5]],
+                                                [0.0, integrals[4], integrals[6]],
+                                                [integrals[1], 0.0, integrals[7]]]))
+        fids[1]._deconvoluted_peaks = fids[0]._deconvoluted_peaks
+        self.assertIsNot(table, self.fid_array_varian.deconvoluted_table)
+        self.assertFalse(numpy.isnan(self.fid_array_varian.deconvoluted_integrals).any())
+        fids[2].ranges = [[1.05, 0.27]]
+        table = self.fid_array_varian.deconvoluted_table
+        self.assertEqual(list(table['range'][table['fid'] == 2]), [-1, -1, 0])
+        self.assertEqual(list(table['range'][table['fid'] == 0]), [0, 0, 1])
+        integrals = self.fid_array_varian.deconvoluted_integrals
+        fids[2]._deconvoluted_peaks[0, 3] *= 2
+        self.assertIsNot(integrals, self.fid_array_varian.deconvoluted_integrals)
+        self.assertTrue(numpy.isclose(self.fid_array_varian.deconvoluted_integrals[2, 0], 2*integrals[2, 0]))
+
+    def test_deconv_fids_warm_start(self):
+        self.fid_array_varian.ft_fids()
+        self.fid_array_varian.phase_correct_fids(shared=True)
+        self.fid_array_varian.real_fids()
+        fids = self.fid_array_varian.get_fids()
+        self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0, warm_start=True)
+        sequential = [fid._deconvoluted_peaks for fid in fids]
+        with WorkerPool(cpus=1):
+            self.fid_array_varian.deconv_fids(mp=True, frac_gauss=0.0, warm_start=True)
+        for fid, peaks in zip(fids, sequential):
+            self.assertEqual(fid._deconvoluted_peaks.shape, (4, 5))
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks, peaks))
+
+    def test_deconv_fids_joint(self):
+        self.fid_array_varian.ft_fids()
+        self.fid_array_varian.phase_correct_fids(shared=True)
+        self.fid_array_varian.real_fids()
+        fids = self.fid_array_varian.get_fids()
+        self.fid_array_varian.deconv_fids_joint(mp=False, frac_gauss=0.0)
+        sequential = [fid._deconvoluted_peaks for fid in fids]
+        for fid in fids:
+            self.assertEqual(fid._deconvoluted_peaks.shape, (4, 5))
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks[:, 1:3], fids[0]._deconvoluted_peaks[:, 1:3]))
+        with WorkerPool(cpus=1):
+            self.fid_array_varian.deconv_fids_joint(frac_gauss=0.0)
+        for fid, peaks in zip(fids, sequential):
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks, peaks))
+        self.fid_array_varian.deconv_fids_joint(mp=False, frac_gauss=None, shared_offsets=True, window=100)
+        for fid in fids:
+            self.assertTrue(numpy.allclose(fid._deconvoluted_peaks[:, :3], fids[0]._deconvoluted_peaks[:, :3]))
+
+    def test_failed_deconv_fids_joint(self):
+        with self.assertRaises(ValueError):
+            self.fid_array_varian.deconv_fids_joint(mp=False)
+        self.fid_array_varian.ft_fids()
+        self.fid_array_varian.real_fids()
+        self.fid_array_varian.get_fids()[1].peaks = [4.71, 4.64, 4.17]
+        with self.assertRaises(ValueError):
+            self.fid_array_varian.deconv_fids_joint(mp=False)
+
     def test_failed_deconv_fids(self):
         with self.assertRaises(ValueError):
             self.fid_array_varian.deconv_fids(mp=True, frac_gauss=0.0)
 
+    def test_failed_deconv_fids_sequential(self):
+        fids = self.fid_array_varian.get_fids()
+        for warm_start in [False, True]:
+            with self.assertRaises(TypeError):
+                self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0, warm_start=warm_start)
+        self.fid_array_varian.ft_fids()
+        self.fid_array_varian.real_fids()
+        fids[1].peaks = None
+        for warm_start in [False, True]:
+            with self.assertRaises(AttributeError):
+                self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0, warm_start=warm_start)
+        fids[1].peaks = [4.71, 4.64, 4.17, 0.57]
+        fids[2].ranges = None
+        for warm_start in [False, True]:
+            with self.assertRaises(AttributeError):
+                self.fid_array_varian.deconv_fids(mp=False, frac_gauss=0.0, warm_start=warm_start)
+        self.assertTrue(all(fid._deconvoluted_peaks is None for fid in fids))
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_map(self):
+        for backend in ['process', 'thread']:
+            with WorkerPool(cpus=2, backend=backend) as pool:
+                result = pool.map(numpy.sum, [numpy.arange(i) for i in range(20)], chunksize=3)
+                self.assertEqual(result, [sum(range(i)) for i in range(20)])
+                self.assertIs(get_worker_pool(cpus=3), pool)
+            self.assertIsNone(pool._pool)
+
+    def test_shared_pool(self):
+        pool = get_worker_pool(cpus=1, backend='thread')
+        self.assertIs(get_worker_pool(), pool)
+        self.assertIs(get_worker_pool(backend='thread'), pool)
+        self.assertIsNot(get_worker_pool(cpus=2, backend='thread'), pool)
+        close_worker_pool()
+
+    def test_failed_worker_pool(self):
+        with self.assertRaises(ValueError):
+            WorkerPool(cpus=0)
+        with self.assertRaises(ValueError):
+            WorkerPool(backend='string')
+
+    def test_deconv_fids_thread_pool(self):
+        path_varian = os.path.join(testpath, 'test_data', 'test1.fid')
+        fid_array = FidArray.from_path(fid_path=path_varian, file_format='varian')
+        for fid in fid_array.get_fids():
+            fid.peaks = [ 4.71,  4.64,  4.17,  0.57]
+            fid.ranges = [[ 5.29,  3.67], [1.05,  0.27]]
+        with WorkerPool(cpus=2, backend='thread'):
+            fid_array.ft_fids()
+            fid_array.phase_correct_fids()
+            fid_array.real_fids()
+            fid_array.deconv_fids()
+        self.assertTrue(all(len(fid._deconvoluted_peaks) == 4 for fid in fid_array.get_fids()))
+
+    def test_shared_array(self):
+        data = numpy.arange(12.0).reshape(3, 4)
+        with WorkerPool(cpus=2) as pool:
+            with pool.share(data) as shared:
+                self.assertIsInstance(shared, SharedArray)
+                self.assertIsNot(shared.array, data)
+                pool.map(_double_shared_row, [[shared, i] for i in range(3)])
+                self.assertTrue(numpy.array_equal(shared.array, 2*data))
+            self.assertIsNone(shared.array)
+        with WorkerPool(cpus=2, backend='thread') as pool:
+            with pool.share(data) as shared:
+                self.assertIs(shared.array, data)
+
+    def test_shared_phase_correct_deconv_fids(self):
+        path_varian = os.path.join(testpath, 'test_data', 'test1.fid')
+        fid_arrays = [FidArray.from_path(fid_path=path_varian, file_format='varian') for i in range(2)]
+        for fid_array in fid_arrays:
+            for fid in fid_array.get_fids():
+                fid.peaks = [ 4.71,  4.64,  4.17,  0.57]
+                fid.ranges = [[ 5.29,  3.67], [1.05,  0.27]]
+            fid_array.ft_fids()
+        fid_arrays[0].phase_correct_fids(mp=False)
+        with WorkerPool(cpus=2):
+            block = fid_arrays[1].data
+            fid_arrays[1].phase_correct_fids()
+            self.assertIs(block, fid_arrays[1].data)
+            self.assertTrue(numpy.allclose(fid_arrays[0].data, fid_arrays[1].data))
+            self.assertTrue(numpy.allclose(fid_arrays[0].phase_corrections, fid_arrays[1].phase_corrections))
+            for fid_array in fid_arrays:
+                fid_array.real_fids()
+            fid_arrays[0].deconv_fids(mp=False)
+            fid_arrays[1].deconv_fids()
+        for fid0, fid1 in zip(*[fid_array.get_fids() for fid_array in fid_arrays]):
+            self.assertTrue(numpy.allclose(fid0._deconvoluted_peaks, fid1._deconvoluted_peaks))
+
+def _double_shared_row(list_params):
+    shared, index = list_params
+    shared.array[index] *= 2
+
 class TestPlottingUtils(unittest.TestCase):
 
     def setUp(self):
@@ -709,6 +1419,7 @@ class NMRPyTest:
         'fidarrayinit'  - FidArray initialisation tests
         'fidutils'      - Fid utilities tests
         'fidarrayutils' - FidArray utilities tests
+        'workerpool'    - worker pool tests
         'plotutils'     - plotting utilities tests
         'noplot'        - all tests except plotting utilities (scripted usage)
         """
@@ -718,6 +1429,7 @@ class NMRPyTest:
         fidarrayinit_test = unittest.makeSuite(TestFidArrayInitialisation)
         fidutils_test = unittest.makeSuite(TestFidUtils)
         fidarrayutils_test = unittest.makeSuite(TestFidArrayUtils)
+        workerpool_test = unittest.makeSuite(TestWorkerPool)
         plotutils_test = unittest.makeSuite(TestPlottingUtils)
         
         suite = baseinit_test
@@ -726,12 +1438,14 @@ class NMRPyTest:
             suite.addTests(fidarrayinit_test)
             suite.addTests(fidutils_test)
             suite.addTests(fidarrayutils_test)
+            suite.addTests(workerpool_test)
             suite.addTests(plotutils_test)
         elif tests == 'noplot':
             suite.addTests(fidinit_test)
             suite.addTests(fidarrayinit_test)
             suite.addTests(fidutils_test)
             suite.addTests(fidarrayutils_test)
+            suite.addTests(workerpool_test)
         elif tests == 'fidinit':
             suite.addTests(fidinit_test)
         elif tests == 'fidarrayinit':
@@ -740,6 +1454,8 @@ class NMRPyTest:
             suite.addTests(fidutils_test)
         elif tests == 'fidarrayutils':
             suite.addTests(fidarrayutils_test)
+        elif tests == 'workerpool':
+            suite.addTests(workerpool_test)
         elif tests == 'plotutils':
             suite.addTests(plotutils_test)
         else: